@@ -0,0 +1,517 @@
+import asyncio
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from plex.debank_api import DebankAPI
+from plex.debank_server import DebankStandIn, synthetic_raw_snapshot, synthetic_history
+from plex.plex import PnlExplainer
+from plex.rebuild import RebuildEngine
+from utils.coingecko import AddressIndex, myCoinGeckoAPI
+from utils.db import SQLiteDB, LocalJsonRawDataDB, json_loads, orjson
+from utils.prices import PriceStore, FixturePriceBackend
+
+
+def synthetic_snapshots(n_snapshots: int, n_positions: int, addresses: list[str], start_timestamp: int = 1700000000) -> list[pd.DataFrame]:
+    '''
+    parsed snapshot frames as parse_snapshot would produce them, one per (timestamp, address).
+    positions are the same across snapshots, amounts and prices drift.
+    '''
+    rng = np.random.default_rng(0)
+    positions = pd.DataFrame({'chain': [['eth', 'arb', 'op', 'base'][j % 4] for j in range(n_positions)],
+                              'protocol': [f'protocol_{j % 50}' for j in range(n_positions)],
+                              'hold_mode': 'Lending',
+                              'type': [['supply_token_list', 'borrow_token_list'][j % 2] for j in range(n_positions)],
+                              'asset': [f'asset_{j}' for j in range(n_positions)]})
+    sign = np.where(positions['type'] == 'borrow_token_list', -1, 1)
+    frames = []
+    for address in addresses:
+        amount = sign * rng.lognormal(size=n_positions)
+        price = rng.lognormal(size=n_positions)
+        for i in range(n_snapshots):
+            amount = amount * (1 + 1e-4 * rng.standard_normal(n_positions))
+            price = price * (1 + 1e-3 * rng.standard_normal(n_positions))
+            frames.append(positions.assign(amount=amount, price=price, value=amount * price,
+                                           timestamp=start_timestamp + 60 * i, address=address))
+    return frames
+
+
+def legacy_parse_snapshot(dict_input: dict, redundant_protocols: list) -> pd.DataFrame:
+    '''DebankAPI.parse_snapshot before the columnar parser: deepcopy, a dict per position, sum of lists'''
+    dict_result = copy.deepcopy(dict_input)
+    timestamp = int(dict_result.pop('timestamp'))
+    address = dict_result.pop('address')
+    res_list = []
+    for protocol in dict_result['all_complex_protocol_list']:
+        for portfolio_item in protocol['portfolio_item_list']:
+            for bucket_type, positions in portfolio_item['detail'].items():
+                if isinstance(positions, list):
+                    res_list.extend({'chain': protocol['chain'], 'protocol': protocol['name'],
+                                     'hold_mode': portfolio_item['name'], 'type': bucket_type,
+                                     'asset': position['symbol'],
+                                     'amount': (-1 if 'borrow' in bucket_type else 1) * position['amount'],
+                                     'price': position['price'],
+                                     'value': (-1 if 'borrow' in bucket_type else 1) * position['amount'] * position['price']}
+                                    for position in positions)
+    res_list = sum([res_list,
+                    [{'chain': position['chain'], 'protocol': 'wallet', 'hold_mode': 'cash', 'type': 'cash',
+                      'asset': position['symbol'], 'amount': position['amount'], 'price': position['price'],
+                      'value': position['amount'] * position['price']}
+                     for position in dict_result['all_token_list']
+                     if position['is_verified'] and position['is_core'] and (position['price'] > 0)],
+                    [{'chain': position['chain'], 'protocol': position['name'], 'hold_mode': 'cash', 'type': 'nft',
+                      'asset': position['name'], 'amount': position['amount'], 'price': position['usd_price'],
+                      'value': position['amount'] * position['usd_price']}
+                     for position in dict_result['all_nft_list']
+                     if ('usd_price' in position) and (position['usd_price'] > 0)]], [])
+    df_result = pd.DataFrame(res_list)
+    df_result['timestamp'] = timestamp
+    df_result['address'] = address
+    return df_result[~df_result['protocol'].isin(redundant_protocols)]
+
+
+def bench_parse_snapshot(n_snapshots: int = 20, n_protocols: int = 500, n_tokens: int = 2000) -> None:
+    '''
+    decoding + parsing of whale-style raw snapshots: legacy parser one at a time with json,
+    versus DebankAPI.parse_snapshots all at once with json_loads (orjson if installed)
+    '''
+    parameters = {'plex': {'redundant_protocols': [None]}}
+    api = DebankAPI(json_db=None, plex_db=None, parameters=parameters)
+    raw = [json.dumps(synthetic_raw_snapshot('0xwhale', 1700000000 + 60 * i, n_protocols=n_protocols,
+                                             n_tokens=n_tokens, seed=i)).encode('utf-8')
+           for i in range(n_snapshots)]
+
+    start = time.perf_counter()
+    legacy = pd.concat([legacy_parse_snapshot(json.loads(data), parameters['plex']['redundant_protocols']) for data in raw],
+                       ignore_index=True)
+    elapsed = time.perf_counter() - start
+    print(f'legacy parse_snapshot: {len(legacy)} rows in {elapsed:.2f}s -> {len(legacy) / elapsed:,.0f} rows/s')
+
+    start = time.perf_counter()
+    columnar = api.parse_snapshots([json_loads(data) for data in raw]).reset_index(drop=True)
+    elapsed = time.perf_counter() - start
+    print(f'parse_snapshots:       {len(columnar)} rows in {elapsed:.2f}s -> {len(columnar) / elapsed:,.0f} rows/s '
+          f'({"orjson" if orjson is not None else "json"})')
+    pd.testing.assert_frame_equal(legacy, columnar)
+
+
+def legacy_parse_all_history_list(transactions: dict) -> pd.DataFrame:
+    '''DebankAPI.parse_all_history_list before vectorization'''
+    result = []
+    for tx in transactions['history_list']:
+        if not tx['is_scam']:
+            def append_leg(leg, side):
+                result = {'id': tx['id'],
+                          'timestamp': tx['time_at'],
+                          'chain': tx['chain'],
+                          'protocol': transactions['project_dict'][tx['project_id']]['name'] if tx['project_id'] else
+                          leg['to_addr' if side == -1 else 'from_addr'],
+                          'gas': tx['tx']['usd_gas_fee'] if 'usd_gas_fee' in tx['tx'] else 0.0,
+                          'type': tx['tx']['name'],
+                          'asset': leg['token_id'],
+                          'amount': leg['amount'] * side}
+                if leg['token_id'] in transactions['token_dict']:
+                    if ('price' in transactions['token_dict'][leg['token_id']]) and transactions['token_dict'][leg['token_id']]['price']:
+                        result['price'] = transactions['token_dict'][leg['token_id']]['price']
+                        result['pnl'] = leg['amount'] * result['price'] * side
+                return result
+
+            if 'receives' in tx:
+                for cur_leg in tx['receives']:
+                    result.append(append_leg(cur_leg, 1))
+            if 'sends' in tx:
+                for cur_leg in tx['sends']:
+                    result.append(append_leg(cur_leg, -1))
+
+    df = pd.DataFrame(result)
+    if not df.empty:
+        df['pnl'] = df['pnl'] - df['gas']
+    return df
+
+
+def bench_parse_history(n_legs: int = 100000) -> None:
+    '''legacy per-leg parse_all_history_list versus the vectorized one, on a history of n_legs legs'''
+    transactions = synthetic_history(n_legs)
+
+    start = time.perf_counter()
+    legacy = legacy_parse_all_history_list(transactions)
+    elapsed = time.perf_counter() - start
+    print(f'legacy parse_all_history_list: {len(legacy)} legs in {elapsed:.2f}s -> {len(legacy) / elapsed:,.0f} legs/s')
+
+    start = time.perf_counter()
+    vectorized = DebankAPI.parse_all_history_list(transactions)
+    elapsed = time.perf_counter() - start
+    print(f'parse_all_history_list:        {len(vectorized)} legs in {elapsed:.2f}s -> {len(vectorized) / elapsed:,.0f} legs/s')
+    pd.testing.assert_frame_equal(legacy, vectorized)
+
+
+def decoded(df: pd.DataFrame) -> pd.DataFrame:
+    '''categoricals back to object, to compare with frames of the object dtype era'''
+    return df.astype({column: object for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)})
+
+
+def legacy_explain(explainer: PnlExplainer, start_snapshot: pd.DataFrame, end_snapshot: pd.DataFrame) -> pd.DataFrame:
+    '''PnlExplainer.explain before vectorization: set operations on index tuples, row-wise apply, deepcopies'''
+    snapshot_start = start_snapshot.set_index([col for col in start_snapshot.columns if col not in ['price', 'amount', 'value', 'timestamp']])
+    snapshot_end = end_snapshot.set_index([col for col in end_snapshot.columns if col not in ['price', 'amount', 'value', 'timestamp']])
+    data = snapshot_start.join(snapshot_end, how='outer', lsuffix='_start', rsuffix='_end')
+    common_pos = data[data.index.isin(set(snapshot_start.index) & set(snapshot_end.index))].reset_index()
+    before_pos = data[data.index.isin(set(snapshot_start.index) - set(snapshot_end.index))].reset_index()
+    after_pos = data[data.index.isin(set(snapshot_end.index) - set(snapshot_start.index))].reset_index()
+
+    common_pos['underlying'] = common_pos['asset'].apply(explainer.underlying)
+    before_pos['underlying'] = before_pos['asset'].apply(explainer.underlying)
+    after_pos['underlying'] = after_pos['asset'].apply(explainer.underlying)
+    common_pos[['P_underlying_start', 'P_underlying_end']] = common_pos.apply(lambda x: common_pos.loc[common_pos['asset'] == x['underlying'], ['price_start', 'price_end']].mean(), axis=1)
+    common_pos = common_pos.fillna(0)
+
+    delta_pnl = copy.deepcopy(common_pos)
+    delta_pnl['pnl_bucket'] = 'delta'
+    delta_pnl['pnl'] = (common_pos['P_underlying_end'] - common_pos['P_underlying_start']) * common_pos['amount_start'] * common_pos['price_start'] / common_pos['P_underlying_start']
+    basis_pnl = copy.deepcopy(common_pos)
+    basis_pnl['pnl_bucket'] = 'basis'
+    basis_pnl['pnl'] = common_pos['amount_start']*(common_pos['price_end'] - common_pos['price_start']) - delta_pnl['pnl']
+    amt_chng_pnl = copy.deepcopy(common_pos)
+    amt_chng_pnl['pnl_bucket'] = 'amt_chng'
+    amt_chng_pnl['pnl'] = (common_pos['amount_end'] - common_pos['amount_start']) * common_pos['price_end']
+    before_pos['pnl_bucket'] = 'amt_chng'
+    before_pos['pnl'] = - before_pos['amount_start'] * before_pos['price_start']
+    after_pos['pnl_bucket'] = 'amt_chng'
+    after_pos['pnl'] = after_pos['amount_end'] * after_pos['price_end']
+
+    result = pd.concat([delta_pnl, basis_pnl, amt_chng_pnl, before_pos, after_pos], axis=0, ignore_index=True)
+    result['timestamp_end'] = datetime.fromtimestamp(max(common_pos['timestamp_end']), tz=timezone.utc)
+    result['timestamp_start'] = datetime.fromtimestamp(min(common_pos['timestamp_start']), tz=timezone.utc)
+    return result
+
+
+def bench_explain(n_positions: int = 2000, n_addresses: int = 2) -> None:
+    '''
+    PnlExplainer.explain versus the row-wise legacy explain, between two snapshots of n_positions per address
+    where 5% of positions are closed and 5% opened
+    '''
+    addresses = [f'0x{i:040x}' for i in range(n_addresses)]
+    frames = synthetic_snapshots(2, n_positions, addresses)
+    start_snapshot = pd.concat(frames[0::2], ignore_index=True)
+    end_snapshot = pd.concat(frames[1::2], ignore_index=True)
+    start_snapshot = start_snapshot[start_snapshot.index % 20 != 0]
+    end_snapshot = end_snapshot[end_snapshot.index % 20 != 1]
+    # a tenth of the assets are underlyings of the others
+    explainer = PnlExplainer({f'asset_{j}': f'asset_{j - j % 10}' for j in range(n_positions)})
+
+    start = time.perf_counter()
+    legacy = legacy_explain(explainer, start_snapshot, end_snapshot)
+    elapsed = time.perf_counter() - start
+    print(f'legacy explain: {len(start_snapshot)} positions in {elapsed:.2f}s')
+
+    start = time.perf_counter()
+    result = explainer.explain(start_snapshot, end_snapshot)
+    elapsed = time.perf_counter() - start
+    print(f'explain:        {len(start_snapshot)} positions in {elapsed:.3f}s')
+    pd.testing.assert_frame_equal(legacy, decoded(result))
+
+
+def bench_explain_periods(n_snapshots: int = 100, n_positions: int = 500, n_addresses: int = 2) -> None:
+    '''
+    explain of every consecutive pair of n_snapshots: one PnlExplainer.explain per pair on filtered frames
+    (as the pnl_history tab used to) versus one PnlExplainer.explain_periods
+    '''
+    addresses = [f'0x{i:040x}' for i in range(n_addresses)]
+    snapshots = pd.concat(synthetic_snapshots(n_snapshots, n_positions, addresses), ignore_index=True)
+    # positions come and go
+    snapshots = snapshots[(snapshots.index * 7) % 101 != 0].reset_index(drop=True)
+    explainer = PnlExplainer({f'asset_{j}': f'asset_{j - j % 10}' for j in range(n_positions)})
+
+    start = time.perf_counter()
+    timestamps = snapshots['timestamp'].unique()
+    per_pair = pd.concat([explainer.explain(snapshots[snapshots['timestamp'] == start], snapshots[snapshots['timestamp'] == end])
+                          for start, end in zip(timestamps[:-1], timestamps[1:])], axis=0, ignore_index=True)
+    elapsed = time.perf_counter() - start
+    print(f'explain per pair: {len(timestamps) - 1} pairs in {elapsed:.2f}s')
+
+    start = time.perf_counter()
+    result = explainer.explain_periods(snapshots)
+    elapsed = time.perf_counter() - start
+    print(f'explain_periods:  {len(timestamps) - 1} pairs in {elapsed:.2f}s')
+    pd.testing.assert_frame_equal(decoded(per_pair), decoded(result))
+
+
+def bench_prices(n_pairs: int = 100000, n_coins: int = 20, days: int = 90) -> None:
+    '''
+    PriceStore.prices_at of n_pairs random (coin, timestamp) over hourly fixture prices of n_coins over days:
+    first call fetches each coin once, second one is served from plex.db, a longer window only fetches the new range
+    '''
+    rng = np.random.default_rng(0)
+    end = int(time.time()) // 3600 * 3600
+    start = end - days * 86400
+    hours = np.arange(start, end, 3600)
+    fixture = pd.DataFrame({'coin_id': np.repeat([f'coin_{i}' for i in range(n_coins)], len(hours)),
+                            'timestamp': np.tile(hours, n_coins),
+                            'price': rng.lognormal(size=n_coins * len(hours))})
+    backend = FixturePriceBackend(fixture)
+    coin_ids = rng.choice([f'coin_{i}' for i in range(n_coins)], n_pairs)
+    timestamps = rng.integers(start + 86400 * days // 2, end, n_pairs)
+    with tempfile.TemporaryDirectory() as data_dir:
+        store = PriceStore(SQLiteDB({'data_dir': os.path.join(data_dir, 'plex')}, {}), backend)
+        for label, window_start in [('cold', start + 86400 * days // 2), ('warm', start + 86400 * days // 2), ('extended', start + 86400)]:
+            timestamps[0] = window_start
+            n_fetched = len(backend.fetched)
+            begin = time.perf_counter()
+            prices = store.prices_at(coin_ids, timestamps)
+            elapsed = time.perf_counter() - begin
+            print(f'prices_at {label}: {n_pairs} pairs in {elapsed:.2f}s -> {n_pairs / elapsed:,.0f} pairs/s, '
+                  f'{len(backend.fetched) - n_fetched} fetches, {np.isnan(prices).sum()} unpriced')
+
+
+def bench_memory(days: int = 90, n_positions: int = 300, n_addresses: int = 2) -> None:
+    '''
+    memory of a risk history of hourly snapshots over days, as object strings (as query_table_between used to
+    return it) versus the categoricals of snapshot_schema, and of its explain_periods
+    '''
+    addresses = [f'0x{i:040x}' for i in range(n_addresses)]
+    frames = synthetic_snapshots(days * 24, n_positions, addresses)
+    for df in frames:
+        df['timestamp'] = 1700000000 + (df['timestamp'] - 1700000000) * 60
+    with tempfile.TemporaryDirectory() as data_dir:
+        plex_db = SQLiteDB({'data_dir': os.path.join(data_dir, 'plex')}, {})
+        plex_db.bulk_insert(frames, 'snapshots')
+        start, end = frames[0]['timestamp'].iloc[0], frames[-1]['timestamp'].iloc[0]
+        with plex_db.connections.reader() as conn:
+            strings = pd.read_sql_query('SELECT * FROM snapshots WHERE timestamp BETWEEN ? AND ?', conn, params=(int(start), int(end)))
+        categoricals = plex_db.query_table_between(addresses, start, end, 'snapshots')
+    explainer = PnlExplainer({f'asset_{j}': f'asset_{j - j % 10}' for j in range(n_positions)})
+    explains = explainer.explain_periods(categoricals)
+    for label, df in [('snapshots, object', strings), ('snapshots, categorical', categoricals),
+                      ('explain_periods, object', decoded(explains)), ('explain_periods, categorical', explains)]:
+        print(f'{label}: {len(df)} rows, {df.memory_usage(deep=True).sum() / 1e6:,.1f}MB')
+
+
+def bench_ingest(n_addresses: int = 10, latency: float = 0.05, max_concurrency: int = 0, rate_429: float = 0.0) -> None:
+    '''
+    ingest of n_addresses through DebankAPI against a local DebankStandIn: throughput of fetch (snapshot endpoints and
+    paginated history, written to a raw data dir), parse, insert into plex.db and upload to a local remote,
+    and p50/p99 latency of the endpoint calls
+    '''
+    server = DebankStandIn(latency=latency, max_concurrency=max_concurrency or None, rate_429=rate_429)
+    api_url = server.start_in_thread()
+    addresses = [f'0x{i:040x}' for i in range(n_addresses)]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as data_dir:
+        # a plex.db synced to a remote lives in the working directory
+        os.chdir(data_dir)
+        try:
+            parameters = {'profile': {'debank_key': 'stand-in', 'api_url': api_url, 'addresses': addresses},
+                          'run_parameters': {'async': {'gather_limit': 10, 'max_window': 200},
+                                             'http': {'limit': 200, 'limit_per_host': 200}},
+                          'plex': {'redundant_protocols': [None], 'update_frequency': 1}}
+            json_db = LocalJsonRawDataDB({'data_dir': os.path.join(data_dir, 'raw_data'), 'compression': 'gzip'})
+            plex_db = SQLiteDB({'remote_dir': os.path.join(data_dir, 'remote'), 'remote_file': 'plex.db'}, {})
+            api = DebankAPI(json_db, plex_db, parameters)
+
+            latencies = []
+            get = api._get
+
+            async def timed_get(endpoint: str, params: dict = None):
+                start = time.perf_counter()
+                try:
+                    return await get(endpoint, params)
+                finally:
+                    latencies.append(time.perf_counter() - start)
+            api._get = timed_get
+
+            start = time.perf_counter()
+            results = asyncio.run(api.gather([api._fetch_snapshot(address, write_to_json=True) for address in addresses] +
+                                             [api._fetch_transactions(address, 0, int(time.time()), write_to_json=True)
+                                              for address in addresses]))
+            elapsed = time.perf_counter() - start
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print(f'fetch:  {len(latencies)} calls in {elapsed:.2f}s -> {len(latencies) / elapsed:,.0f} calls/s, '
+                  f'p50 {p50:.0f}ms, p99 {p99:.0f}ms, {server.throttled} throttled, final {api.limiter}, '
+                  f'{1e6 - server.balance:,.0f} credits')
+
+            start = time.perf_counter()
+            snapshots = api.parse_snapshots(results[:n_addresses])
+            elapsed = time.perf_counter() - start
+            print(f'parse:  {len(snapshots)} rows in {elapsed:.2f}s -> {len(snapshots) / elapsed:,.0f} rows/s')
+
+            transactions = [df.assign(address=address).drop_duplicates('id')
+                            for address, (_, df) in zip(addresses, results[n_addresses:]) if not df.empty]
+            start = time.perf_counter()
+            n_rows = plex_db.bulk_insert([snapshots], 'snapshots') + plex_db.bulk_insert(transactions, 'transactions')
+            elapsed = time.perf_counter() - start
+            print(f'insert: {n_rows} rows in {elapsed:.2f}s -> {n_rows / elapsed:,.0f} rows/s')
+
+            start = time.perf_counter()
+            plex_db.upload_to_s3()
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(plex_db.data_location['local_file']) / 1e6
+            print(f'upload: {size:.1f}MB in {elapsed:.2f}s -> {size / elapsed:,.1f}MB/s')
+        finally:
+            os.chdir(cwd)
+            server.stop_thread()
+
+
+def bench_rebuild_engine(n_snapshots: int = 2000, n_addresses: int = 2) -> None:
+    '''files/s and rows/s of RebuildEngine over a local raw data directory of synthetic snapshots'''
+    parameters = {'plex': {'redundant_protocols': [None]}}
+    with tempfile.TemporaryDirectory() as data_dir:
+        json_db = LocalJsonRawDataDB({'data_dir': os.path.join(data_dir, 'raw_data'), 'compression': 'gzip'})
+        addresses = [f'0x{i:040x}' for i in range(n_addresses)]
+        for address in addresses:
+            for i in range(n_snapshots):
+                json_db.insert_table(synthetic_raw_snapshot(address, 1700000000 + 60 * i, seed=i), address, 'snapshots')
+        plex_db = SQLiteDB({'data_dir': os.path.join(data_dir, 'plex')}, {})
+        stats = RebuildEngine(json_db, plex_db, parameters).run(addresses)
+        print(f"RebuildEngine: {stats['files']} files, {stats['rows']} rows in {stats['seconds']:.2f}s -> "
+              f"{stats['files'] / stats['seconds']:,.0f} files/s, {stats['rows'] / stats['seconds']:,.0f} rows/s")
+
+
+def bench_rebuild(n_snapshots: int = 2000, n_positions: int = 50, n_addresses: int = 2) -> None:
+    '''
+    rows/sec of a full rebuild of n_snapshots, per-frame pandas to_sql (as rebuild_db_from_json used to)
+    versus bulk_insert in one transaction
+    '''
+    addresses = [f'0x{i:040x}' for i in range(n_addresses)]
+    frames = synthetic_snapshots(n_snapshots, n_positions, addresses)
+    n_rows = sum(len(df) for df in frames)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        plex_db = SQLiteDB({'data_dir': os.path.join(data_dir, 'to_sql'), 'journal_mode': 'DELETE', 'synchronous': 'FULL'}, {})
+        start = time.perf_counter()
+        for df in frames:
+            plex_db.connections.write(lambda conn: df.to_sql('snapshots', conn, if_exists='append', index=False))
+        elapsed = time.perf_counter() - start
+        print(f'to_sql per frame: {n_rows} rows in {elapsed:.2f}s -> {n_rows / elapsed:,.0f} rows/s')
+
+        plex_db = SQLiteDB({'data_dir': os.path.join(data_dir, 'bulk')}, {})
+        start = time.perf_counter()
+        plex_db.bulk_insert(frames, 'snapshots')
+        elapsed = time.perf_counter() - start
+        print(f'bulk_insert:      {n_rows} rows in {elapsed:.2f}s -> {n_rows / elapsed:,.0f} rows/s')
+
+
+def bench_address_index(n_lookups: int = 2000) -> None:
+    '''
+    n_lookups (address, chain) -> coin id over config/coingecko_address_map.csv: one column scan per lookup, as
+    address_to_id did, against AddressIndex bulk lookups, after a cold build and a warm load of the index
+    '''
+    source = os.path.join('config', 'coingecko_address_map.csv')
+    address_map = myCoinGeckoAPI.adapt_address_map_to_defillama(pd.read_csv(source, index_col='id', dtype=str, keep_default_na=False))
+    chains = [chain for chain in ['Ethereum', 'Arbitrum', 'Polygon', 'Optimism', 'Base'] if chain in address_map.columns]
+    listed = pd.concat([pd.DataFrame({'chain': chain, 'address': address_map.loc[address_map[chain] != '', chain]})
+                        for chain in chains]).sample(n_lookups, replace=True, random_state=0)
+
+    begin = time.perf_counter()
+    legacy = [address_map[address_map[chain] == address].index[0] for chain, address in zip(listed['chain'], listed['address'])]
+    elapsed_legacy = time.perf_counter() - begin
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        filename = os.path.join(data_dir, 'coingecko_address_index.pickle')
+        begin = time.perf_counter()
+        AddressIndex.load(filename, source=source)
+        elapsed_build = time.perf_counter() - begin
+        begin = time.perf_counter()
+        index = AddressIndex.load(filename, source=source)
+        elapsed_load = time.perf_counter() - begin
+        begin = time.perf_counter()
+        result = index.lookup(map(myCoinGeckoAPI.platform, listed['chain']), listed['address'].str.upper())
+        elapsed_lookup = time.perf_counter() - begin
+
+    print(f'column scans:  {n_lookups} lookups in {elapsed_legacy:.3f}s -> {n_lookups / elapsed_legacy:,.0f} lookups/s')
+    print(f'address index: built in {elapsed_build:.3f}s, loaded in {elapsed_load * 1000:.1f}ms, '
+          f'{n_lookups} lookups in {elapsed_lookup * 1000:.1f}ms -> {n_lookups / elapsed_lookup:,.0f} lookups/s, '
+          f'{len(index.index)} contracts')
+    # contracts listed under several coins resolve to the first one in both
+    assert result['id'].tolist() == legacy
+
+
+class FixtureCoinGeckoAPI(myCoinGeckoAPI):
+    '''market chart range endpoint over a synthetic price path, at coingecko's granularities. calls counts requests'''
+    def __init__(self, series_cache_dir: str):
+        super().__init__()
+        self.series_cache_dir = series_cache_dir
+        self.calls = 0
+
+    def get_coin_market_chart_range_by_id(self, id, vs_currency, from_timestamp, to_timestamp, **kwargs):
+        self.calls += 1
+        span = to_timestamp - from_timestamp
+        step = 300 if span <= 86400 else 3600 if span <= 90 * 86400 else 86400
+        timestamps = np.arange((from_timestamp // step + 1) * step, to_timestamp, step) * 1000
+        prices = np.exp(np.sin(timestamps / 1e10))
+        return {'prices': np.column_stack([timestamps, prices]).tolist(),
+                'market_caps': np.column_stack([timestamps, prices * 1e9]).tolist(),
+                'total_volumes': np.column_stack([timestamps, prices * 1e7]).tolist()}
+
+
+def bench_series_cache(n_requests: int = 200, days: int = 60) -> None:
+    '''
+    n_requests fetch_range calls of random windows of 30 to 60 days within the last days + 60, through the series
+    cache, against one request and one per-row timestamp conversion per call, as fetch_range did
+    '''
+    rng = np.random.default_rng(0)
+    now = time.time()
+    starts = now - rng.uniform(60, 60 + days, n_requests) * 86400
+    ends = starts + rng.uniform(30, 60, n_requests) * 86400
+    with tempfile.TemporaryDirectory() as cache_dir:
+        api = FixtureCoinGeckoAPI(cache_dir)
+
+        begin = time.perf_counter()
+        for start, end in zip(starts, ends):
+            data = api.get_coin_market_chart_range_by_id('bitcoin', 'usd', int(start), int(end))
+            legacy = pd.DataFrame(data['prices'], columns=['timestamp', 'price'])
+            legacy['timestamp'] = legacy['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000).replace(tzinfo=timezone.utc))
+        elapsed_legacy = time.perf_counter() - begin
+        calls_legacy, api.calls = api.calls, 0
+
+        begin = time.perf_counter()
+        for start, end in zip(starts, ends):
+            result = api.fetch_range('bitcoin', datetime.fromtimestamp(start, tz=timezone.utc), datetime.fromtimestamp(end, tz=timezone.utc))
+        elapsed = time.perf_counter() - begin
+
+    print(f'refetch:      {n_requests} windows in {elapsed_legacy:.2f}s, {calls_legacy} requests')
+    print(f'series cache: {n_requests} windows in {elapsed:.2f}s, {api.calls} requests')
+    # the last window, served from cache, matches a direct request
+    assert np.allclose(result['price'].to_numpy(), legacy['price'].to_numpy())
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'rebuild':
+        # python benchmark.py rebuild [n_snapshots] [n_positions] [n_addresses]
+        bench_rebuild(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == 'rebuild_engine':
+        # python benchmark.py rebuild_engine [n_snapshots] [n_addresses]
+        bench_rebuild_engine(*[int(arg) for arg in sys.argv[2:4]])
+    elif sys.argv[1] == 'parse_snapshot':
+        # python benchmark.py parse_snapshot [n_snapshots] [n_protocols] [n_tokens]
+        bench_parse_snapshot(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == 'ingest':
+        # python benchmark.py ingest [n_addresses] [latency] [max_concurrency] [rate_429]
+        bench_ingest(*[cast(arg) for cast, arg in zip([int, float, int, float], sys.argv[2:6])])
+    elif sys.argv[1] == 'parse_history':
+        # python benchmark.py parse_history [n_legs]
+        bench_parse_history(*[int(arg) for arg in sys.argv[2:3]])
+    elif sys.argv[1] == 'explain':
+        # python benchmark.py explain [n_positions] [n_addresses]
+        bench_explain(*[int(arg) for arg in sys.argv[2:4]])
+    elif sys.argv[1] == 'explain_periods':
+        # python benchmark.py explain_periods [n_snapshots] [n_positions] [n_addresses]
+        bench_explain_periods(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == 'memory':
+        # python benchmark.py memory [days] [n_positions] [n_addresses]
+        bench_memory(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == 'prices':
+        # python benchmark.py prices [n_pairs] [n_coins] [days]
+        bench_prices(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == 'address_index':
+        # python benchmark.py address_index [n_lookups]
+        bench_address_index(*[int(arg) for arg in sys.argv[2:3]])
+    elif sys.argv[1] == 'series_cache':
+        # python benchmark.py series_cache [n_requests] [days]
+        bench_series_cache(*[int(arg) for arg in sys.argv[2:4]])
@@ -1,5 +1,6 @@
 import asyncio
 import copy
+import logging
 import sys
 import os
 from hashlib import sha256
@@ -8,11 +9,15 @@ import toml
 import yaml
 
 from plex.debank_api import DebankAPI
-from utils.async_utils import safe_gather
+from plex.plex import PnlExplainer
+from plex.rebuild import RebuildEngine
+from plex.scheduler import RefreshScheduler
 from utils.db import SQLiteDB, SQLiteDB, RawDataDB, S3JsonRawDataDB
+from utils.prices import PriceStore, CoinGeckoPriceBackend
 
 if __name__ == '__main__':
-    if sys.argv[1] in ['snapshot', 'rebuild_db']:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if sys.argv[1] in ['snapshot', 'refresh_plan', 'rebuild_db', 'compact_raw_data']:
         with open(os.path.join(os.sep, os.getcwd(), '.streamlit', 'secrets.toml'), 'r') as f:
             secrets = toml.load(f)
         with open(os.path.join(os.sep, os.getcwd(), 'config', 'params.yaml'), 'r') as f:
@@ -24,7 +29,7 @@ if __name__ == '__main__':
         plex_db_params = copy.deepcopy(parameters['input_data']['plex_db'])
         plex_db_params['remote_file'] = plex_db_params['remote_file'].replace('.db', f"_{parameters['profile']['debank_key']}.db")
 
-        plex_db: SQLiteDB = SQLiteDB(plex_db_params, secrets)
+        plex_db: SQLiteDB = SQLiteDB(plex_db_params, secrets, pool_config=parameters['run_parameters']['async'])
         # empty the plex.db file
 
         raw_data_db: RawDataDB = RawDataDB.build_RawDataDB(parameters['input_data']['raw_data_db'], secrets)
@@ -32,14 +37,34 @@ if __name__ == '__main__':
 
         addresses = parameters['profile']['addresses']
         if sys.argv[1] == 'snapshot':
-            refresh = True
-            all_fetch = asyncio.run(safe_gather([api.fetch_snapshot(address, refresh=refresh)
-                                                 for address in addresses] +
-                                                [api.fetch_transactions(address)
-                                                 for address in addresses if refresh],
-                                                n=parameters['run_parameters']['async']['gather_limit']))
+            # only refresh what the credit budget allows, most valuable and stalest first
+            plan = RefreshScheduler(plex_db, parameters).plan(addresses)
+            logging.info(f'refresh plan:\n{plan.to_string()}')
+            refreshed = plan.loc[plan['refresh'], 'address'].tolist()
+            all_fetch = asyncio.run(api.gather([api.fetch_snapshot(address, refresh=True)
+                                                for address in refreshed] +
+                                               [api.fetch_transactions(address)
+                                                for address in refreshed]))
+            # running pnl totals, so that cumulative pnl over any range is two ledger lookups
+            price_ids = parameters['plex'].get('price_ids')
+            pnl_explainer = PnlExplainer(plex_db.query_categories(), secrets.get('alchemy_key'), plex_db=plex_db,
+                                         price_store=PriceStore(plex_db, CoinGeckoPriceBackend()) if price_ids else None,
+                                         price_ids=price_ids)
+            for address in refreshed:
+                try:
+                    pnl_explainer.update_ledger(plex_db, address)
+                except ValueError as e:
+                    # its head stays put, the next snapshot retries once the assets are categorized
+                    logging.error(f'pnl ledger of {address} not updated: {e}')
             plex_db.upload_to_s3()
+        elif sys.argv[1] == 'refresh_plan':
+            logging.info(f'refresh plan:\n{RefreshScheduler(plex_db, parameters).plan(addresses).to_string()}')
         elif sys.argv[1] == 'rebuild_db':
+            # resumes where an interrupted rebuild stopped
+            RebuildEngine(raw_data_db, plex_db, parameters).run(addresses)
+            plex_db.upload_to_s3()
+        elif sys.argv[1] == 'compact_raw_data':
+            # pack and compress all past raw files, including legacy ones
             for address in addresses:
-                api.rebuild_db_from_json(address)
-            plex_db.upload_to_s3()
\ No newline at end of file
+                for table_name in ['snapshots', 'transactions']:
+                    raw_data_db.compact(address, table_name, include_legacy=True)
\ No newline at end of file
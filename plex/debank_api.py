@@ -1,34 +1,96 @@
-import copy
-import json
+import asyncio
 import logging
+import time
 import typing
+import weakref
 from datetime import datetime, timezone, timedelta
 from typing import Dict, Any
 
 import pandas as pd
-import requests
 import aiohttp
 import streamlit as st
 
-from utils.async_utils import safe_gather
-from utils.db import RawDataDB, SQLiteDB
+from utils.async_utils import safe_gather, AdaptiveLimiter, observed, throttled
+from utils.db import RawDataDB, SQLiteDB, snapshot_schema
 
 
 class DebankAPI:
     endpoints = ["all_complex_protocol_list", "all_token_list", "all_nft_list"]
     api_url = "https://pro-openapi.debank.com/v1"
+    history_page_count = 20  # max page_count of all_history_list
+    # columns filled by the parse_<endpoint> methods, value being amount * price
+    position_columns = ['chain', 'protocol', 'hold_mode', 'type', 'asset', 'amount', 'price']
     def __init__(self, json_db: RawDataDB, plex_db: SQLiteDB, parameters: Dict[str, Any]):
         self.parameters = parameters
         self.json_db: RawDataDB = json_db
         self.plex_db: SQLiteDB = plex_db
+        # eg a local plex.debank_server stand-in
+        self.api_url = parameters.get('profile', {}).get('api_url', DebankAPI.api_url)
+        # aiohttp sessions are bound to the event loop they were created in
+        self._sessions: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession] = weakref.WeakKeyDictionary()
+        async_parameters = parameters.get('run_parameters', {}).get('async', {})
+        # beyond the connector's limit, calls would queue unseen in aiohttp and read as latency
+        self.limiter = AdaptiveLimiter(initial=async_parameters.get('gather_limit', 10),
+                                       max_window=min(async_parameters.get('max_window', 100),
+                                                      parameters.get('run_parameters', {}).get('http', {}).get('limit_per_host', 20)))
+
+    def _session(self) -> aiohttp.ClientSession:
+        '''
+        the pooled client of the running event loop, shared by all endpoint calls made in it.
+        connections are kept alive between calls and DNS lookups cached, within the limits of run_parameters.http.
+        '''
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            http = self.parameters.get('run_parameters', {}).get('http', {})
+            connector = aiohttp.TCPConnector(limit=http.get('limit', 100),
+                                             limit_per_host=http.get('limit_per_host', 20),
+                                             ttl_dns_cache=http.get('ttl_dns_cache', 300),
+                                             keepalive_timeout=http.get('keepalive_timeout', 60))
+            session = aiohttp.ClientSession(connector=connector,
+                                            timeout=aiohttp.ClientTimeout(total=http.get('timeout', 60)),
+                                            headers={"accept": "application/json",
+                                                     "AccessKey": self.parameters['profile']['debank_key']})
+            self._sessions[loop] = session
+        return session
+
+    async def _get(self, endpoint: str, params: dict = None) -> typing.Any:
+        '''retries 429s after Retry-After or an exponential backoff, telling the limiter to shrink its window'''
+        retries = self.parameters.get('run_parameters', {}).get('http', {}).get('retries', 5)
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            async with self._session().get(url=f'{self.api_url}/{endpoint}', params=params) as response:
+                if response.status != 429 or attempt == retries:
+                    response.raise_for_status()
+                    result = await response.json()
+                    observed(time.perf_counter() - start)
+                    return result
+                delay = float(response.headers.get('Retry-After', 2 ** attempt))
+            throttled()
+            await asyncio.sleep(delay)
+
+    async def close(self) -> None:
+        '''closes the client of the running event loop'''
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def gather(self, tasks: list) -> list:
+        '''
+        safe_gather of endpoint calls sharing one client, closed once they are all done.
+        they also share self.limiter, whose window carries over from one gather to the next.
+        '''
+        try:
+            return await safe_gather(tasks, n=self.limiter.window, limiter=self.limiter)
+        finally:
+            await self.close()
+
+    async def fetch_credits(self) -> float:
+        return (await self._get('account/units'))['balance']
 
     def get_credits(self) -> float:
-        response = requests.get(f'{self.api_url}/account/units',
-                                headers={
-                                    "accept": "application/json",
-                                    "AccessKey": self.parameters['profile']['debank_key'],
-                                })
-        return response.json()['balance']
+        return asyncio.run(self.gather([self.fetch_credits()]))[0]
+
     async def _fetch_snapshot(self, address: str, write_to_json=True) -> dict:
         '''
         Fetches the position snapshot for a given address from the Debank API
@@ -36,24 +98,15 @@ class DebankAPI:
         Parses the result into a pandas DataFrame and returns it
         '''
 
-        async def call_position_endpoint(endpoint: str) -> typing.Any:
-            async with session.get(url=f'{self.api_url}/{endpoint}',
-                                   headers={
-                                       "accept": "application/json",
-                                       "AccessKey": self.parameters['profile']['debank_key'],
-                                   },
-                                   params={"id": address}) as response:
-                return await response.json()
-
         now_time = datetime.now(tz=timezone.utc).timestamp()
-        async with aiohttp.ClientSession() as session:
-            json_results = await safe_gather([call_position_endpoint(f'user/{endpoint}')
-                                       for endpoint in self.endpoints],
-                                             n=self.parameters['run_parameters']['async']['gather_limit'])
+        json_results = await safe_gather([self._get(f'user/{endpoint}', params={"id": address})
+                                          for endpoint in self.endpoints],
+                                         n=self.limiter.window)
 
         dict_result = {'timestamp': now_time, 'address': address} | dict(zip(self.endpoints, json_results))
         if write_to_json:
-            self.json_db.insert_table(dict_result, address, "snapshots")
+            # off the event loop, the other addresses' calls keep going
+            await asyncio.to_thread(self.json_db.insert_table, dict_result, address, "snapshots")
 
         return dict_result
 
@@ -75,6 +128,7 @@ class DebankAPI:
                 snapshot_dict = await self._fetch_snapshot(address, write_to_json=True)
                 snapshot = self.parse_snapshot(snapshot_dict)
                 self.plex_db.insert_table(snapshot, "snapshots")
+                snapshot = snapshot_schema.encode(snapshot)
             else:
                 st.warning(
                     f"We only update once every {self.parameters['plex']['update_frequency']} minutes. {address} not refreshed")
@@ -83,53 +137,79 @@ class DebankAPI:
     def parse_snapshot(self, dict_input: dict) -> pd.DataFrame:
         if not dict_input:
             return pd.DataFrame()
-        dict_result = copy.deepcopy(dict_input)
-        timestamp = int(dict_result.pop('timestamp'))
-        address = dict_result.pop('address')
-        res_list = sum(
-            (
-                getattr(self, f'parse_{endpoint}')(res)
-                for endpoint, res in dict_result.items()
-            ),
-            [],
-        )
-        df_result = pd.DataFrame(res_list)
-        df_result['timestamp'] = timestamp
-        df_result['address'] = address
+        return self.parse_snapshots([dict_input])
+
+    def parse_snapshots(self, dict_inputs: typing.Iterable[dict]) -> pd.DataFrame:
+        '''
+        parses raw snapshots into one frame, appending positions straight into column lists: the raw dicts are only read.
+        '''
+        columns = {column: [] for column in self.position_columns}
+        timestamps = []
+        addresses = []
+        for dict_input in dict_inputs:
+            n_rows = len(columns['chain'])
+            for endpoint, res in dict_input.items():
+                if endpoint not in ('timestamp', 'address'):
+                    getattr(self, f'parse_{endpoint}')(res, columns)
+            n_rows = len(columns['chain']) - n_rows
+            timestamps += [int(dict_input['timestamp'])] * n_rows
+            addresses += [dict_input['address']] * n_rows
+
+        df_result = pd.DataFrame(columns | {'timestamp': timestamps, 'address': addresses})
+        df_result['value'] = df_result['amount'] * df_result['price']
         df_result = df_result[~df_result['protocol'].isin(self.parameters['plex']['redundant_protocols'])]
-        return df_result
+        return df_result[self.position_columns + ['value', 'timestamp', 'address']]
 
-    async def _fetch_transactions(self, address: str, start_timestamp: int, end_timestamp: int, write_to_json=False) -> list:
+    async def _history_pages(self, address: str, start_timestamp: int, end_timestamp: int) -> typing.AsyncIterator[dict]:
         '''
-        returns {tx_hash: {timestamp instead of taime_atm, the rest}}
+        pages of all_history_list, from end_timestamp back to start_timestamp.
+        the next page is requested before the current one is yielded, so processing a page overlaps with fetching the next.
         '''
+        def get_page(cur_timestamp: int) -> typing.Coroutine:
+            return self._get('user/all_history_list',
+                             params={"id": address, "start_time": int(cur_timestamp), "page_count": self.history_page_count})
+
         cur_timestamp = end_timestamp
-        data = {'cate_dict': {}, 'cex_dict': {}, 'history_list': [], 'project_dict': {}, 'token_dict': {}}
-        while cur_timestamp >= start_timestamp:
+        next_page = asyncio.create_task(get_page(cur_timestamp)) if cur_timestamp >= start_timestamp else None
+        while next_page is not None:
             try:
-                response = requests.get(f'{self.api_url}/user/all_history_list',
-                                   headers={
-                                       "accept": "application/json",
-                                       "AccessKey": self.parameters['profile']['debank_key'],
-                                   },
-                                   params={"id": address, "start_time": int(cur_timestamp), "page_count": 20})
-                temp = response.json()
-                cur_timestamp = min(cur_timestamp, min(x['time_at'] for x in temp['history_list']) -1)
-                for key, value in temp.items():
-                    if isinstance(value, dict):
-                        data[key] |= value
-                    elif isinstance(value, list):
-                        data[key] += value
-                    else:
-                        raise ValueError(f'Unexpected type {type(value)}')
+                page = await next_page
+                history_list = page['history_list']
             except Exception as e:
-                print(f'Error: {e}')
-                break
+                logging.error(f'all_history_list {address} {cur_timestamp} -> Error: {e}')
+                return
+            next_page = None
+            # a short page is the last one
+            if len(history_list) == self.history_page_count:
+                cur_timestamp = min(cur_timestamp, min(x['time_at'] for x in history_list) - 1)
+                if cur_timestamp >= start_timestamp:
+                    next_page = asyncio.create_task(get_page(cur_timestamp))
+            yield page
+
+    async def _fetch_transactions(self, address: str, start_timestamp: int, end_timestamp: int,
+                                  write_to_json=False) -> tuple[dict, pd.DataFrame]:
+        '''
+        pages through all_history_list, parsing each page in a thread while the next one downloads.
+        returns the merged raw tx_list, as stored in json_db, and the parsed transactions.
+        '''
+        data = {'cate_dict': {}, 'cex_dict': {}, 'history_list': [], 'project_dict': {}, 'token_dict': {}}
+        parsed = []
+        async for page in self._history_pages(address, start_timestamp, end_timestamp):
+            for key, value in page.items():
+                if isinstance(value, dict):
+                    data[key] = data.get(key, {}) | value
+                elif isinstance(value, list):
+                    data[key] = data.get(key, []) + value
+                else:
+                    raise ValueError(f'Unexpected type {type(value)}')
+            parsed.append(await asyncio.to_thread(self.parse_all_history_list, page))
+
         data = {'start_timestamp': end_timestamp, 'end_timestamp': end_timestamp, 'tx_list': data}
         if write_to_json:
-            self.json_db.insert_table(data, address, "transactions")
+            await asyncio.to_thread(self.json_db.insert_table, data, address, "transactions")
 
-        return data['tx_list']
+        parsed = [df for df in parsed if not df.empty]
+        return data['tx_list'], pd.concat(parsed, ignore_index=True) if parsed else pd.DataFrame()
 
     async def fetch_transactions(self, address: str) -> pd.DataFrame:
         '''
@@ -140,11 +220,10 @@ class DebankAPI:
         '''
         updated_at = self.plex_db.last_updated(address, "transactions")
 
-        transactions_list = await self._fetch_transactions(address,
-                                                           start_timestamp=int(updated_at.timestamp()),
-                                                           end_timestamp=int(datetime.now().timestamp()),
-                                                           write_to_json=True)
-        transactions = self.parse_all_history_list(transactions_list)
+        _, transactions = await self._fetch_transactions(address,
+                                                         start_timestamp=int(updated_at.timestamp()),
+                                                         end_timestamp=int(datetime.now().timestamp()),
+                                                         write_to_json=True)
         if not transactions.empty:
             transactions['address'] = address
             transactions = transactions[~transactions['id'].duplicated()]
@@ -152,128 +231,88 @@ class DebankAPI:
         return transactions
 
     @staticmethod
-    def parse_all_complex_protocol_list(snapshot: list) -> list:
-        result = []
-        for protocol in snapshot:
-            for portfolio_item in protocol['portfolio_item_list']:
+    def parse_all_complex_protocol_list(snapshot: list, columns: dict[str, list]) -> None:
+        chain, protocol, hold_mode, bucket, asset, amount, price = (columns[column].append for column in DebankAPI.position_columns)
+        for cur_protocol in snapshot:
+            for portfolio_item in cur_protocol['portfolio_item_list']:
                 for bucket_type, positions in portfolio_item['detail'].items():
                     if isinstance(positions, list):
-                        result.extend(
-                            {
-                                'chain': protocol['chain'],
-                                'protocol': protocol['name'],
-                                # 'description': portfolio_item['detail']['description'],
-                                'hold_mode': portfolio_item['name'],
-                                'type': bucket_type,
-                                'asset': position['symbol'],
-                                'amount': (-1 if 'borrow' in bucket_type else 1)
-                                * position['amount'],
-                                'price': position['price'],
-                                'value': (-1 if 'borrow' in bucket_type else 1)
-                                * position['amount']
-                                * position['price'],
-                            }
-                            for position in positions
-                        )
-        return result
+                        sign = -1 if 'borrow' in bucket_type else 1
+                        for position in positions:
+                            chain(cur_protocol['chain'])
+                            protocol(cur_protocol['name'])
+                            hold_mode(portfolio_item['name'])
+                            bucket(bucket_type)
+                            asset(position['symbol'])
+                            amount(sign * position['amount'])
+                            price(position['price'])
 
     @staticmethod
-    def parse_all_token_list(snapshot: list) -> list:
-        return [
-            {
-                'chain': position['chain'],
-                'protocol': 'wallet',
-                # 'description': portfolio_item['detail']['description'],
-                'hold_mode': 'cash',
-                'type': 'cash',
-                'asset': position['symbol'],
-                'amount': position['amount'],
-                'price': position['price'],
-                'value': position['amount'] * position['price'],
-            }
-            for position in snapshot
-            if position['is_verified'] and position['is_core'] and (position['price'] > 0)
-        ]
+    def parse_all_token_list(snapshot: list, columns: dict[str, list]) -> None:
+        chain, protocol, hold_mode, bucket, asset, amount, price = (columns[column].append for column in DebankAPI.position_columns)
+        for position in snapshot:
+            if position['is_verified'] and position['is_core'] and (position['price'] > 0):
+                chain(position['chain'])
+                protocol('wallet')
+                hold_mode('cash')
+                bucket('cash')
+                asset(position['symbol'])
+                amount(position['amount'])
+                price(position['price'])
 
     @staticmethod
-    def parse_all_nft_list(snapshot: list) -> list:
-        return [
-            {
-                'chain': position['chain'],
-                'protocol': position['name'],
-                #'description': portfolio_item['detail']['description'],
-                'hold_mode': 'cash',
-                'type': 'nft',
-                'asset': position['name'],
-                'amount': position['amount'],
-                'price': position['usd_price'] if 'usd_price' in position else 0.0,
-                'value': position['amount'] * position['usd_price'],
-            }
-            for position in snapshot
-            if ('usd_price' in position) and (position['usd_price'] > 0)
-        ]
+    def parse_all_nft_list(snapshot: list, columns: dict[str, list]) -> None:
+        chain, protocol, hold_mode, bucket, asset, amount, price = (columns[column].append for column in DebankAPI.position_columns)
+        for position in snapshot:
+            if ('usd_price' in position) and (position['usd_price'] > 0):
+                chain(position['chain'])
+                protocol(position['name'])
+                hold_mode('cash')
+                bucket('nft')
+                asset(position['name'])
+                amount(position['amount'])
+                price(position['usd_price'])
 
     @staticmethod
-    def parse_all_history_list(transactions: list) -> pd.DataFrame:
-        result = []
+    def parse_all_history_list(transactions: dict) -> pd.DataFrame:
+        '''
+        flattens the receives then sends legs of non-scam transactions into columns, then joins transaction fields,
+        project names and token prices onto the legs as frames. pnl is the leg's value less the transaction's gas.
+        '''
+        # one row per leg, receives then sends of each transaction, pointing at the row of its transaction
+        leg_tx, assets, amounts, counterparties = [], [], [], []
+        tx_rows = []
         for tx in transactions['history_list']:
-            if not tx['is_scam']:
-                def append_leg(leg, side):
-                    result = {'id': tx['id'],
-                              'timestamp': tx['time_at'],
-                              'chain': tx['chain'],
-                              'protocol': transactions['project_dict'][tx['project_id']]['name'] if tx[
-                                  'project_id'] else
-                              leg['to_addr' if side == -1 else 'from_addr'],
-                              'gas': tx['tx']['usd_gas_fee'] if 'usd_gas_fee' in tx['tx'] else 0.0,
-                              'type': tx['tx']['name'],
-                              'asset': leg['token_id'],
-                              'amount': leg['amount'] * side}
-                    if leg['token_id'] in transactions['token_dict']:
-                        if ('price' in transactions['token_dict'][leg['token_id']]) and transactions['token_dict'][leg['token_id']]['price']:
-                            result['price'] = transactions['token_dict'][leg['token_id']]['price']
-                            result['pnl'] = leg['amount'] * result['price'] * side
-                    return result
-
-
-                if 'receives' in tx:
-                    for cur_leg in tx['receives']:
-                        result.append(append_leg(cur_leg, 1))
-                if 'sends' in tx:
-                    for cur_leg in tx['sends']:
-                        result.append(append_leg(cur_leg, -1))
+            if not tx['is_scam'] and (tx.get('receives') or tx.get('sends')):
+                row = len(tx_rows)
+                for leg in tx.get('receives', ()):
+                    leg_tx.append(row)
+                    assets.append(leg['token_id'])
+                    amounts.append(leg['amount'])
+                    counterparties.append(leg['from_addr'])
+                for leg in tx.get('sends', ()):
+                    leg_tx.append(row)
+                    assets.append(leg['token_id'])
+                    amounts.append(-leg['amount'])
+                    counterparties.append(leg['to_addr'])
+                tx_rows.append((tx['id'], tx['time_at'], tx['chain'], tx['project_id'],
+                                tx['tx']['usd_gas_fee'] if 'usd_gas_fee' in tx['tx'] else 0.0, tx['tx']['name']))
+        if not tx_rows:
+            return pd.DataFrame()
 
-        df = pd.DataFrame(result)
-        if not df.empty:
-            df['pnl'] = df['pnl'] - df['gas']
-        return df
+        txs = pd.DataFrame(tx_rows, columns=['id', 'timestamp', 'chain', 'project_id', 'gas', 'type'])
+        projects = pd.Series({project_id: project['name'] for project_id, project in transactions['project_dict'].items()},
+                             dtype=object)
+        prices = {token_id: token['price'] for token_id, token in transactions['token_dict'].items()
+                  if ('price' in token) and token['price']}
+        prices = pd.Series(prices) if prices else pd.Series(dtype=float)
 
-    def rebuild_db_from_json(self, address: str, delete_unreadable=False):
-        all_snapshots_filenames = self.json_db.all_timestamps(address, "snapshots")
-        for filename in all_snapshots_filenames:
-            response = self.json_db.connection.get_object(Bucket=self.json_db.bucket_name, Key=filename)
-            snapshot_dict = json.loads(response['Body'].read().decode('utf-8'))
-            try:
-                snapshot = self.parse_snapshot(snapshot_dict)
-                self.plex_db.insert_table(snapshot, "snapshots")
-                logging.info(f"inserted to db from# {filename}")
-            except Exception as e:
-                logging.error(f"{filename} -> Error: {e}", stack_info=True)
-                if delete_unreadable:
-                    self.json_db.connection.delete_object(Bucket=self.json_db.bucket_name, Key=filename)
-
-        all_transactions_filenames = self.json_db.all_timestamps(address, "transactions")
-        for filename in all_transactions_filenames:
-            response = self.json_db.connection.get_object(Bucket=self.json_db.bucket_name, Key=filename)
-            transactions_dict = json.loads(response['Body'].read().decode('utf-8'))
-            try:
-                transactions = self.parse_all_history_list(transactions_dict['tx_list'])
-                if not transactions.empty:
-                    transactions['address'] = address
-                    transactions = transactions[~transactions['id'].duplicated()]
-                    self.plex_db.insert_table(transactions, "transactions")
-                    logging.info(f"inserted to db from# {filename}")
-            except Exception as e:
-                logging.error(f"{filename} Error: {e}", stack_info=True)
-                if delete_unreadable:
-                    self.json_db.connection.delete_object(Bucket=self.json_db.bucket_name, Key=filename)
\ No newline at end of file
+        df = txs.iloc[leg_tx].reset_index(drop=True)
+        # the project if any, else the counterparty of the leg
+        df['protocol'] = df['project_id'].map(projects).where(df['project_id'].map(bool),
+                                                              pd.Series(counterparties, dtype=object))
+        df['asset'] = assets
+        df['amount'] = amounts
+        df['price'] = df['asset'].map(prices)
+        df['pnl'] = df['amount'] * df['price'] - df['gas']
+        return df[['id', 'timestamp', 'chain', 'protocol', 'gas', 'type', 'asset', 'amount', 'price', 'pnl']]
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import sys
+import threading
+from collections import Counter
+
+import numpy as np
+from aiohttp import web
+
+from utils.db import RawDataDB
+
+
+def synthetic_raw_snapshot(address: str, timestamp: float, n_protocols: int = 20, n_tokens: int = 50, n_nfts: int = 5,
+                           seed: int = 0) -> dict:
+    '''a raw snapshot shaped like DebankAPI._fetch_snapshot's output'''
+    rng = np.random.default_rng(seed)
+
+    def token(symbol: str) -> dict:
+        return {'symbol': symbol, 'amount': float(rng.lognormal()), 'price': float(rng.lognormal())}
+
+    return {'timestamp': timestamp,
+            'address': address,
+            'all_complex_protocol_list': [
+                {'chain': ['eth', 'arb', 'op', 'base'][i % 4],
+                 'name': f'protocol_{i}',
+                 'portfolio_item_list': [{'name': hold_mode,
+                                          'detail': {'supply_token_list': [token(f'asset_{(i + j) % 40}') for j in range(3)],
+                                                     'borrow_token_list': [token(f'asset_{(i + j + 3) % 40}') for j in range(2)],
+                                                     'description': f'{hold_mode} on protocol_{i}'}}
+                                         for hold_mode in ['Lending', 'Yield', 'Staked']]}
+                for i in range(n_protocols)],
+            'all_token_list': [{'chain': ['eth', 'arb', 'op', 'base'][i % 4], 'symbol': f'asset_{i % 40}',
+                                'is_verified': True, 'is_core': i % 5 != 0} | token(f'asset_{i % 40}')
+                               for i in range(n_tokens)],
+            'all_nft_list': [{'chain': 'eth', 'name': f'nft_{i}', 'amount': 1, 'usd_price': float(rng.lognormal())}
+                             for i in range(n_nfts)]}
+
+
+def synthetic_history(n_legs: int, n_tokens: int = 500, n_projects: int = 50, seed: int = 0) -> dict:
+    '''a raw tx_list of about n_legs legs, shaped like DebankAPI._fetch_transactions' output'''
+    rng = np.random.default_rng(seed)
+    history_list = []
+    n = 0
+    while n < n_legs:
+        i = len(history_list)
+        legs = {side: [{'token_id': f'token_{rng.integers(n_tokens)}', 'amount': float(rng.lognormal()),
+                        'from_addr': f'0x{rng.integers(1000):040x}', 'to_addr': f'0x{rng.integers(1000):040x}'}
+                       for _ in range(rng.integers(3))]
+                for side in ['sends', 'receives']}
+        history_list.append({'id': f'0x{i:064x}', 'time_at': 1700000000.0 - 60 * i, 'chain': ['eth', 'arb', 'op'][i % 3],
+                             'project_id': f'project_{i % n_projects}' if i % 4 else None,
+                             'is_scam': i % 50 == 0,
+                             'tx': {'name': ['swap', 'deposit', 'withdraw'][i % 3]}
+                                   | ({'usd_gas_fee': float(rng.lognormal(-2))} if i % 10 else {})}
+                            | {side: side_legs for side, side_legs in legs.items() if side_legs or i % 2})
+        n += sum(len(side_legs) for side_legs in legs.values())
+    return {'cate_dict': {}, 'cex_dict': {},
+            'history_list': history_list,
+            'project_dict': {f'project_{j}': {'name': f'protocol_{j}'} for j in range(n_projects)},
+            # some tokens without a price, or a null one
+            'token_dict': {f'token_{j}': {'price': float(rng.lognormal()) if j % 7 else None} if j % 11 else {}
+                           for j in range(n_tokens)}}
+
+
+class DebankStandIn:
+    '''
+    Local aiohttp stand-in for the Debank pro API, to run DebankAPI without spending credits:
+        GET /v1/user/all_complex_protocol_list | all_token_list | all_nft_list ?id=
+        GET /v1/user/all_history_list ?id= &start_time= &page_count=
+        GET /v1/account/units
+    responses are replayed from json_db's latest raw files of the address if any, else synthetic, seeded by the address.
+    each call waits a lognormal latency of median latency seconds, and gets a 429 when more than max_concurrency
+    calls are in flight, or with probability rate_429. served calls are charged endpoint_costs against balance.
+    '''
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, max_concurrency: int = None, rate_429: float = 0.0,
+                 retry_after: float = 0.1, json_db: RawDataDB = None, n_protocols: int = 20, n_tokens: int = 50,
+                 n_legs: int = 200, endpoint_costs: dict[str, float] = None, balance: float = 1e6, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.json_db = json_db
+        self.n_protocols = n_protocols
+        self.n_tokens = n_tokens
+        self.n_legs = n_legs
+        self.endpoint_costs = endpoint_costs or {}
+        self.balance = balance
+        self.rng = np.random.default_rng(seed)
+        self.calls: Counter = Counter()
+        self.throttled = 0
+        self.in_flight = 0
+        self._snapshots: dict[str, dict] = {}
+        self._histories: dict[str, dict] = {}
+        self._runner: web.AppRunner = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._thread: threading.Thread = None
+
+    @staticmethod
+    def _seed(address: str) -> int:
+        return int(hashlib.sha256(address.encode('utf-8')).hexdigest()[:8], 16)
+
+    def snapshot(self, address: str) -> dict:
+        if address not in self._snapshots:
+            timestamps = self.json_db.all_timestamps(address, 'snapshots') if self.json_db is not None else []
+            if timestamps:
+                self._snapshots[address] = self.json_db.query_table(address, timestamps[-1], 'snapshots')
+            else:
+                self._snapshots[address] = synthetic_raw_snapshot(address, 0, n_protocols=self.n_protocols,
+                                                                  n_tokens=self.n_tokens, seed=self._seed(address))
+        return self._snapshots[address]
+
+    def history(self, address: str) -> dict:
+        '''tx_list of address, history_list sorted by decreasing time_at'''
+        if address not in self._histories:
+            timestamps = self.json_db.all_timestamps(address, 'transactions') if self.json_db is not None else []
+            if timestamps:
+                history = {'history_list': [], 'project_dict': {}, 'token_dict': {}, 'cate_dict': {}, 'cex_dict': {}}
+                for timestamp in timestamps:
+                    tx_list = self.json_db.query_table(address, timestamp, 'transactions')['tx_list']
+                    history['history_list'] += tx_list['history_list']
+                    for key in ['project_dict', 'token_dict', 'cate_dict', 'cex_dict']:
+                        history[key] |= tx_list.get(key, {})
+                history['history_list'] = list({tx['id']: tx for tx in history['history_list']}.values())
+            else:
+                history = synthetic_history(self.n_legs, seed=self._seed(address))
+            history['history_list'].sort(key=lambda tx: -tx['time_at'])
+            self._histories[address] = history
+        return self._histories[address]
+
+    def history_page(self, address: str, start_time: float, page_count: int) -> dict:
+        '''the page_count latest transactions at or before start_time, with the dicts they refer to'''
+        history = self.history(address)
+        times = [-tx['time_at'] for tx in history['history_list']]
+        i = int(np.searchsorted(times, -start_time, side='left'))
+        page = history['history_list'][i:i + page_count]
+        tokens = {leg['token_id'] for tx in page for leg in tx.get('sends', []) + tx.get('receives', [])}
+        projects = {tx['project_id'] for tx in page}
+        return {'history_list': page,
+                'project_dict': {key: value for key, value in history['project_dict'].items() if key in projects},
+                'token_dict': {key: value for key, value in history['token_dict'].items() if key in tokens},
+                'cate_dict': history['cate_dict'], 'cex_dict': history['cex_dict']}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        endpoint = request.match_info['endpoint']
+        if (self.max_concurrency is not None and self.in_flight >= self.max_concurrency) \
+                or self.rng.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({'error': 'too many requests'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency * self.rng.lognormal(sigma=self.jitter) if self.jitter else self.latency)
+            if endpoint == 'account/units':
+                return web.json_response({'balance': self.balance})
+            address = request.query['id']
+            if endpoint == 'user/all_history_list':
+                result = self.history_page(address, float(request.query['start_time']),
+                                           int(request.query.get('page_count', 20)))
+            elif endpoint.startswith('user/') and endpoint[5:] in self.snapshot(address):
+                result = self.snapshot(address)[endpoint[5:]]
+            else:
+                raise web.HTTPNotFound()
+            self.calls[endpoint] += 1
+            self.balance -= self.endpoint_costs.get(endpoint[5:], 1)
+            return web.json_response(result)
+        finally:
+            self.in_flight -= 1
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/v1/{endpoint:.+}', self.handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080) -> str:
+        '''serves in the running event loop, returns the api_url to give DebankAPI'''
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f'http://{host}:{port}/v1'
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    def start_in_thread(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        '''serves from an event loop of its own in a daemon thread, so that clients don't share it. port 0 picks a free one'''
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start(host, port), self._loop).result()
+
+    def stop_thread(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    # python -m plex.debank_server [port] [latency] [max_concurrency]
+    # then point profile.api_url of params.yaml to http://127.0.0.1:<port>/v1
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    max_concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    web.run_app(DebankStandIn(latency=latency, max_concurrency=max_concurrency).app(), host='127.0.0.1', port=port)
@@ -1,19 +1,29 @@
-import copy
+import bisect
 import os
 from datetime import datetime, timezone
 from typing import Any
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 import yaml
 from pandas import DataFrame
 from utils.coingecko import ScannerAPI
+from utils.db import SQLiteDB, pnl_ledger_keys, snapshot_schema
+from utils.prices import PriceStore
 
 
 class PnlExplainer:
-    def __init__(self, categories: dict[str, str], alchemy_key: str = None):
+    def __init__(self, categories: dict[str, str], alchemy_key: str = None, plex_db: SQLiteDB = None,
+                 price_store: PriceStore = None, price_ids: dict[str, str] = None):
+        '''
+        with a price_store, underlyings that have a coin id in price_ids but that no position of the snapshot holds
+        are priced from it at the snapshot times.
+        '''
         self.categories = categories
-        self.etherscan_api = ScannerAPI(alchemy_key)
+        self.etherscan_api = ScannerAPI(alchemy_key, plex_db)
+        self.price_store = price_store
+        self.price_ids = {key.lower(): value for key, value in (price_ids or {}).items()}
 
     def underlying(self, asset: str) -> str:
         categories = {key.lower(): value for key, value in self.categories.items()}
@@ -23,53 +33,196 @@ class PnlExplainer:
         if missing_category := set(data['asset']) - set(self.categories.keys()):
             st.error(f"Categories need to be updated. Please categorize the following assets: {missing_category}")
             st.stop()
+            # only reached outside streamlit, eg from cli.py
+            raise ValueError(f"Please categorize the following assets: {missing_category}")
+
+    @staticmethod
+    def _position_keys(snapshots: pd.DataFrame) -> list[str]:
+        return [col for col in snapshots.columns if col not in ['price', 'amount', 'value', 'timestamp']]
 
     def explain(self, start_snapshot: pd.DataFrame, end_snapshot: pd.DataFrame) -> DataFrame:
-        snapshot_start = start_snapshot.set_index([col for col in start_snapshot.columns if col not in ['price', 'amount', 'value', 'timestamp']])
-        snapshot_end = end_snapshot.set_index([col for col in end_snapshot.columns if col not in ['price', 'amount', 'value', 'timestamp']])
-        data = snapshot_start.join(snapshot_end, how='outer', lsuffix='_start', rsuffix='_end')
-        common_pos = data[data.index.isin(set(snapshot_start.index) & set(snapshot_end.index))].reset_index()
-        before_pos = data[data.index.isin(set(snapshot_start.index) - set(snapshot_end.index))].reset_index()
-        after_pos = data[data.index.isin(set(snapshot_end.index) - set(snapshot_start.index))].reset_index()
-
-        self.validate_categories(common_pos)
-
-        common_pos['underlying'] = common_pos['asset'].apply(self.underlying)
-        before_pos['underlying'] = before_pos['asset'].apply(self.underlying)
-        after_pos['underlying'] = after_pos['asset'].apply(self.underlying)
-        # TODO: messy since we need position on same chain, USD and EUR don't work...need coingecko snap.
-        common_pos[['P_underlying_start', 'P_underlying_end']] = common_pos.apply(lambda x: common_pos.loc[common_pos['asset'] == x['underlying'], ['price_start', 'price_end']].mean(), axis=1)
-        # data['dP_basis'] = data['dP'] / data['dP_underlying']
-        common_pos = common_pos.fillna(0)
+        '''
+        pnl of each position between two snapshots, in buckets delta, basis and amt_chng.
+        positions are matched with one outer merge, whose indicator splits common, closed and opened positions.
+        '''
+        keys = self._position_keys(start_snapshot)
+        # both sides on the current categoricals, so that the merge runs on their codes
+        start_snapshot = snapshot_schema.encode(start_snapshot[keys + [col for col in start_snapshot.columns if col not in keys]])
+        end_snapshot = snapshot_schema.encode(end_snapshot.copy(deep=False))
+        data = start_snapshot.merge(end_snapshot, how='outer', on=keys, suffixes=('_start', '_end'), indicator=True)
+        merge = data.pop('_merge')
+        common = (merge == 'both').to_numpy()
+
+        result, _ = self._explain_merged(data, merge, np.zeros(len(data), dtype=np.int64))
+        result['timestamp_end'] = datetime.fromtimestamp(max(data.loc[common, 'timestamp_end']), tz=timezone.utc)
+        result['timestamp_start'] = datetime.fromtimestamp(min(data.loc[common, 'timestamp_start']), tz=timezone.utc)
 
-        # delta is underlying-equivalent amount * dP
-        delta_pnl = copy.deepcopy(common_pos)
-        delta_pnl['pnl_bucket'] = 'delta'
-        delta_pnl['pnl'] = (common_pos['P_underlying_end'] - common_pos['P_underlying_start']) * common_pos['amount_start'] * common_pos['price_start'] / common_pos['P_underlying_start']
+        return result
 
-        # basis is the rest
-        basis_pnl = copy.deepcopy(common_pos)
-        basis_pnl['pnl_bucket'] = 'basis'
-        basis_pnl['pnl'] = common_pos['amount_start']*(common_pos['price_end'] - common_pos['price_start']) - delta_pnl['pnl']
+    def explain_periods(self, snapshots: pd.DataFrame, pairs: list[tuple[int, int]] = None) -> DataFrame:
+        '''
+        explain of every consecutive pair of snapshot timestamps (or only of pairs), in one pass: each row is the start
+        of its own period and the end of the previous one, and both sides are matched with one merge on position and
+        period. same rows as concatenating explain of each pair, in pair order.
+        '''
+        snapshots = snapshot_schema.encode(snapshots.copy(deep=False))
+        timestamps = np.sort(snapshots['timestamp'].unique())
+        period = np.searchsorted(timestamps, snapshots['timestamp'].to_numpy())
+        keys = self._position_keys(snapshots)
+        values = [col for col in snapshots.columns if col not in keys]
+        wanted = np.arange(len(timestamps) - 1)
+        if pairs is not None:
+            pairs = set(pairs)
+            wanted = wanted[[(start, end) in pairs for start, end in zip(timestamps[:-1], timestamps[1:])]]
+
+        sides = snapshots[keys + values].assign(period=period)
+        start_side = sides[np.isin(period, wanted)]
+        end_side = sides.assign(period=period - 1)[np.isin(period - 1, wanted)]
+        data = start_side[keys + ['period'] + values].merge(end_side, how='outer', on=keys + ['period'],
+                                                            suffixes=('_start', '_end'), indicator=True)
+        merge = data.pop('_merge')
+        period = data.pop('period').to_numpy()
+
+        result, result_period = self._explain_merged(data, merge, period)
+        # same resolution as the datetimes explain sets
+        datetimes = pd.to_datetime(timestamps, unit='s', utc=True).as_unit('us')
+        result['timestamp_end'] = datetimes[result_period + 1]
+        result['timestamp_start'] = datetimes[result_period]
 
-        amt_chng_pnl = copy.deepcopy(common_pos)
-        amt_chng_pnl['pnl_bucket'] = 'amt_chng'
-        amt_chng_pnl['pnl'] = (common_pos['amount_end'] - common_pos['amount_start']) * common_pos['price_end']
+        return result
 
-        before_pos['pnl_bucket'] = 'amt_chng'
-        before_pos['pnl'] = - before_pos['amount_start'] * before_pos['price_start']
+    def _explain_merged(self, data: pd.DataFrame, merge: pd.Series, period: np.ndarray) -> tuple[DataFrame, np.ndarray]:
+        '''
+        buckets of start and end positions merged on position and period, ordered by period. returns them with the
+        period of each row. P_underlying is the mean price of the underlying's own positions within the period, looked
+        up with one groupby, else from the price_store.
+        '''
+        common = (merge == 'both').to_numpy()
 
-        after_pos['pnl_bucket'] = 'amt_chng'
-        after_pos['pnl'] = after_pos['amount_end'] * after_pos['price_end']
+        self.validate_categories(data.loc[common, ['asset']])
 
-        assert (common_pos['value_end'] - common_pos['value_start'] - delta_pnl['pnl'] - basis_pnl['pnl'] - amt_chng_pnl['pnl']).apply(abs).max() < 1, \
+        categories = {key.lower(): value for key, value in self.categories.items()}
+        data['underlying'] = data['asset'].map({asset: categories.get(asset.lower(), asset) for asset in data['asset'].unique()})
+        # TODO: messy since we need position on same chain, USD and EUR don't work...need coingecko snap.
+        underlying_prices = data.loc[common, ['asset', 'price_start', 'price_end']].groupby([period[common], 'asset'], observed=True).mean()
+        underlying_prices = underlying_prices.reindex(pd.MultiIndex.from_arrays([period, data['underlying']])).to_numpy()
+        data['P_underlying_start'] = np.where(common, underlying_prices[:, 0], np.nan)
+        data['P_underlying_end'] = np.where(common, underlying_prices[:, 1], np.nan)
+        if self.price_store is not None:
+            # only as a fallback: the store's points are hourly at best, so between two snapshots it would often have
+            # the same price at both ends and the underlying's own move would end up in basis
+            coin_ids = data['underlying'].str.lower().map(self.price_ids)
+            for side in ['start', 'end']:
+                priced = np.flatnonzero(common & coin_ids.notna().to_numpy() & np.isnan(data[f'P_underlying_{side}'].to_numpy()))
+                prices = self.price_store.prices_at(coin_ids.iloc[priced], data[f'timestamp_{side}'].iloc[priced])
+                found = ~np.isnan(prices)
+                data.iloc[priced[found], data.columns.get_loc(f'P_underlying_{side}')] = prices[found]
+        # common positions are zero-filled, closed and opened ones keep their NaNs
+        for col in data.columns:
+            if (missing := common & data[col].isna().to_numpy()).any():
+                if isinstance(data[col].dtype, pd.CategoricalDtype) and 0 not in data[col].cat.categories:
+                    data[col] = data[col].cat.add_categories([0])
+                data.loc[missing, col] = 0
+
+        # delta is underlying-equivalent amount * dP, basis is the rest
+        delta = (data['P_underlying_end'] - data['P_underlying_start']) * data['amount_start'] * data['price_start'] / data['P_underlying_start']
+        basis = data['amount_start'] * (data['price_end'] - data['price_start']) - delta
+        amt_chng = np.select([common, merge == 'left_only'],
+                             [(data['amount_end'] - data['amount_start']) * data['price_end'],
+                              - data['amount_start'] * data['price_start']],
+                             data['amount_end'] * data['price_end'])
+
+        assert (data['value_end'] - data['value_start'] - delta - basis - amt_chng)[common].abs().max() < 1, \
             "something doesn't add up..."
 
-        result = pd.concat([delta_pnl, basis_pnl, amt_chng_pnl, before_pos, after_pos], axis=0, ignore_index=True)
-        result['timestamp_end'] = datetime.fromtimestamp(max(common_pos['timestamp_end']), tz=timezone.utc)
-        result['timestamp_start'] = datetime.fromtimestamp(min(common_pos['timestamp_start']), tz=timezone.utc)
-
-        return result
+        # per period: one row per (common position, bucket), then closed and opened positions
+        common_rows = np.flatnonzero(common)
+        before_rows = np.flatnonzero(merge == 'left_only')
+        after_rows = np.flatnonzero(merge == 'right_only')
+        rows = np.concatenate([common_rows, common_rows, common_rows, before_rows, after_rows])
+        blocks = np.repeat(np.arange(5), [len(common_rows)] * 3 + [len(before_rows), len(after_rows)])
+        order = np.lexsort((rows, blocks, period[rows]))
+        result = data.take(rows[order])
+        result.index = pd.RangeIndex(len(result))
+        result['pnl_bucket'] = np.array(['delta', 'basis', 'amt_chng', 'amt_chng', 'amt_chng'])[blocks[order]]
+        result['pnl'] = np.concatenate([delta.to_numpy()[common_rows], basis.to_numpy()[common_rows],
+                                        amt_chng[rows[2 * len(common_rows):]]])[order]
+
+        return snapshot_schema.encode(result), period[rows[order]]
+
+    def explain_history(self, plex_db: SQLiteDB, addresses: list[str], snapshots: pd.DataFrame) -> DataFrame:
+        '''
+        explains of all consecutive pairs of snapshots. pairs already in plex_db's plex_results under the current
+        categories are read back, only the new ones are computed, in one explain_periods, and persisted.
+        '''
+        timestamps = sorted(snapshots['timestamp'].unique())
+        pairs = list(zip(timestamps[:-1], timestamps[1:]))
+        categories_version = plex_db.categories_version()
+        cached_pairs = plex_db.plex_results_pairs(addresses)
+
+        new_pairs = [pair for pair in pairs if pair not in cached_pairs]
+        new = self.explain_periods(snapshots, new_pairs) if new_pairs else pd.DataFrame()
+        by_end = dict(tuple(new.groupby('timestamp_end', sort=False, observed=True))) if not new.empty else {}
+        plex_db.insert_plex_results(addresses, [(start, end, by_end.get(pd.Timestamp(end, unit='s', tz='UTC'), pd.DataFrame()))
+                                                for start, end in new_pairs], categories_version)
+
+        cached = plex_db.query_plex_results(addresses, [pair for pair in pairs if pair in cached_pairs])
+        # cached may have grown snapshot_schema's categories past new's, which pd.concat would turn into object
+        return snapshot_schema.encode(pd.concat([explain for explain in [cached, new] if not explain.empty], axis=0, ignore_index=True))
+
+    def transactions_history(self, timestamps: list[int], transactions: pd.DataFrame) -> pd.DataFrame:
+        '''
+        format_transactions of each window between consecutive snapshot timestamps, from the transactions of the whole
+        range. each transaction is assigned to its window by a sorted search: (start, end], the first window being
+        closed on both ends, so that one on a snapshot timestamp isn't counted in two windows.
+        '''
+        timestamps = np.sort(np.unique(timestamps))
+        tx_timestamps = transactions['timestamp'].to_numpy()
+        within = (len(timestamps) > 1) & (tx_timestamps >= timestamps[0]) & (tx_timestamps <= timestamps[-1])
+        transactions = transactions[within]
+        window = np.maximum(np.searchsorted(timestamps, transactions['timestamp'].to_numpy(), side='left') - 1, 0)
+        return self.format_transactions(timestamps[window], timestamps[window + 1], transactions)
+
+    def ledger_entries(self, snapshots: pd.DataFrame, transactions: pd.DataFrame) -> pd.DataFrame:
+        '''
+        pnl per pnl_ledger_keys and window end timestamp, of the explains of consecutive snapshots and of the
+        transactions within each window. keys whose pnl is 0 are left out.
+        '''
+        explains = self.explain_periods(snapshots)
+        explains['timestamp'] = (explains['timestamp_end'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+        tx_pnl = self.transactions_history(snapshots['timestamp'].unique(), transactions)
+        tx_pnl['timestamp'] = tx_pnl['timestamp_end']
+        entries = pd.concat([frame[pnl_ledger_keys + ['timestamp', 'pnl']] for frame in [explains, tx_pnl] if not frame.empty]
+                            or [pd.DataFrame(columns=pnl_ledger_keys + ['timestamp', 'pnl'])], ignore_index=True)
+        entries[pnl_ledger_keys] = entries[pnl_ledger_keys].astype(object).fillna('')
+        entries = entries.groupby(pnl_ledger_keys + ['timestamp'], as_index=False, observed=True)['pnl'].sum()
+        return entries[entries['pnl'] != 0]
+
+    def update_ledger(self, plex_db: SQLiteDB, address: str, chunk_size: int = 1000) -> int:
+        '''
+        appends to plex_db's pnl ledger the windows of address' snapshots taken since its ledger head, a new ledger
+        being backfilled from address' first stored snapshot. windows are explained and appended chunk_size at a time,
+        so a long backfill holds one chunk in memory and resumes from the last appended chunk if interrupted.
+        raises ValueError on assets without a category, rather than ledgering them as their own underlying.
+        returns the number of windows appended.
+        '''
+        timestamps = plex_db.all_timestamps(address, 'snapshots')
+        head = plex_db.pnl_ledger_head(address)
+        if len(timestamps) < 2:
+            return 0
+        start = 0 if head is None else max(bisect.bisect_right(timestamps, head) - 1, 0)
+        head = timestamps[0] if head is None else head
+        appended = 0
+        while start < len(timestamps) - 1:
+            end = min(start + chunk_size, len(timestamps) - 1)
+            snapshots = plex_db.query_table_between([address], head, timestamps[end], 'snapshots')
+            transactions = plex_db.query_table_between([address], head, timestamps[end], 'transactions')
+            # transactions on the head belong to the previous window, already in the ledger
+            entries = self.ledger_entries(snapshots, transactions[transactions['timestamp'] > head])
+            plex_db.append_pnl_ledger(address, timestamps[end], entries)
+            appended += end - start
+            start, head = end, timestamps[end]
+        return appended
 
     def format_transactions(self, start_snapshot_timestamp: int, end_snapshot_timestamp: int, transactions: pd.DataFrame) -> pd.DataFrame:
         tx_pnl = transactions[~transactions['id'].duplicated()]
@@ -77,8 +230,9 @@ class PnlExplainer:
         tx_pnl['timestamp_start'] = start_snapshot_timestamp
         tx_pnl['timestamp_end'] = end_snapshot_timestamp
         tx_pnl['hold_mode'] = tx_pnl['type']
-        tx_pnl['asset'] = tx_pnl.apply(
-                lambda x: self.etherscan_api.get_token_symbol(x['asset'], x['chain']), axis=1)
+        tokens = list(zip(tx_pnl['asset'], tx_pnl['chain']))
+        symbols = self.etherscan_api.get_token_symbols(tokens)
+        tx_pnl['asset'] = [symbols[token] for token in tokens]
         tx_pnl['underlying'] = tx_pnl['asset'].apply(self.underlying)
 
         return tx_pnl
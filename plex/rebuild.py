@@ -0,0 +1,115 @@
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor
+from typing import Dict, Any
+
+import pandas as pd
+
+from plex.debank_api import DebankAPI
+from utils.db import RawDataDB, SQLiteDB, TableType, json_loads
+
+# parser of each worker process, set by _init_parser
+_parser: DebankAPI = None
+
+
+def _init_parser(parameters: Dict[str, Any]) -> None:
+    global _parser
+    _parser = DebankAPI(json_db=None, plex_db=None, parameters=parameters)
+
+
+def _parse_raw(data: bytes, address: str, table_name: TableType) -> pd.DataFrame:
+    dict_result = json_loads(data)
+    if table_name == 'snapshots':
+        return _parser.parse_snapshot(dict_result)
+    transactions = _parser.parse_all_history_list(dict_result['tx_list'])
+    if not transactions.empty:
+        transactions['address'] = address
+        transactions = transactions[~transactions['id'].duplicated()]
+    return transactions
+
+
+class RebuildEngine:
+    '''
+    Rebuilds plex_db from the raw files of json_db, through the RawDataDB interface only:
+    - raw files are downloaded by download_workers threads, and parsed in a pool of parse_workers processes,
+    - parsed frames are consumed in timestamp order and inserted by batches of batch_size files with bulk_insert,
+    - each batch records its last timestamp in rebuild_checkpoints, in the same transaction, so an interrupted rebuild
+    resumes after it. snapshots already in plex_db are skipped too.
+    - a file that fails to download or parse stops the rebuild of its address and table there, the checkpoint staying
+    before it, so that the next run retries it. with delete_unreadable, it is deleted and skipped instead.
+    '''
+    def __init__(self, json_db: RawDataDB, plex_db: SQLiteDB, parameters: Dict[str, Any],
+                 download_workers: int = 16, parse_workers: int = None, batch_size: int = 500):
+        self.json_db = json_db
+        self.plex_db = plex_db
+        self.parameters = parameters
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers or os.cpu_count()
+        self.batch_size = batch_size
+
+    def run(self, addresses: list[str], delete_unreadable: bool = False) -> dict:
+        '''returns throughput stats: files, rows, errors, seconds'''
+        stats = {'files': 0, 'rows': 0, 'errors': 0, 'seconds': 0.0}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.download_workers) as downloaders, \
+                ProcessPoolExecutor(self.parse_workers, initializer=_init_parser, initargs=(self.parameters,)) as parsers:
+            for table_name in ['snapshots', 'transactions']:
+                for address in addresses:
+                    self._rebuild(address, table_name, downloaders, parsers, stats, delete_unreadable)
+        stats['seconds'] = time.perf_counter() - start
+        logging.info(f"rebuilt {stats['files']} files, {stats['rows']} rows in {stats['seconds']:.1f}s: "
+                     f"{stats['files'] / max(stats['seconds'], 1e-9):,.0f} files/s, "
+                     f"{stats['rows'] / max(stats['seconds'], 1e-9):,.0f} rows/s, {stats['errors']} errors")
+        return stats
+
+    def _rebuild(self, address: str, table_name: TableType, downloaders: Executor, parsers: Executor,
+                 stats: dict, delete_unreadable: bool) -> None:
+        checkpoint = self.plex_db.rebuild_checkpoint(address, table_name)
+        done = set(self.plex_db.all_timestamps(address, table_name)) if table_name == 'snapshots' else set()
+        timestamps = [timestamp for timestamp in self.json_db.all_timestamps(address, table_name)
+                      if timestamp > checkpoint and timestamp not in done]
+        if not timestamps:
+            return
+
+        def download_and_parse(timestamp: int) -> pd.DataFrame:
+            data = self.json_db.query_table_bytes(address, timestamp, table_name)
+            return parsers.submit(_parse_raw, data, address, table_name).result()
+
+        # a bounded window of in-flight files, consumed in timestamp order so the checkpoint is a prefix
+        window = 2 * max(self.batch_size, self.download_workers)
+        pending = deque()
+        batch = []
+        previous = checkpoint
+        remaining = iter(timestamps)
+        batch_start = time.perf_counter()
+        while True:
+            while len(pending) < window and (timestamp := next(remaining, None)) is not None:
+                pending.append((timestamp, downloaders.submit(download_and_parse, timestamp)))
+            if not pending:
+                break
+            timestamp, future = pending.popleft()
+            try:
+                batch.append(future.result())
+            except Exception as e:
+                stats['errors'] += 1
+                logging.error(f"{table_name} {address} {timestamp} -> Error: {e}")
+                if not delete_unreadable:
+                    # a later checkpoint would skip it for good, eg on a transient download error
+                    for _, later in pending:
+                        later.cancel()
+                    if batch:
+                        stats['rows'] += self.plex_db.bulk_insert(batch, table_name, checkpoint=(address, previous))
+                    logging.warning(f"{table_name} {address}: stopped before {timestamp}, the next run resumes from it")
+                    return
+                self.json_db.delete_table(address, timestamp, table_name)
+            stats['files'] += 1
+            previous = timestamp
+            if len(batch) >= self.batch_size or not pending:
+                stats['rows'] += self.plex_db.bulk_insert(batch, table_name, checkpoint=(address, timestamp))
+                elapsed = time.perf_counter() - batch_start
+                logging.info(f"{table_name} {address}: inserted up to {timestamp}, "
+                             f"{len(batch) / max(elapsed, 1e-9):,.0f} files/s")
+                batch = []
+                batch_start = time.perf_counter()
@@ -0,0 +1,73 @@
+import bisect
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any
+
+import pandas as pd
+
+from plex.debank_api import DebankAPI
+from utils.db import SQLiteDB
+
+
+class RefreshScheduler:
+    '''
+    Decides which addresses to refresh from Debank within a credit budget.
+    - a refresh costs one call of each snapshot endpoint plus one all_history_list page, priced by endpoint_costs,
+    - credits already spent are estimated from the snapshots taken in the trailing hour and day,
+    - addresses are ranked by staleness * portfolio value of their last snapshot, value floored at min_value so that
+    dust wallets still get refreshed, just rarely. addresses refreshed less than update_frequency minutes ago are skipped.
+    '''
+    def __init__(self, plex_db: SQLiteDB, parameters: Dict[str, Any]):
+        self.plex_db = plex_db
+        config = parameters['plex']['scheduler']
+        self.budget_per_hour: float = config['budget']['per_hour']
+        self.budget_per_day: float = config['budget']['per_day']
+        self.endpoint_costs: Dict[str, float] = config['endpoint_costs']
+        self.min_value: float = config.get('min_value', 1.0)
+        self.update_frequency: float = parameters['plex']['update_frequency'] * 60
+
+    @property
+    def refresh_cost(self) -> float:
+        return sum(self.endpoint_costs[endpoint] for endpoint in DebankAPI.endpoints + ['all_history_list'])
+
+    def spent(self, addresses: list[str], now: float, period: float) -> float:
+        '''estimated credits spent on addresses over the last period seconds'''
+        refreshes = 0
+        for address in addresses:
+            timestamps = self.plex_db.all_timestamps(address, 'snapshots')
+            refreshes += len(timestamps) - bisect.bisect_left(timestamps, now - period)
+        return refreshes * self.refresh_cost
+
+    def plan(self, addresses: list[str], now: float = None) -> pd.DataFrame:
+        '''
+        one row per address, by decreasing priority: address, last_updated, staleness (s), value, score, cost, refresh.
+        '''
+        now = now if now is not None else datetime.now(tz=timezone.utc).timestamp()
+        available = min(self.budget_per_hour - self.spent(addresses, now, 3600),
+                        self.budget_per_day - self.spent(addresses, now, 86400))
+
+        rows = []
+        for address in addresses:
+            last_updated = self.plex_db.last_updated(address, 'snapshots').timestamp()
+            snapshot = self.plex_db.query_table_at([address], last_updated, 'snapshots')
+            value = snapshot['value'].abs().sum() if not snapshot.empty else 0.0
+            staleness = now - last_updated
+            rows.append({'address': address,
+                         'last_updated': last_updated,
+                         'staleness': staleness,
+                         'value': value,
+                         'score': staleness * max(value, self.min_value),
+                         'cost': self.refresh_cost})
+        plan = pd.DataFrame(rows, columns=['address', 'last_updated', 'staleness', 'value', 'score', 'cost'])
+        plan = plan.sort_values('score', ascending=False, ignore_index=True)
+
+        refresh = []
+        for staleness, cost in zip(plan['staleness'], plan['cost']):
+            refresh.append(bool(staleness >= self.update_frequency and cost <= available))
+            if refresh[-1]:
+                available -= cost
+        plan['refresh'] = refresh
+
+        logging.info(f"refreshing {plan['refresh'].sum()}/{len(plan)} addresses for {plan.loc[plan['refresh'], 'cost'].sum()} "
+                     f"credits, {available} left")
+        return plan
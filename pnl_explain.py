@@ -8,9 +8,9 @@ import streamlit as st
 import plotly.express as px
 
 from plex.plex import PnlExplainer
-from utils.async_utils import safe_gather
 from utils.db import SQLiteDB, RawDataDB
 from plex.debank_api import DebankAPI
+from utils.prices import PriceStore, CoinGeckoPriceBackend
 
 assert (sys.version_info >= (3, 10)), "Please use Python 3.10 or higher"
 
@@ -24,18 +24,31 @@ from utils.streamlit_utils import load_parameters, prompt_plex_interval, display
 pd.options.mode.chained_assignment = None
 st.session_state.parameters = load_parameters()
 
-# TODO: no pb reloading each time ? bc of sql
+
+
+@st.cache_resource
+def shared_plex_db(plex_db_params: dict, pool_config: dict, _secrets) -> SQLiteDB:
+    '''one SQLiteDB per db file for all sessions, so that its single writer thread is the only one writing to it'''
+    return SQLiteDB(plex_db_params, _secrets, pool_config=pool_config)
+
+
 if 'plex_db' not in st.session_state:
     # tamper with the db file name to add debank key
     plex_db_params = copy.deepcopy(st.session_state.parameters['input_data']['plex_db'])
     plex_db_params['remote_file'] = plex_db_params['remote_file'].replace('.db',
                                                                           f"_{st.session_state.parameters['profile']['debank_key']}.db")
-    st.session_state.plex_db: SQLiteDB = SQLiteDB(plex_db_params, st.secrets)
+    st.session_state.plex_db: SQLiteDB = shared_plex_db(plex_db_params, st.session_state.parameters['run_parameters']['async'],
+                                                        st.secrets)
     raw_data_db: RawDataDB = RawDataDB.build_RawDataDB(st.session_state.parameters['input_data']['raw_data_db'], st.secrets)
     st.session_state.api = DebankAPI(json_db=raw_data_db,
                                      plex_db=st.session_state.plex_db,
                                      parameters=st.session_state.parameters)
-    st.session_state.pnl_explainer = PnlExplainer(st.session_state.plex_db.query_categories(),st.secrets['alchemy_key'])
+    # underlyings with a coingecko id are priced from the local price history, fetched as needed
+    price_ids = st.session_state.parameters['plex'].get('price_ids')
+    st.session_state.pnl_explainer = PnlExplainer(st.session_state.plex_db.query_categories(), st.secrets['alchemy_key'],
+                                                  plex_db=st.session_state.plex_db,
+                                                  price_store=PriceStore(st.session_state.plex_db, CoinGeckoPriceBackend()) if price_ids else None,
+                                                  price_ids=price_ids)
 
 addresses = st.session_state.parameters['profile']['addresses']
 risk_tab, risk_history_tab, pnl_tab, pnl_history_tab = st.tabs(
@@ -54,11 +67,10 @@ with risk_tab:
 
     if refresh or historical:
         all_fetch = asyncio.run(
-            safe_gather([st.session_state.api.fetch_snapshot(address, refresh=refresh, timestamp=timestamp)
-                         for address in addresses] +
-                        [st.session_state.api.fetch_transactions(address)
-                         for address in addresses if refresh],
-                        n=st.session_state.parameters['run_parameters']['async']['gather_limit']))
+            st.session_state.api.gather([st.session_state.api.fetch_snapshot(address, refresh=refresh, timestamp=timestamp)
+                                         for address in addresses] +
+                                        [st.session_state.api.fetch_transactions(address)
+                                         for address in addresses if refresh]))
         if refresh:
             st.write(f"Debank credits used: {(debank_credits - st.session_state.api.get_credits()) * 200 / 1e6} $")
             st.session_state.plex_db.upload_to_s3()
@@ -77,7 +89,7 @@ with risk_tab:
                 st.write("Edit 'underlying' below to group exposures by underlying")
                 categorization = pd.DataFrame({'underlying': {coin: coin for coin in missing_category}
                                                              | st.session_state.pnl_explainer.categories})
-                categorization['exposure'] = st.session_state.snapshot.groupby('asset').sum()['value']
+                categorization['exposure'] = st.session_state.snapshot.groupby('asset', observed=True)['value'].sum()
                 edited_categorization = st.data_editor(categorization, use_container_width=True)['underlying'].to_dict()
                 if st.form_submit_button("Override categorization"):
                     st.session_state.pnl_explainer.categories = edited_categorization
@@ -158,33 +170,18 @@ with pnl_history_tab:
                                                                   default_dt=timedelta(days=7))
     # snapshots
     pnl_snapshots_within = st.session_state.plex_db.query_table_between(st.session_state.parameters['profile']['addresses'], pnl_history_start_timestamp, pnl_history_end_timestamp, "snapshots")
-    # explains and transactions btw snapshots
-    explain_list = []
-    transactions_list = []
-    for start, end in zip(
-            pnl_snapshots_within['timestamp'].unique()[:-1],
-            pnl_snapshots_within['timestamp'].unique()[1:],
-    ):
-        start_snapshots = pnl_snapshots_within[pnl_snapshots_within['timestamp'] == start]
-        end_snapshots = pnl_snapshots_within[pnl_snapshots_within['timestamp'] == end]
-        explain = st.session_state.pnl_explainer.explain(start_snapshots, end_snapshots)
-        explain_list.append(explain)
-
-        # transactions
-        transactions = st.session_state.plex_db.query_table_between(addresses, start, end, "transactions")
-        transactions = st.session_state.pnl_explainer.format_transactions(start, end, transactions)
-        transactions_list.append(transactions)
-    explain_history = pd.concat(explain_list, axis=0, ignore_index=True)
-    tx_pnl = pd.concat(transactions_list, axis=0, ignore_index=True)
-
-    display_multi_stacked_bars(explain_history,
-                               categoricals=['underlying', 'asset', 'protocol', 'pnl_bucket', 'chain',
-                                             'hold_mode', 'type'],
+    # cumulative pnl at each snapshot from the ledger, kept up to date by cli.py snapshot, rather than replaying explains
+    snapshot_timestamps = sorted(pnl_snapshots_within['timestamp'].unique())
+    cumulative_pnl = pd.concat([st.session_state.plex_db.cumulative_pnl(addresses, snapshot_timestamps[0], timestamp).assign(
+                                    timestamp_end=pd.Timestamp(timestamp, unit='s', tz='UTC'))
+                                for timestamp in snapshot_timestamps[1:]], ignore_index=True)
+
+    display_multi_stacked_bars(cumulative_pnl,
+                               categoricals=['underlying', 'asset', 'protocol', 'pnl_bucket', 'address'],
                                values=['pnl'],
                                rows=['timestamp_end'],
                                default_stacking_field='protocol',
-                               default_row_field='pnl_bucket',
-                               cum_sum=True)
+                               default_row_field='pnl_bucket')
 
     download_button(pnl_snapshots_within, file_name='snapshot.csv', label='Download pnl history')
 
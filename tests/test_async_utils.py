@@ -0,0 +1,74 @@
+import asyncio
+
+from utils.async_utils import AdaptiveLimiter, observed, safe_gather, throttled
+
+
+def test_window_grows_by_one_per_call_in_slow_start_then_by_one_per_window():
+    limiter = AdaptiveLimiter(initial=4, max_window=100)
+    for _ in range(4):
+        limiter.on_latency(0.1)
+    assert limiter.window == 8
+
+    # the first congestion halves the window and ends slow start
+    limiter.on_congestion()
+    assert limiter.window == 4
+    limiter.on_latency(0.1)
+    assert limiter.window == 4.25
+
+
+def test_window_is_capped_and_floored():
+    limiter = AdaptiveLimiter(initial=4, min_window=2, max_window=6)
+    for _ in range(10):
+        limiter.on_latency(0.1)
+    assert limiter.window == 6
+    for _ in range(20):
+        limiter.on_congestion()
+    assert limiter.window == 2
+
+
+def test_congestion_shrinks_the_window_at_most_once_per_window_of_calls():
+    limiter = AdaptiveLimiter(initial=8)
+    limiter.on_congestion()
+    assert limiter.window == 4
+    # the rest of the calls in flight when it shrank
+    for _ in range(3):
+        limiter.on_congestion()
+    assert limiter.window == 4
+    limiter.on_congestion()
+    assert limiter.window == 2
+
+
+def test_latency_above_tolerance_of_the_baseline_is_congestion():
+    limiter = AdaptiveLimiter(initial=4, latency_tolerance=2.0, min_latency=0.05)
+    for _ in range(4):
+        limiter.on_latency(0.1)
+    window = limiter.window
+    # smoothed latency 0.1 * 0.8 + 1.0 * 0.2 = 0.28 > 2 * baseline
+    limiter.on_latency(1.0)
+    assert limiter.window == window / 2
+
+    # below min_latency, jitter is not congestion
+    limiter = AdaptiveLimiter(initial=4, min_latency=0.05)
+    limiter.on_latency(0.001)
+    limiter.on_latency(0.02)
+    assert limiter.window == 6
+
+
+def test_safe_gather_keeps_tasks_within_the_window_and_reports_to_it():
+    limiter = AdaptiveLimiter(initial=3, max_window=3)
+    in_flight, windows = [], []
+
+    async def task(i: int) -> int:
+        in_flight.append(limiter.in_flight)
+        await asyncio.sleep(0.001)
+        if i == 5:
+            throttled()
+        else:
+            observed(0.01)
+        windows.append(limiter.window)
+        return i
+
+    assert asyncio.run(safe_gather([task(i) for i in range(20)], n=3, limiter=limiter)) == list(range(20))
+    assert max(in_flight) == 3
+    assert min(windows) == 1.5
+    assert limiter.in_flight == 0
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import time
+
+import pandas as pd
+from aiohttp import web
+
+from utils.coingecko import AddressIndex, ScannerAPI, SeriesCache, myCoinGeckoAPI
+from utils.db import SQLiteDB
+
+
+def test_address_index_keeps_updates_across_rebuilds(tmp_path):
+    source, filename = str(tmp_path / 'address_map.csv'), str(tmp_path / 'address_index.pickle')
+    pd.DataFrame({'id': ['weth'], 'symbol': ['weth'], 'name': ['WETH'], 'ethereum': ['0xC02A']}).to_csv(source, index=False)
+    index = AddressIndex.load(filename, source=source)
+    assert index.update([{'id': 'new-coin', 'symbol': 'new', 'name': 'New', 'platforms': {'ethereum': '0xBEEF'}}]) == 1
+
+    # the csv changing rebuilds the index, which keeps the coin added since
+    os.utime(source, (os.path.getmtime(source) + 60,) * 2)
+    rebuilt = AddressIndex.load(filename, source=source)
+    assert rebuilt.source_mtime == os.path.getmtime(source)
+    assert rebuilt.lookup(['ethereum', 'ethereum'], ['0xc02a', '0xbeef'])['id'].tolist() == ['weth', 'new-coin']
+
+
+async def resolve_from_stand_in(scanner: ScannerAPI, tokens: list[tuple[str, str]], failing: set[str]) -> tuple[dict, list]:
+    '''fetch_token_symbols against a local alchemy_getTokenMetadata, returning the symbols and the batches it served'''
+    batches = []
+
+    async def handle(request: web.Request) -> web.Response:
+        payload = await request.json()
+        batches.append((request.match_info['network'], [call['params'][0] for call in payload]))
+        return web.json_response([{'id': call['id'], 'jsonrpc': '2.0'}
+                                  | ({'error': {'code': -32000}} if call['params'][0] in failing
+                                     else {'result': {'symbol': call['params'][0][-4:].upper()}}) for call in payload])
+
+    app = web.Application()
+    app.router.add_post('/{network}/{api_key}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    scanner.url = f'http://127.0.0.1:{runner.addresses[0][1]}/{{network}}/{{api_key}}'
+    try:
+        return await scanner.fetch_token_symbols(tokens), batches
+    finally:
+        await runner.cleanup()
+
+
+def test_token_symbols_are_resolved_in_batches_and_persisted(tmp_path):
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    tokens = [(f'0xA{i:03d}', 'eth') for i in range(5)] + [(f'0xb{i:03d}', 'arb') for i in range(3)] + [('eth', 'eth')]
+
+    symbols, batches = asyncio.run(resolve_from_stand_in(ScannerAPI('key', plex_db, batch_size=2), tokens, failing={'0xb001'}))
+
+    assert sorted(len(addresses) for _, addresses in batches) == [1, 1, 2, 2, 2]
+    assert {network for network, _ in batches} == {'eth-mainnet', 'arb-mainnet'}
+    assert symbols[('0xA003', 'eth')] == 'a003'
+    # unresolved and native ones come back as is
+    assert symbols[('0xb001', 'arb')] == '0xb001'
+    assert symbols[('eth', 'eth')] == 'eth'
+
+    # resolved ones are read back from plex_db, only the failed one is looked up again
+    symbols, batches = asyncio.run(resolve_from_stand_in(ScannerAPI('key', plex_db), tokens, failing=set()))
+    assert batches == [('arb-mainnet', ['0xb001'])]
+    assert symbols[('0xb001', 'arb')] == 'b001'
+    assert ScannerAPI('key', plex_db).get_token_symbols(tokens[:2]) == {('0xA000', 'eth'): 'a000', ('0xA001', 'eth'): 'a001'}
+
+
+def test_series_cache_only_fetches_the_gaps(tmp_path):
+    cache = SeriesCache(str(tmp_path))
+    calls, failing = [], {260}
+
+    def fetch(start: int, end: int) -> pd.DataFrame:
+        calls.append((start, end))
+        if start in failing:
+            failing.remove(start)
+            raise ConnectionError('connection reset')
+        timestamps = list(range(start - start % 10, end + 1, 10))
+        return pd.DataFrame({'timestamp': timestamps, 'price': [float(t) for t in timestamps]})
+
+    assert cache.get(('ethereum', 'usd', 'hourly'), 100, 200, fetch)['timestamp'].tolist() == list(range(100, 201, 10))
+    # gaps on both sides, the one shorter than min_gap left for later, the other widened to min_span
+    series = cache.get(('ethereum', 'usd', 'hourly'), 95, 260, fetch, min_gap=10, min_span=80)
+    assert calls[1:] == [(180, 260)]
+    assert series['timestamp'].tolist() == list(range(100, 261, 10))
+    assert cache.load(('ethereum', 'usd', 'hourly'))[1] == [(100, 260)]
+
+    # a failed fetch isn't recorded as covered, and is retried by the next get
+    cache.get(('ethereum', 'usd', 'hourly'), 100, 320, fetch)
+    assert cache.load(('ethereum', 'usd', 'hourly'))[1] == [(100, 260)]
+    cache.get(('ethereum', 'usd', 'hourly'), 100, 320, fetch)
+    assert calls[2:] == [(260, 320), (260, 320)]
+    assert cache.load(('ethereum', 'usd', 'hourly'))[1] == [(100, 320)]
+
+
+class OHLCStandIn(myCoinGeckoAPI):
+    '''4h candles up to now, over the days requested'''
+    def __init__(self, series_cache_dir: str):
+        super().__init__()
+        self.series_cache_dir = series_cache_dir
+        self.days = []
+
+    def get_coin_ohlc_by_id(self, id, vs_currency, days):
+        self.days.append(days)
+        now = int(time.time() * 1000)
+        span = 400 if days == 'max' else int(days)
+        return [[t, 1.0, 2.0, 0.5, 1.5] for t in range(now - span * 86400000, now + 1, 14400000)]
+
+
+def test_ohlc_spans_are_rounded_up_to_the_served_ones_and_trimmed(tmp_path):
+    coingecko = OHLCStandIn(str(tmp_path))
+    start = int(time.time() * 1000) - 10 * 86400000 - 1000
+    ohlc = coingecko.fetch_ohlc('ethereum', days=10)
+    assert coingecko.days == ['14']
+    assert ohlc['timestamp'].min() >= pd.Timestamp(start, unit='ms', tz='UTC')
+    assert coingecko.series_cache.load(('ethereum', 'usd', 'ohlc_4h'))[0]['timestamp'].min() >= start
+
+    # covered
+    coingecko.fetch_ohlc('ethereum', days=3)
+    assert coingecko.days == ['14']
+    coingecko.fetch_ohlc('ethereum', days=20)
+    assert coingecko.days == ['14', '30']
+    coingecko.fetch_ohlc('ethereum', days=500)
+    assert coingecko.days == ['14', '30', 'max']
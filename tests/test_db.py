@@ -0,0 +1,170 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.db import ConnectionManager, SQLiteDB
+
+
+def snapshots(n_snapshots: int = 8) -> list[pd.DataFrame]:
+    '''positions whose price drifts in and out of NaN, one of them NaN throughout'''
+    frames = []
+    for i in range(n_snapshots):
+        prices = [2000.0 + i, np.nan if i % 3 == 1 else 1.0, np.nan]
+        amounts = [1.0 + i, 100.0, np.nan if i % 2 else 5.0]
+        frames.append(pd.DataFrame({'chain': 'eth', 'protocol': ['lido', 'wallet', 'wallet'], 'hold_mode': 'cash',
+                                    'type': 'cash', 'asset': ['stETH', 'USDC', 'SCAM'],
+                                    'amount': amounts, 'price': prices, 'value': np.multiply(amounts, prices),
+                                    'timestamp': 1700000000 + 60 * i, 'address': '0xa'}))
+    return frames
+
+
+def test_delta_storage_round_trips_nan_like_full_storage(tmp_path):
+    full = SQLiteDB({'data_dir': str(tmp_path / 'full')}, {})
+    delta = SQLiteDB({'data_dir': str(tmp_path / 'delta'), 'snapshot_storage': 'delta', 'keyframe_interval': 3}, {})
+    for frame in snapshots():
+        full.insert_table(frame, 'snapshots')
+        delta.insert_table(frame, 'snapshots')
+
+    expected = full.query_table_between(['0xa'], 1700000000, 1700000000 + 60 * 8, 'snapshots')
+    result = delta.query_table_between(['0xa'], 1700000000, 1700000000 + 60 * 8, 'snapshots')
+    columns = ['timestamp', 'protocol', 'asset']
+    pd.testing.assert_frame_equal(result.sort_values(columns, ignore_index=True)[expected.columns],
+                                  expected.sort_values(columns, ignore_index=True), check_categorical=False)
+    assert result['price'].isna().any()
+
+
+def positions(address: str, timestamp: int, amount: float = 1.0) -> pd.DataFrame:
+    return pd.DataFrame({'chain': 'eth', 'protocol': ['wallet', 'lido'], 'hold_mode': 'cash', 'type': 'cash',
+                         'asset': ['USDC', 'stETH'], 'amount': amount, 'price': [1.0, 2000.0],
+                         'value': [amount, 2000.0 * amount], 'timestamp': timestamp, 'address': address})
+
+
+def test_timestamp_catalog_picks_up_rows_written_by_another_connection(tmp_path):
+    writer = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    writer.bulk_insert([positions('0xa', 1700000000), positions('0xa', 1700000060), positions('0xb', 1700000060)], 'snapshots')
+    reader = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    assert reader.last_updated('0xa', 'snapshots').timestamp() == 1700000060
+    assert reader.common_timestamps(['0xa', '0xb']) == [1700000060]
+
+    # newer rows are read by the timestamp index, a late one by a full reload, a duplicate one is not counted
+    writer.bulk_insert([positions('0xa', 1700000120), positions('0xb', 1700000000), positions('0xa', 1700000060)], 'snapshots')
+    assert reader.all_timestamps('0xa', 'snapshots') == [1700000000, 1700000060, 1700000120]
+    assert reader.common_timestamps(['0xa', '0xb']) == [1700000000, 1700000060]
+    assert reader.catalog('snapshots').size == writer.catalog('snapshots').size == 5
+
+
+def test_delta_storage_overwrites_a_snapshot_written_again(tmp_path):
+    frames = snapshots(6)
+    delta = SQLiteDB({'data_dir': str(tmp_path / 'delta'), 'snapshot_storage': 'delta', 'keyframe_interval': 10}, {})
+    for frame in frames[:5]:
+        delta.insert_table(frame, 'snapshots')
+    # a delta that later ones apply to, and the latest one
+    for i in [2, 4]:
+        frames[i] = frames[i].assign(amount=frames[i]['amount'] * 2, value=frames[i]['value'] * 2)
+        delta.insert_table(frames[i], 'snapshots')
+    delta.insert_table(frames[5], 'snapshots')
+
+    full = SQLiteDB({'data_dir': str(tmp_path / 'full')}, {})
+    full.bulk_insert(frames, 'snapshots')
+    expected = full.query_table_between(['0xa'], 1700000000, 1700000000 + 60 * 6, 'snapshots')
+    result = delta.query_table_between(['0xa'], 1700000000, 1700000000 + 60 * 6, 'snapshots')
+    columns = ['timestamp', 'protocol', 'asset']
+    pd.testing.assert_frame_equal(result.sort_values(columns, ignore_index=True)[expected.columns],
+                                  expected.sort_values(columns, ignore_index=True), check_categorical=False)
+    with delta.connections.reader() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM snapshot_deltas '
+                            'WHERE frame_id NOT IN (SELECT frame_id FROM snapshot_frames)').fetchone()[0] == 0
+
+
+def test_per_address_tables_migrate_into_the_single_indexed_table(tmp_path):
+    legacy = SQLiteDB({'data_dir': str(tmp_path), 'schema': 'per_address'}, {})
+    for address in ['0xa', '0xb']:
+        legacy.insert_table(positions(address, 1700000000), 'snapshots')
+        legacy.insert_table(positions(address, 1700000060, amount=2.0), 'snapshots')
+    legacy.connections.close()
+
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    with plex_db.connections.reader() as conn:
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM snapshots WHERE address = ? AND timestamp = ?',
+                            ('0xa', 1700000000)).fetchall()
+    assert not {'snapshots_0xa', 'snapshots_0xb'} & tables
+    assert 'idx_snapshots_address_timestamp' in str(plan)
+    assert plex_db.all_timestamps('0xb', 'snapshots') == [1700000000, 1700000060]
+    result = plex_db.query_table_between(['0xa', '0xb'], 1700000000, 1700000060, 'snapshots')
+    assert len(result) == 8
+    assert result.loc[result['timestamp'] == 1700000060, 'amount'].tolist() == [2.0] * 4
+
+
+def test_bulk_insert_writes_all_frames_in_one_transaction(tmp_path):
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    plex_db.all_timestamps('0xa', 'snapshots')
+    assert plex_db.bulk_insert([positions('0xa', 1700000000 + 60 * i) for i in range(3)], 'snapshots') == 6
+    assert plex_db.all_timestamps('0xa', 'snapshots') == [1700000000, 1700000060, 1700000120]
+
+    # a row sqlite can't bind fails the whole batch, frames before it included
+    unbindable = positions('0xa', 1700000240).astype({'amount': object})
+    unbindable.at[1, 'amount'] = {'not': 'a number'}
+    with pytest.raises(sqlite3.Error):
+        plex_db.bulk_insert([positions('0xa', 1700000180), unbindable], 'snapshots')
+    assert plex_db.all_timestamps('0xa', 'snapshots') == [1700000000, 1700000060, 1700000120]
+    assert len(plex_db.query_table_between(['0xa'], 1700000000, 1700000240, 'snapshots')) == 6
+
+
+def test_writes_from_many_threads_run_on_the_single_writer(tmp_path):
+    connections = ConnectionManager(str(tmp_path / 'plex.db'), pool_size=2, max_overflow=1)
+    connections.write(lambda conn: conn.execute('CREATE TABLE t (thread TEXT, i INTEGER)'))
+
+    def insert(i: int) -> str:
+        def fn(conn: sqlite3.Connection) -> str:
+            conn.execute('INSERT INTO t VALUES (?, ?)', (threading.current_thread().name, i))
+            return threading.current_thread().name
+        return connections.write(fn)
+
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(insert, range(100))) == {'sqlite_writer'}
+
+    # a failing write rolls back and raises in the caller
+    def failing(conn: sqlite3.Connection) -> None:
+        conn.execute('INSERT INTO t VALUES (?, ?)', ('sqlite_writer', -1))
+        raise ValueError('boom')
+    with pytest.raises(ValueError):
+        connections.write(failing)
+
+    def count(_) -> int:
+        with connections.reader() as conn:
+            return conn.execute('SELECT COUNT(*) FROM t').fetchone()[0]
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(count, range(20))) == {100}
+    # readers are read-only, and only pool_size of them are kept
+    with connections.reader() as conn, pytest.raises(sqlite3.OperationalError):
+        conn.execute('INSERT INTO t VALUES (?, ?)', ('reader', 0))
+    assert connections.pool.qsize() <= 2
+    connections.close()
+
+
+def explain_rows(assets: list[str]) -> pd.DataFrame:
+    return pd.DataFrame({'chain': 'eth', 'protocol': 'wallet', 'hold_mode': 'cash', 'type': 'cash', 'asset': assets,
+                         'address': '0xa', 'underlying': 'ETH', 'pnl_bucket': 'delta', 'pnl': 1.0})
+
+
+def test_plex_results_are_keyed_by_address_set_pair_and_categories_version(tmp_path):
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    version = plex_db.categories_version()
+    plex_db.insert_plex_results(['0xb', '0xa'], [(100, 200, explain_rows(['stETH'])), (200, 300, explain_rows(['USDC']))],
+                                version)
+    # a result computed under older categories is not persisted
+    plex_db.insert_plex_results(['0xa', '0xb'], [(300, 400, explain_rows(['USDC']))], version - 1)
+
+    assert plex_db.plex_results_pairs(['0xa', '0xb', '0xa']) == {(100, 200), (200, 300)}
+    assert plex_db.plex_results_pairs(['0xa']) == set()
+    assert plex_db.query_plex_results(['0xa', '0xb'], [(200, 300)])['asset'].tolist() == ['USDC']
+
+    # re-categorizing stETH drops the pairs explained with it and carries the others over to the new version
+    plex_db.overwrite_categories({'stETH': 'ETH'})
+    assert plex_db.categories_version() == version + 1
+    assert plex_db.plex_results_pairs(['0xa', '0xb']) == {(200, 300)}
@@ -0,0 +1,169 @@
+import asyncio
+import copy
+
+import pandas as pd
+import pytest
+
+from plex.debank_api import DebankAPI
+from plex.debank_server import DebankStandIn, synthetic_history, synthetic_raw_snapshot
+
+
+class PeerCountingStandIn(DebankStandIn):
+    '''records the client side of the connection each call came in on'''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.peers = set()
+
+    async def handle(self, request):
+        self.peers.add(request.transport.get_extra_info('peername'))
+        return await super().handle(request)
+
+
+def debank_api(api_url: str, http: dict = None) -> DebankAPI:
+    return DebankAPI(None, None, {'profile': {'debank_key': 'key', 'api_url': api_url},
+                                  'run_parameters': {'http': http or {}},
+                                  'plex': {'redundant_protocols': [None]}})
+
+
+@pytest.fixture
+def server():
+    server = PeerCountingStandIn(latency=0.001, jitter=0, n_legs=200)
+    server.api_url = server.start_in_thread()
+    yield server
+    server.stop_thread()
+
+
+def test_transactions_are_paged_through_and_parsed_as_one_list(server):
+    history = server.history('0xa')
+    api = debank_api(server.api_url)
+
+    tx_list, transactions = asyncio.run(api.gather([api._fetch_transactions('0xa', 0, 1700000000)]))[0]
+
+    assert [tx['id'] for tx in tx_list['history_list']] == [tx['id'] for tx in history['history_list']]
+    # down to the first short page
+    assert server.calls['user/all_history_list'] == len(history['history_list']) // api.history_page_count + 1
+    pd.testing.assert_frame_equal(transactions, api.parse_all_history_list(history))
+
+
+def test_transactions_stop_at_start_timestamp(server):
+    history = server.history('0xa')
+    api = debank_api(server.api_url)
+    start_timestamp = history['history_list'][50]['time_at']
+
+    tx_list, _ = asyncio.run(api.gather([api._fetch_transactions('0xa', start_timestamp, 1700000000)]))[0]
+
+    # whole pages, the last one reaching back to start_timestamp
+    assert server.calls['user/all_history_list'] == 50 // api.history_page_count + 1
+    assert {tx['id'] for tx in history['history_list'][:51]} <= {tx['id'] for tx in tx_list['history_list']}
+
+
+def test_calls_of_a_gather_share_the_kept_alive_connections(server):
+    api = debank_api(server.api_url, http={'limit_per_host': 4})
+
+    async def run() -> list:
+        sessions = []
+
+        async def call() -> dict:
+            sessions.append(api._session())
+            return await api._get('user/all_token_list', params={'id': '0xa'})
+        results = await api.gather([call() for _ in range(40)])
+        assert len({id(session) for session in sessions}) == 1
+        assert sessions[0].closed and not api._sessions
+        return results
+
+    assert len(asyncio.run(run())) == 40
+    assert server.calls['user/all_token_list'] == 40
+    assert len(server.peers) <= 4
+
+    # a new event loop gets a new client
+    asyncio.run(run())
+    assert server.calls['user/all_token_list'] == 80
+
+
+def test_throttled_calls_are_retried_after_retry_after_and_shrink_the_window():
+    server = DebankStandIn(latency=0.001, jitter=0, max_concurrency=3, rate_429=0.2, retry_after=0.01)
+    api_url = server.start_in_thread()
+    try:
+        api = debank_api(api_url, http={'retries': 20})
+        results = asyncio.run(api.gather([api._get('user/all_token_list', params={'id': '0xa'}) for _ in range(30)]))
+    finally:
+        server.stop_thread()
+
+    assert results == [server.snapshot('0xa')['all_token_list']] * 30
+    assert server.calls['user/all_token_list'] == 30
+    assert server.throttled > 0
+    assert api.limiter.window < 10
+
+
+def baseline_parse_snapshot(dict_input: dict, redundant_protocols: list) -> pd.DataFrame:
+    '''the row-dict parser the columnar one replaced'''
+    rows = []
+    for protocol in dict_input['all_complex_protocol_list']:
+        for portfolio_item in protocol['portfolio_item_list']:
+            for bucket_type, positions in portfolio_item['detail'].items():
+                if isinstance(positions, list):
+                    sign = -1 if 'borrow' in bucket_type else 1
+                    rows += [{'chain': protocol['chain'], 'protocol': protocol['name'], 'hold_mode': portfolio_item['name'],
+                              'type': bucket_type, 'asset': position['symbol'], 'amount': sign * position['amount'],
+                              'price': position['price'], 'value': sign * position['amount'] * position['price']}
+                             for position in positions]
+    rows += [{'chain': position['chain'], 'protocol': 'wallet', 'hold_mode': 'cash', 'type': 'cash',
+              'asset': position['symbol'], 'amount': position['amount'], 'price': position['price'],
+              'value': position['amount'] * position['price']}
+             for position in dict_input['all_token_list']
+             if position['is_verified'] and position['is_core'] and (position['price'] > 0)]
+    rows += [{'chain': position['chain'], 'protocol': position['name'], 'hold_mode': 'cash', 'type': 'nft',
+              'asset': position['name'], 'amount': position['amount'], 'price': position['usd_price'],
+              'value': position['amount'] * position['usd_price']}
+             for position in dict_input['all_nft_list']
+             if ('usd_price' in position) and (position['usd_price'] > 0)]
+    df = pd.DataFrame(rows)
+    df['timestamp'] = int(dict_input['timestamp'])
+    df['address'] = dict_input['address']
+    return df[~df['protocol'].isin(redundant_protocols)]
+
+
+def test_columnar_snapshot_parser_matches_the_row_parser():
+    raw = [synthetic_raw_snapshot('0xa', 1700000000.5, seed=0), synthetic_raw_snapshot('0xb', 1700000060, seed=1)]
+    raw[0]['all_token_list'][1]['price'] = 0.0
+    raw[0]['all_nft_list'][0].pop('usd_price')
+    untouched = copy.deepcopy(raw)
+    api = DebankAPI(None, None, {'plex': {'redundant_protocols': ['protocol_3']}})
+
+    expected = pd.concat([baseline_parse_snapshot(dict_input, ['protocol_3']) for dict_input in raw], ignore_index=True)
+    result = api.parse_snapshots(raw)
+
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+    pd.testing.assert_frame_equal(api.parse_snapshot(raw[1]), baseline_parse_snapshot(raw[1], ['protocol_3']))
+    assert raw == untouched
+
+
+def baseline_parse_all_history_list(transactions: dict) -> pd.DataFrame:
+    '''the row-dict parser the vectorized one replaced'''
+    rows = []
+    for tx in transactions['history_list']:
+        if not tx['is_scam']:
+            for side, legs, counterparty in [(1, tx.get('receives', []), 'from_addr'), (-1, tx.get('sends', []), 'to_addr')]:
+                for leg in legs:
+                    row = {'id': tx['id'], 'timestamp': tx['time_at'], 'chain': tx['chain'],
+                           'protocol': transactions['project_dict'][tx['project_id']]['name'] if tx['project_id'] else leg[counterparty],
+                           'gas': tx['tx']['usd_gas_fee'] if 'usd_gas_fee' in tx['tx'] else 0.0,
+                           'type': tx['tx']['name'], 'asset': leg['token_id'], 'amount': leg['amount'] * side}
+                    token = transactions['token_dict'].get(leg['token_id'], {})
+                    if ('price' in token) and token['price']:
+                        row['price'] = token['price']
+                        row['pnl'] = leg['amount'] * row['price'] * side
+                    rows.append(row)
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        df['pnl'] = df['pnl'] - df['gas']
+    return df
+
+
+def test_vectorized_history_parser_matches_the_row_parser():
+    # unpriced tokens, scam and gasless transactions, transactions without a project or without legs
+    transactions = synthetic_history(500, n_tokens=50)
+
+    pd.testing.assert_frame_equal(DebankAPI.parse_all_history_list(transactions),
+                                  baseline_parse_all_history_list(transactions))
+    assert DebankAPI.parse_all_history_list({'history_list': [], 'project_dict': {}, 'token_dict': {}}).empty
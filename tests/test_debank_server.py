@@ -0,0 +1,52 @@
+import asyncio
+
+import aiohttp
+
+from plex.debank_server import DebankStandIn, synthetic_history, synthetic_raw_snapshot
+from utils.db import ObjectStoreRawDataDB
+from utils.sync import LocalDirStore
+
+
+async def get_all(api_url: str, endpoint: str, params: dict, n: int) -> list[tuple[int, dict]]:
+    async with aiohttp.ClientSession() as session:
+        async def get() -> tuple[int, dict]:
+            async with session.get(f'{api_url}/{endpoint}', params=params) as response:
+                return response.status, await response.json()
+        return await asyncio.gather(*(get() for _ in range(n)))
+
+
+def test_responses_are_replayed_from_the_raw_data_and_charged(tmp_path):
+    json_db = ObjectStoreRawDataDB(LocalDirStore(str(tmp_path)), data_dir='raw_data')
+    raw = synthetic_raw_snapshot('0xa', 1700000000, n_protocols=2, n_tokens=3, seed=7)
+    json_db.insert_table(raw, '0xa', 'snapshots')
+    json_db.insert_table({'start_timestamp': 1700000000, 'end_timestamp': 1700000000, 'tx_list': synthetic_history(30)},
+                         '0xa', 'transactions')
+    server = DebankStandIn(latency=0.001, jitter=0, json_db=json_db, endpoint_costs={'all_token_list': 3}, balance=100)
+    api_url = server.start_in_thread()
+    try:
+        [(status, tokens)] = asyncio.run(get_all(api_url, 'user/all_token_list', {'id': '0xa'}, 1))
+        [(_, page)] = asyncio.run(get_all(api_url, 'user/all_history_list',
+                                          {'id': '0xa', 'start_time': 1700000000 - 60 * 5, 'page_count': 4}, 1))
+        [(_, units)] = asyncio.run(get_all(api_url, 'account/units', {}, 1))
+    finally:
+        server.stop_thread()
+
+    assert status == 200 and tokens == raw['all_token_list']
+    # the transactions at or before start_time, latest first
+    assert [tx['time_at'] for tx in page['history_list']] == [1700000000 - 60 * i for i in range(5, 9)]
+    assert set(page['token_dict']) == {leg['token_id'] for tx in page['history_list']
+                                       for leg in tx.get('sends', []) + tx.get('receives', [])}
+    assert units == {'balance': 96}
+
+
+def test_calls_beyond_max_concurrency_get_a_429():
+    server = DebankStandIn(latency=0.05, jitter=0, max_concurrency=4, retry_after=0.5)
+    api_url = server.start_in_thread()
+    try:
+        responses = asyncio.run(get_all(api_url, 'user/all_nft_list', {'id': '0xa'}, 10))
+    finally:
+        server.stop_thread()
+
+    statuses = [status for status, _ in responses]
+    assert statuses.count(200) == 4 and statuses.count(429) == 6
+    assert server.calls['user/all_nft_list'] == 4 and server.throttled == 6
@@ -0,0 +1,147 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from plex.plex import PnlExplainer
+from utils.db import SQLiteDB
+from utils.prices import PriceStore, FixturePriceBackend
+
+T0 = int(time.time()) // 3600 * 3600 - 7200
+
+
+def snapshot(timestamp: int, eth_price: float = None, steth_price: float = 1990.0) -> pd.DataFrame:
+    rows = [('lido', 'stETH', 10.0, steth_price), ('wallet', 'USDC', 100.0, 1.0)]
+    if eth_price is not None:
+        rows.append(('wallet', 'ETH', 10.0, eth_price))
+    protocols, assets, amounts, prices = zip(*rows)
+    return pd.DataFrame({'chain': 'eth', 'protocol': protocols, 'hold_mode': 'cash', 'type': 'cash', 'asset': assets,
+                         'amount': amounts, 'price': prices, 'value': [a * p for a, p in zip(amounts, prices)],
+                         'timestamp': timestamp, 'address': '0xa'})
+
+
+@pytest.fixture
+def explainer(tmp_path) -> PnlExplainer:
+    # the store only knows a flat hourly ETH price
+    fixture = pd.DataFrame({'coin_id': 'ethereum', 'timestamp': [T0 - 3600, T0, T0 + 3600], 'price': [2000.0] * 3})
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    return PnlExplainer({'ETH': 'ETH', 'stETH': 'ETH', 'USDC': 'USD'}, plex_db=plex_db,
+                        price_store=PriceStore(plex_db, FixturePriceBackend(fixture)),
+                        price_ids={'ETH': 'ethereum', 'USD': 'usd'})
+
+
+def pnl(explain: pd.DataFrame, asset: str) -> dict[str, float]:
+    rows = explain[explain['asset'] == asset]
+    return dict(zip(rows['pnl_bucket'].astype(str), rows['pnl']))
+
+
+def test_held_underlying_is_priced_from_the_snapshot(explainer):
+    explain = explainer.explain(snapshot(T0 + 60, eth_price=3000.0), snapshot(T0 + 120, eth_price=3030.0))
+    assert pnl(explain, 'ETH')['delta'] == pytest.approx(300.0)
+    assert pnl(explain, 'ETH')['basis'] == pytest.approx(0.0)
+
+
+def test_missing_underlying_is_priced_from_the_store(explainer):
+    explain = explainer.explain(snapshot(T0 + 60), snapshot(T0 + 120, steth_price=2000.0))
+    assert explain.loc[explain['asset'] == 'stETH', 'P_underlying_start'].tolist() == [2000.0] * 3
+    assert pnl(explain, 'stETH')['delta'] == pytest.approx(0.0)
+    assert pnl(explain, 'stETH')['basis'] == pytest.approx(100.0)
+    assert explainer.price_store.backend.fetched
+
+
+def test_new_ledger_is_backfilled_from_the_first_snapshot(explainer):
+    plex_db = explainer.price_store.plex_db
+    for i, eth_price in enumerate([3000.0, 3010.0, 3005.0, 3040.0, 3050.0]):
+        plex_db.insert_table(snapshot(T0 + 60 * i, eth_price=eth_price), 'snapshots')
+
+    assert explainer.update_ledger(plex_db, '0xa', chunk_size=3) == 4
+    assert plex_db.pnl_ledger_head('0xa') == T0 + 240
+    cumulative_pnl = plex_db.cumulative_pnl(['0xa'], T0, T0 + 240)
+    eth = cumulative_pnl[cumulative_pnl['asset'] == 'ETH']
+    assert eth['pnl'].sum() == pytest.approx(10 * (3050.0 - 3000.0))
+    assert explainer.update_ledger(plex_db, '0xa') == 0
+
+
+def test_ledger_is_not_updated_with_uncategorized_assets(tmp_path):
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    for i in range(3):
+        plex_db.insert_table(snapshot(T0 + 60 * i, eth_price=3000.0 + i), 'snapshots')
+
+    with pytest.raises(ValueError, match='ETH'):
+        PnlExplainer({'stETH': 'ETH', 'USDC': 'USD'}, plex_db=plex_db).update_ledger(plex_db, '0xa')
+    assert plex_db.pnl_ledger_head('0xa') is None
+    assert plex_db.cumulative_pnl(['0xa'], T0, T0 + 120).empty
+
+
+def test_explain_history_dtypes_match_on_cache_hit_and_miss(explainer):
+    plex_db = explainer.price_store.plex_db
+    snapshots = pd.concat([snapshot(T0 + 60 * i, eth_price=3000.0 + i) for i in range(3)], ignore_index=True)
+    miss = explainer.explain_history(plex_db, ['0xa'], snapshots[snapshots['timestamp'] < T0 + 120])
+    partial = explainer.explain_history(plex_db, ['0xa'], snapshots)
+    hit = explainer.explain_history(plex_db, ['0xa'], snapshots)
+    for explain in [partial, hit]:
+        pd.testing.assert_series_equal(explain.dtypes[miss.columns], miss.dtypes)
+    assert len(hit) == len(partial) > len(miss)
+
+
+def baseline_explain(categories: dict[str, str], start_snapshot: pd.DataFrame, end_snapshot: pd.DataFrame) -> pd.DataFrame:
+    '''the per-row explain the vectorized one replaced, less its timestamps'''
+    keys = [col for col in start_snapshot.columns if col not in ['price', 'amount', 'value', 'timestamp']]
+    start, end = start_snapshot.set_index(keys), end_snapshot.set_index(keys)
+    data = start.join(end, how='outer', lsuffix='_start', rsuffix='_end')
+    common = data[data.index.isin(set(start.index) & set(end.index))].reset_index()
+    before = data[data.index.isin(set(start.index) - set(end.index))].reset_index()
+    after = data[data.index.isin(set(end.index) - set(start.index))].reset_index()
+    for df in [common, before, after]:
+        df['underlying'] = df['asset'].map(lambda asset: categories.get(asset, asset))
+    common[['P_underlying_start', 'P_underlying_end']] = common.apply(
+        lambda x: common.loc[common['asset'] == x['underlying'], ['price_start', 'price_end']].mean(), axis=1)
+    common = common.fillna(0)
+    delta = (common['P_underlying_end'] - common['P_underlying_start']) * common['amount_start'] * common['price_start'] / common['P_underlying_start']
+    basis = common['amount_start'] * (common['price_end'] - common['price_start']) - delta
+    return pd.concat([common.assign(pnl_bucket='delta', pnl=delta),
+                      common.assign(pnl_bucket='basis', pnl=basis),
+                      common.assign(pnl_bucket='amt_chng', pnl=(common['amount_end'] - common['amount_start']) * common['price_end']),
+                      before.assign(pnl_bucket='amt_chng', pnl=- before['amount_start'] * before['price_start']),
+                      after.assign(pnl_bucket='amt_chng', pnl=after['amount_end'] * after['price_end'])], ignore_index=True)
+
+
+def test_vectorized_explain_matches_the_per_row_explain():
+    categories = {'ETH': 'ETH', 'stETH': 'ETH', 'USDC': 'USDC', 'WBTC': 'BTC', 'DAI': 'USDC'}
+    start = snapshot(T0, eth_price=3000.0)
+    # the same asset on another chain, and a position closed in between
+    start = pd.concat([start, start.iloc[[0]].assign(chain='arb', amount=3.0, value=3.0 * 1990.0),
+                       start.iloc[[0]].assign(protocol='aave', asset='WBTC', amount=0.5, price=40000.0, value=20000.0)],
+                      ignore_index=True)
+    end = start.assign(timestamp=T0 + 60, price=start['price'] * [1.02, 1.0, 1.01, 0.99, 1.0],
+                       amount=start['amount'] * [1.0, 1.1, 1.0, 2.0, 1.0]).iloc[:4]
+    end = pd.concat([end, end.iloc[[1]].assign(protocol='maker', asset='DAI', amount=50.0, price=1.0)], ignore_index=True)
+    end['value'] = end['amount'] * end['price']
+
+    result = PnlExplainer(categories).explain(start, end)
+    expected = baseline_explain(categories, start, end)
+
+    columns = ['chain', 'protocol', 'hold_mode', 'type', 'asset', 'address', 'pnl_bucket']
+    result = result.astype({column: str for column in columns}).sort_values(columns, ignore_index=True)
+    expected = expected.sort_values(columns, ignore_index=True)
+    assert result[columns].to_dict('list') == expected[columns].to_dict('list')
+    for column in ['pnl', 'P_underlying_start', 'P_underlying_end', 'amount_start', 'amount_end']:
+        np.testing.assert_allclose(result[column].astype(float), expected[column].astype(float))
+    assert result['timestamp_start'].unique().tolist() == [pd.Timestamp(T0, unit='s', tz='UTC')]
+
+
+def test_explain_periods_matches_explain_of_each_pair():
+    explainer = PnlExplainer({'ETH': 'ETH', 'stETH': 'ETH', 'USDC': 'USDC', 'DAI': 'USDC'})
+    frames = [snapshot(T0 + 60 * i, eth_price=3000.0 + 10 * i, steth_price=1990.0 + 7 * i) for i in range(5)]
+    # a position opened, then closed
+    frames[2] = pd.concat([frames[2], frames[2].iloc[[1]].assign(protocol='maker', asset='DAI')], ignore_index=True)
+    frames[3] = frames[3].iloc[1:]
+    snapshots = pd.concat(frames, ignore_index=True)
+
+    expected = pd.concat([explainer.explain(start, end) for start, end in zip(frames[:-1], frames[1:])], ignore_index=True)
+    pd.testing.assert_frame_equal(explainer.explain_periods(snapshots), expected, check_categorical=False)
+
+    pairs = [(T0 + 60, T0 + 120), (T0 + 180, T0 + 240)]
+    expected = pd.concat([explainer.explain(frames[1], frames[2]), explainer.explain(frames[3], frames[4])], ignore_index=True)
+    pd.testing.assert_frame_equal(explainer.explain_periods(snapshots, pairs), expected, check_categorical=False)
@@ -0,0 +1,82 @@
+import json
+
+from utils.db import ObjectStoreRawDataDB
+from utils.sync import LocalDirStore
+
+
+class CountingStore(LocalDirStore):
+    def __init__(self, remote_dir: str):
+        super().__init__(remote_dir)
+        self.requests = {'get': 0, 'put': 0}
+
+    def get(self, key):
+        self.requests['get'] += 1
+        return super().get(key)
+
+    def put(self, key, data):
+        self.requests['put'] += 1
+        super().put(key, data)
+
+
+def snapshot(timestamp: int) -> dict:
+    return {'timestamp': timestamp, 'address': '0xa', 'all_token_list': [{'id': 'eth', 'amount': timestamp}]}
+
+
+def test_insert_reads_and_writes_the_manifest_once(tmp_path):
+    store = CountingStore(str(tmp_path))
+    raw_data_db = ObjectStoreRawDataDB(store, data_dir='raw_data', compression='gzip', pack_period='hourly')
+    raw_data_db.insert_table(snapshot(3600), '0xa', 'snapshots')
+    store.requests = {'get': 0, 'put': 0}
+    raw_data_db.insert_table(snapshot(3660), '0xa', 'snapshots')
+    # the payload and the manifest
+    assert store.requests == {'get': 1, 'put': 2}
+
+
+def test_late_data_keeps_packs_sorted(tmp_path):
+    raw_data_db = ObjectStoreRawDataDB(LocalDirStore(str(tmp_path)), data_dir='raw_data', compression='gzip', pack_period='hourly')
+    for timestamp in [3600, 3900, 7300]:
+        raw_data_db.insert_table(snapshot(timestamp), '0xa', 'snapshots')
+    # late, into the already packed first hour
+    raw_data_db.insert_table(snapshot(3700), '0xa', 'snapshots')
+    raw_data_db.insert_table(snapshot(7400), '0xa', 'snapshots')
+
+    manifest = raw_data_db.manifest('0xa', 'snapshots')
+    assert [index['timestamps'] for index in manifest['packs'].values()] == [[3600, 3700, 3900]]
+    reader = ObjectStoreRawDataDB(LocalDirStore(str(tmp_path)), data_dir='raw_data')
+    assert reader.all_timestamps('0xa', 'snapshots') == [3600, 3700, 3900, 7300, 7400]
+    for timestamp in [3600, 3700, 3900, 7300, 7400]:
+        assert reader.query_table('0xa', timestamp, 'snapshots')['all_token_list'][0]['amount'] == timestamp
+
+
+def test_manifest_is_rebuilt_from_the_address_prefix_and_legacy_keys(tmp_path):
+    store = LocalDirStore(str(tmp_path))
+    store.put('raw_data/snapshots_0xa_1000.json', json.dumps(snapshot(1000)).encode('utf-8'))
+    raw_data_db = ObjectStoreRawDataDB(store, data_dir='raw_data')
+    raw_data_db.insert_table(snapshot(2000), '0xa', 'snapshots')
+    raw_data_db.insert_table({'start_timestamp': 1000, 'end_timestamp': 3000, 'tx_list': []}, '0xa', 'transactions')
+    assert sorted(store.list('raw_data/snapshots/0xa/')) == ['raw_data/snapshots/0xa/2000.json',
+                                                            'raw_data/snapshots/0xa/manifest.json']
+
+    # a lost manifest is rebuilt by listing, transactions being indexed by their end timestamp
+    store.delete('raw_data/snapshots/0xa/manifest.json')
+    store.delete('raw_data/transactions/0xa/manifest.json')
+    reader = ObjectStoreRawDataDB(store, data_dir='raw_data')
+    assert reader.all_timestamps('0xa', 'snapshots') == [1000, 2000]
+    assert reader.all_timestamps('0xa', 'transactions') == [3000]
+    assert reader.query_table('0xa', 3000, 'transactions')['start_timestamp'] == 1000
+
+
+def test_compacted_packs_round_trip(tmp_path):
+    store = LocalDirStore(str(tmp_path))
+    store.put('raw_data/snapshots_0xa_1000.json', json.dumps(snapshot(1000)).encode('utf-8'))
+    raw_data_db = ObjectStoreRawDataDB(store, data_dir='raw_data', compression='gzip')
+    for timestamp in [2000, 90000, 90100]:
+        raw_data_db.insert_table(snapshot(timestamp), '0xa', 'snapshots')
+
+    assert raw_data_db.compact('0xa', 'snapshots', before=86400 * 2, include_legacy=True) == 4
+    assert not store.get('raw_data/snapshots_0xa_1000.json')
+    assert sorted(raw_data_db.manifest('0xa', 'snapshots')['packs']) == ['raw_data/snapshots/0xa/packs/0.pack',
+                                                                        'raw_data/snapshots/0xa/packs/86400.pack']
+    reader = ObjectStoreRawDataDB(store, data_dir='raw_data')
+    for timestamp in [1000, 2000, 90000, 90100]:
+        assert reader.query_table('0xa', timestamp, 'snapshots') == snapshot(timestamp)
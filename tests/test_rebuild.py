@@ -0,0 +1,39 @@
+from plex.debank_server import synthetic_raw_snapshot
+from plex.rebuild import RebuildEngine
+from utils.db import ObjectStoreRawDataDB, SQLiteDB
+from utils.sync import LocalDirStore
+
+TIMESTAMPS = [1700000000 + 60 * i for i in range(6)]
+
+
+class FlakyRawDataDB(ObjectStoreRawDataDB):
+    '''fails the first download of failing, as a transient S3 or network error would'''
+    def __init__(self, store: LocalDirStore, failing: int):
+        super().__init__(store, data_dir='raw_data')
+        self.failing = failing
+
+    def query_table_bytes(self, address, timestamp, table_name):
+        if timestamp == self.failing:
+            self.failing = None
+            raise ConnectionError('connection reset')
+        return super().query_table_bytes(address, timestamp, table_name)
+
+
+def test_a_failed_file_is_retried_by_the_resumed_rebuild(tmp_path):
+    json_db = FlakyRawDataDB(LocalDirStore(str(tmp_path / 'raw')), failing=TIMESTAMPS[3])
+    for i, timestamp in enumerate(TIMESTAMPS):
+        json_db.insert_table(synthetic_raw_snapshot('0xa', timestamp, n_protocols=2, n_tokens=3, n_nfts=0, seed=i),
+                             '0xa', 'snapshots')
+    plex_db = SQLiteDB({'data_dir': str(tmp_path / 'plex')}, {})
+    engine = RebuildEngine(json_db, plex_db, {'plex': {'redundant_protocols': [None]}},
+                           download_workers=2, parse_workers=1, batch_size=2)
+
+    stats = engine.run(['0xa'])
+    assert stats['errors'] == 1
+    assert plex_db.rebuild_checkpoint('0xa', 'snapshots') == TIMESTAMPS[2]
+    assert plex_db.all_timestamps('0xa', 'snapshots') == TIMESTAMPS[:3]
+
+    stats = engine.run(['0xa'])
+    assert stats['errors'] == 0
+    assert plex_db.rebuild_checkpoint('0xa', 'snapshots') == TIMESTAMPS[-1]
+    assert plex_db.all_timestamps('0xa', 'snapshots') == TIMESTAMPS
@@ -0,0 +1,48 @@
+import pandas as pd
+
+from plex.scheduler import RefreshScheduler
+from utils.db import SQLiteDB
+
+NOW = 1700000000
+
+
+def parameters(per_hour: float, per_day: float) -> dict:
+    return {'plex': {'update_frequency': 1,
+                     'scheduler': {'budget': {'per_hour': per_hour, 'per_day': per_day},
+                                   'endpoint_costs': {'all_complex_protocol_list': 1, 'all_token_list': 1,
+                                                      'all_nft_list': 1, 'all_history_list': 1},
+                                   'min_value': 1000}}}
+
+
+def insert_snapshot(plex_db: SQLiteDB, address: str, timestamp: int, value: float) -> None:
+    plex_db.insert_table(pd.DataFrame({'chain': ['eth'], 'protocol': ['wallet'], 'hold_mode': ['cash'], 'type': ['cash'],
+                                       'asset': ['USDC'], 'amount': [value], 'price': [1.0], 'value': [value],
+                                       'timestamp': [timestamp], 'address': [address]}), 'snapshots')
+
+
+def test_stalest_most_valuable_addresses_are_refreshed_within_the_hourly_budget(tmp_path):
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    insert_snapshot(plex_db, '0xbig', NOW - 7200, 1e6)
+    # floored at min_value, still less than 0xbig
+    insert_snapshot(plex_db, '0xdust', NOW - 10800, 10.0)
+    # refreshed within update_frequency, and 4 credits spent in the last hour
+    insert_snapshot(plex_db, '0xfresh', NOW - 10, 1e6)
+
+    plan = RefreshScheduler(plex_db, parameters(per_hour=12, per_day=1000)).plan(['0xdust', '0xbig', '0xfresh', '0xnew'], now=NOW)
+
+    # never refreshed comes first
+    assert plan['address'].tolist() == ['0xnew', '0xbig', '0xdust', '0xfresh']
+    assert plan['refresh'].tolist() == [True, True, False, False]
+    assert plan['cost'].tolist() == [4] * 4
+
+
+def test_the_daily_budget_caps_the_plan(tmp_path):
+    plex_db = SQLiteDB({'data_dir': str(tmp_path)}, {})
+    # 7 refreshes, 28 credits, in the last day, none in the last hour
+    for i in range(6):
+        insert_snapshot(plex_db, '0xa', NOW - 7200 - 3600 * i, 1e6)
+    insert_snapshot(plex_db, '0xb', NOW - 7200, 1e5)
+
+    plan = RefreshScheduler(plex_db, parameters(per_hour=1000, per_day=32)).plan(['0xa', '0xb'], now=NOW)
+
+    assert plan.set_index('address')['refresh'].to_dict() == {'0xa': True, '0xb': False}
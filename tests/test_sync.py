@@ -0,0 +1,97 @@
+import os
+
+import pandas as pd
+
+from utils.db import SQLiteDB
+from utils.sync import LocalDirStore, SegmentSync
+
+SEGMENT_SIZE = 16
+
+
+def write(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_push_pull_only_moves_changed_segments(tmp_path):
+    store = LocalDirStore(str(tmp_path / 'remote'))
+    writer = SegmentSync(store, 'plex.db', str(tmp_path / 'writer.db'), segment_size=SEGMENT_SIZE)
+    reader = SegmentSync(store, 'plex.db', str(tmp_path / 'reader.db'), segment_size=SEGMENT_SIZE)
+    data = bytes(range(64))
+    write(writer.local_file, data)
+
+    assert writer.push() == 4
+    assert reader.pull()
+    assert read(reader.local_file) == data
+    # unchanged remote: nothing to download
+    assert not reader.pull()
+
+    write(writer.local_file, data[:16] + b'x' * 16 + data[32:])
+    assert writer.push() == 1
+    assert reader.pull()
+    assert read(reader.local_file) == read(writer.local_file)
+
+
+def test_retired_segments_outlive_gc_delay_pushes(tmp_path):
+    store = LocalDirStore(str(tmp_path / 'remote'))
+    writer = SegmentSync(store, 'plex.db', str(tmp_path / 'writer.db'), segment_size=SEGMENT_SIZE, gc_delay=2)
+    reader = SegmentSync(store, 'plex.db', str(tmp_path / 'reader.db'), segment_size=SEGMENT_SIZE)
+    write(writer.local_file, b'a' * 16 + b'b' * 16)
+    writer.push()
+    stale_manifest = reader._remote_manifest()
+
+    write(writer.local_file, b'a' * 16 + b'c' * 16)
+    writer.push()
+    # a pull that read the previous manifest can still fetch its segments
+    assert all(store.get(reader.segment_key(digest)) is not None for digest in stale_manifest['segments'])
+
+    write(writer.local_file, b'a' * 16 + b'd' * 16)
+    writer.push()
+    assert all(store.get(reader.segment_key(digest)) is not None for digest in stale_manifest['segments'])
+
+    write(writer.local_file, b'a' * 16 + b'e' * 16)
+    writer.push()
+    retired = [digest for digest in stale_manifest['segments'] if digest not in reader._remote_manifest()['segments']]
+    assert retired and all(store.get(reader.segment_key(digest)) is None for digest in retired)
+
+
+def test_pull_retries_when_segments_were_collected(tmp_path, monkeypatch):
+    store = LocalDirStore(str(tmp_path / 'remote'))
+    writer = SegmentSync(store, 'plex.db', str(tmp_path / 'writer.db'), segment_size=SEGMENT_SIZE, gc_delay=0)
+    reader = SegmentSync(store, 'plex.db', str(tmp_path / 'reader.db'), segment_size=SEGMENT_SIZE)
+    write(writer.local_file, b'a' * 32)
+    writer.push()
+    stale_manifest = reader._remote_manifest()
+    write(writer.local_file, b'b' * 32)
+    writer.push()
+
+    manifests = iter([stale_manifest])
+    current = SegmentSync._remote_manifest
+    monkeypatch.setattr(reader, '_remote_manifest', lambda: next(manifests, None) or current(reader))
+    assert reader.pull()
+    assert read(reader.local_file) == b'b' * 32
+
+
+def test_sqlitedb_round_trips_through_a_local_remote(tmp_path, monkeypatch):
+    config = {'remote_dir': str(tmp_path / 'remote'), 'remote_file': 'plex.db', 'segment_size': 4096}
+    snapshot = pd.DataFrame({'chain': ['eth'], 'protocol': ['wallet'], 'hold_mode': ['cash'], 'type': ['cash'],
+                             'asset': ['USDC'], 'amount': [100.0], 'price': [1.0], 'value': [100.0],
+                             'timestamp': [1700000000], 'address': ['0xa']})
+    os.makedirs(tmp_path / 'first')
+    monkeypatch.chdir(tmp_path / 'first')
+    plex_db = SQLiteDB(config, {})
+    plex_db.insert_table(snapshot, 'snapshots')
+    plex_db.upload_to_s3()
+    plex_db.connections.close()
+
+    os.makedirs(tmp_path / 'second')
+    monkeypatch.chdir(tmp_path / 'second')
+    plex_db = SQLiteDB(config, {})
+    assert plex_db.all_timestamps('0xa', 'snapshots') == [1700000000]
+    assert plex_db.query_table_at(['0xa'], 1700000000, 'snapshots')['amount'].tolist() == [100.0]
+    plex_db.connections.close()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import platform
 import asyncio, threading
+import collections
+import contextvars
 import functools
+import logging
+import typing
 
 if platform.system()=='Windows':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -18,13 +22,142 @@ def async_wrap(f):
         return await loop.run_in_executor(executor, p)
     return run
 
-async def safe_gather(tasks,n,semaphore=None,return_exceptions=False):
-    semaphore = semaphore if semaphore else asyncio.Semaphore(n)
+class AdaptiveLimiter:
+    '''
+    Concurrency window adapted by AIMD, replacing a fixed semaphore:
+    - a call that leaves the smoothed latency within latency_tolerance * baseline grows the window by 1/window,
+    ie ~1 per round trip, or by 1 (doubling per round trip) in slow start, until the first congestion,
+    - a task that fails, a call that is throttled or slower than that shrinks it by backoff, at most once per window of calls.
+    calls report their latency and throttling with observed() and throttled(), from within the task holding the slot.
+    latency is a short EWMA of call latencies, so that jitter alone doesn't read as congestion, and baseline a long one,
+    so that a server that got durably slower is eventually the new normal. latency below min_latency is never congestion.
+    '''
+    def __init__(self, initial: float = 10, min_window: float = 1, max_window: float = 100,
+                 backoff: float = 0.5, latency_tolerance: float = 2.0, min_latency: float = 0.05):
+        self.window = float(initial)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_latency = min_latency
+        self.latency: float = None
+        self.baseline: float = None
+        self.in_flight = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        # the first congestion shrinks the window right away
+        self._since_decrease = float('inf')
+        self._slow_start = True
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def __repr__(self):
+        return f'AdaptiveLimiter(window={self.window:.1f}, in_flight={self.in_flight}, queue_depth={self.queue_depth})'
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.window) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as we got cancelled
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
 
-    async def sem_task(task):
-        async with semaphore:
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.window):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def on_latency(self, latency: float) -> None:
+        self._since_decrease += 1
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.baseline = latency if self.baseline is None else 0.98 * self.baseline + 0.02 * latency
+        if self.latency > max(self.latency_tolerance * self.baseline, self.min_latency):
+            self.on_congestion()
+        else:
+            self.window = min(self.max_window, self.window + (1 if self._slow_start else 1 / self.window))
+            self._wake()
+
+    def on_congestion(self) -> None:
+        self._since_decrease += 1
+        self._slow_start = False
+        if self._since_decrease >= self.window:
+            self.window = max(self.min_window, self.window * self.backoff)
+            self._since_decrease = 0
+            logging.info(f'backing off to {self}')
+
+    async def run(self, task: typing.Awaitable) -> typing.Any:
+        '''awaits task in a slot, a failure shrinking the window'''
+        await self.acquire()
+        slot = _Slot(self)
+        _slot.set(slot)
+        try:
             return await task
-    return await asyncio.gather(*(sem_task(task) for task in tasks),return_exceptions=return_exceptions)
+        except Exception:
+            self.on_congestion()
+            raise
+        finally:
+            if slot.held:
+                self.release()
+
+
+class _Slot:
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+        self.held = True
+
+
+# slot held by the current task, and limiter of the enclosing safe_gather
+_slot: contextvars.ContextVar[typing.Optional[_Slot]] = contextvars.ContextVar('_slot', default=None)
+_limiter: contextvars.ContextVar[typing.Optional[AdaptiveLimiter]] = contextvars.ContextVar('_limiter', default=None)
+
+
+def observed(latency: float) -> None:
+    '''reports the latency of a call to the limiter of the current task'''
+    if (slot := _slot.get()) is not None:
+        slot.limiter.on_latency(latency)
+
+
+def throttled() -> None:
+    '''tells the limiter of the current task that the server asked to slow down, eg a 429'''
+    if (slot := _slot.get()) is not None:
+        slot.limiter.on_congestion()
+
+
+async def safe_gather(tasks, n, limiter: AdaptiveLimiter = None, return_exceptions=False):
+    '''
+    gathers tasks within the window of an AdaptiveLimiter: limiter, else the one of the enclosing safe_gather,
+    else a new one starting at n. a task that nests a safe_gather lends its slot to the nested tasks meanwhile,
+    so nesting neither deadlocks nor adds up concurrency.
+    '''
+    limiter = limiter or _limiter.get() or AdaptiveLimiter(initial=n)
+    limiter_token = _limiter.set(limiter)
+    parent = _slot.get()
+    lend = parent is not None and parent.limiter is limiter and parent.held
+    if lend:
+        parent.held = False
+        limiter.release()
+    try:
+        return await asyncio.gather(*(limiter.run(task) for task in tasks), return_exceptions=return_exceptions)
+    finally:
+        _limiter.reset(limiter_token)
+        if lend:
+            await limiter.acquire()
+            parent.held = True
 
 
 class CustomRLock(threading._PyRLock):
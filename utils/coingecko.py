@@ -1,19 +1,36 @@
+import asyncio
+import collections
+import logging
 import os
 import pickle
 import sys
 import time
-from datetime import datetime, timedelta, timezone
-from functools import wraps, lru_cache
+import typing
+from datetime import datetime
+from functools import wraps, lru_cache, cached_property
 
+import aiohttp
+import numpy as np
 import pandas as pd
 import pycoingecko
-import requests
 import streamlit
 
+from utils.async_utils import safe_gather
+from utils.db import SQLiteDB
+
 
 class ScannerAPI:
-    def __init__(self, api_key):
+    '''
+    token symbols from Alchemy's alchemy_getTokenMetadata. with a plex_db, resolved symbols are persisted in its
+    token_metadata table, so that each contract is only ever looked up once.
+    '''
+    url = 'https://{network}.g.alchemy.com/v2/{api_key}'
+
+    def __init__(self, api_key, plex_db: SQLiteDB = None, batch_size: int = 100, max_concurrency: int = 8):
         self.api_key = api_key
+        self.plex_db = plex_db
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
         self.network_map = {
             "eth": "eth-mainnet",
             "op": "op-mainnet",
@@ -21,26 +38,227 @@ class ScannerAPI:
             "matic": "polygon-mainnet",
             "base": "base-mainnet",
         }
+        # (network, lowercase address) -> symbol, None if the contract has none
+        self.token_symbols: dict[tuple[str, str], typing.Optional[str]] = {}
+        # (network, lowercase address) the node returned an error for, not retried within this process
+        self.unresolved: set[tuple[str, str]] = set()
+
+    def get_token_symbol(self, address, network):
+        return self.get_token_symbols([(address, network)])[(address, network)]
+
+    def get_token_symbols(self, tokens: typing.Iterable[tuple[str, str]]) -> dict[tuple[str, str], str]:
+        '''blocking fetch_token_symbols, for callers outside an event loop. from within one, await fetch_token_symbols'''
+        return asyncio.run(self.fetch_token_symbols(tokens))
+
+    async def fetch_token_symbols(self, tokens: typing.Iterable[tuple[str, str]]) -> dict[tuple[str, str], str]:
+        '''
+        symbol of each (address, network), or the address itself if it can't be resolved.
+        tokens are deduped, looked up in memory then in plex_db, and the misses resolved by JSON-RPC batches of
+        batch_size, all networks concurrently. ids that aren't contract addresses, like debank's native 'eth', are
+        never looked up.
+        '''
+        tokens = set(tokens)
+        keys = {(network, address.lower()) for address, network in tokens}
+        if self.plex_db is not None and (unknown := keys - self.token_symbols.keys()):
+            self.token_symbols |= await asyncio.to_thread(self.plex_db.query_token_symbols, unknown)
+        if misses := [key for key in keys - self.token_symbols.keys() - self.unresolved
+                      if key[0] in self.network_map and key[1].startswith('0x')]:
+            resolved = await self._resolve_token_symbols(misses)
+            self.token_symbols |= resolved
+            self.unresolved |= set(misses) - resolved.keys()
+            if self.plex_db is not None and resolved:
+                await asyncio.to_thread(self.plex_db.insert_token_symbols, resolved)
+        return {(address, network): symbol if (symbol := self.token_symbols.get((network, address.lower()))) is not None else address
+                for address, network in tokens}
+
+    async def _resolve_token_symbols(self, keys: list[tuple[str, str]]) -> dict[tuple[str, str], typing.Optional[str]]:
+        by_network = collections.defaultdict(list)
+        for network, address in keys:
+            by_network[network].append(address)
+        batches = [(network, addresses[i:i + self.batch_size])
+                   for network, addresses in by_network.items() for i in range(0, len(addresses), self.batch_size)]
+        async with aiohttp.ClientSession(headers={"accept": "application/json",
+                                                  "content-type": "application/json"}) as session:
+            results = await safe_gather([self._token_metadata_batch(session, network, addresses) for network, addresses in batches],
+                                        n=self.max_concurrency, return_exceptions=True)
+        resolved = {}
+        for (network, addresses), result in zip(batches, results):
+            if isinstance(result, Exception):
+                logging.warning(f'token metadata of {len(addresses)} {network} contracts -> Error: {result}')
+            else:
+                resolved |= result
+        return resolved
+
+    async def _token_metadata_batch(self, session: aiohttp.ClientSession, network: str, addresses: list[str]) -> dict[tuple[str, str], typing.Optional[str]]:
+        '''one JSON-RPC batch request. contracts the node returned an error for are left out, to be retried later'''
+        url = self.url.format(network=self.network_map[network], api_key=self.api_key)
+        payload = [{"id": i, "jsonrpc": "2.0", "method": "alchemy_getTokenMetadata", "params": [address]}
+                   for i, address in enumerate(addresses)]
+        async with session.post(url, json=payload) as response:
+            response.raise_for_status()
+            data = await response.json()
+        replies = {reply['id']: reply for reply in data}
+        return {(network, address): symbol.lower() if (symbol := (replies[i]['result'] or {}).get('symbol')) is not None else None
+                for i, address in enumerate(addresses) if 'result' in replies.get(i, {})}
+
+
+class AddressIndex:
+    '''
+    (coingecko platform, lowercase contract address) -> (coin id, symbol), built once from the wide address map csv
+    and pickled to filename. update adds the coins of a fresh get_coins_list that aren't indexed yet, and keeps them
+    so that they are re-indexed when the csv changes and the index is rebuilt from it. where several coins share a
+    contract, the first one is kept.
+    '''
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.index: dict[tuple[str, str], tuple[str, str]] = {}
+        self.ids: set[str] = set()
+        # coins indexed by update rather than from the csv
+        self.updates: dict[str, dict] = {}
+        self.source_mtime: typing.Optional[float] = None
+
+    @classmethod
+    def load(cls, filename: str, source: str = None) -> 'AddressIndex':
+        '''unpickles filename, rebuilding it from the source csv if it is missing or older'''
+        result = cls(filename)
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                state = pickle.load(f)
+            result.index, result.ids, result.source_mtime = state['index'], state['ids'], state['source_mtime']
+            result.updates = state.get('updates', {})
+        if source is not None and os.path.isfile(source) and os.path.getmtime(source) != result.source_mtime:
+            result.build(source)
+        return result
+
+    def save(self) -> None:
+        # write then rename so a concurrent load never sees a partial file
+        with open(f'{self.filename}.tmp', 'wb') as f:
+            pickle.dump({'index': self.index, 'ids': self.ids, 'updates': self.updates, 'source_mtime': self.source_mtime}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{self.filename}.tmp', self.filename)
+
+    def build(self, source: str) -> None:
+        address_map = pd.read_csv(source, dtype=str, keep_default_na=False)
+        self.index = {}
+        for platform in address_map.columns.drop(['id', 'symbol', 'name'], errors='ignore'):
+            if platform.startswith('Unnamed'):
+                continue
+            column = address_map[platform]
+            listed = address_map.loc[column != '', ['id', 'symbol']].assign(address=column.str.lower())
+            for address, coin_id, symbol in zip(listed['address'], listed['id'], listed['symbol']):
+                self.index.setdefault((platform, address), (coin_id, symbol))
+        self.ids = set(address_map['id'])
+        self.source_mtime = os.path.getmtime(source)
+        # coins added since the csv was written are kept, those it now lists are indexed from it
+        updates, self.updates = self.updates, {}
+        if not self.update(updates.values()):
+            self.save()
+        logging.info(f'indexed {len(self.index)} contracts of {len(self.ids)} coins from {source}')
+
+    def update(self, coins: typing.Iterable[dict]) -> int:
+        '''indexes the coins of get_coins_list(include_platform='true') not seen yet, returns how many'''
+        added = 0
+        for coin in coins:
+            if coin['id'] in self.ids:
+                continue
+            for platform, address in (coin.get('platforms') or {}).items():
+                if platform and address:
+                    self.index.setdefault((platform, address.lower()), (coin['id'], coin['symbol']))
+            self.ids.add(coin['id'])
+            self.updates[coin['id']] = coin
+            added += 1
+        if added:
+            self.save()
+        return added
+
+    def lookup(self, platforms: typing.Iterable[str], addresses: typing.Iterable[str]) -> pd.DataFrame:
+        '''id and symbol of each (platform, address), None where unknown, in input order'''
+        rows = [self.index.get((platform, address.lower()), (None, None)) for platform, address in zip(platforms, addresses)]
+        return pd.DataFrame(rows, columns=['id', 'symbol'])
+
+
+class SeriesCache:
+    '''
+    on-disk columnar cache of coingecko time series, one npz per (coin id, currency, granularity) under cache_dir:
+    timestamp (in ms, sorted and unique), one float array per column, and coverage, the sorted disjoint [start, end]
+    ranges (in ms) already fetched. get only fetches the parts of the requested range that aren't covered, and
+    serves the whole range from the merged series.
+    '''
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def merge_intervals(intervals: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def gaps(intervals: list[tuple[int, int]], start: int, end: int) -> list[tuple[int, int]]:
+        '''parts of [start, end] not in the sorted disjoint intervals'''
+        gaps = []
+        cursor = start
+        for interval_start, interval_end in intervals:
+            if interval_end < cursor:
+                continue
+            if interval_start > end:
+                break
+            if interval_start > cursor:
+                gaps.append((cursor, interval_start))
+            cursor = max(cursor, interval_end)
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def _path(self, key: tuple[str, str, str]) -> str:
+        return os.path.join(self.cache_dir, '_'.join(key) + '.npz')
+
+    def load(self, key: tuple[str, str, str]) -> tuple[pd.DataFrame, list[tuple[int, int]]]:
+        '''cached series of key, timestamp in ms, and its coverage'''
+        if not os.path.isfile(self._path(key)):
+            return pd.DataFrame({'timestamp': np.array([], dtype='int64')}), []
+        with np.load(self._path(key)) as data:
+            coverage = [tuple(interval) for interval in data['coverage'].tolist()]
+            return pd.DataFrame({column: data[column] for column in data.files if column != 'coverage'}), coverage
+
+    def save(self, key: tuple[str, str, str], series: pd.DataFrame, coverage: list[tuple[int, int]]) -> None:
+        # write then rename so a concurrent load never sees a partial file
+        with open(f'{self._path(key)}.tmp', 'wb') as f:
+            np.savez(f, coverage=np.array(coverage, dtype='int64').reshape(-1, 2),
+                     **{column: series[column].to_numpy() for column in series.columns})
+        os.replace(f'{self._path(key)}.tmp', self._path(key))
+
+    def get(self, key: tuple[str, str, str], start: int, end: int,
+            fetch: typing.Callable[[int, int], pd.DataFrame], min_gap: int = 0, min_span: int = 0) -> pd.DataFrame:
+        '''
+        series of key within [start, end] (in ms). fetch(start, end) returns the series (timestamp in ms) of a gap:
+        gaps shorter than min_gap are left for later, and fetches are widened back to min_span, for endpoints whose
+        granularity depends on the span requested.
+        '''
+        series, coverage = self.load(key)
+        fetched = []
+        for gap_start, gap_end in self.gaps(coverage, start, end):
+            if gap_end - gap_start < min_gap:
+                continue
+            fetch_start = min(gap_start, gap_end - min_span)
+            try:
+                fetched.append(fetch(fetch_start, gap_end))
+            except Exception as e:
+                logging.warning(f'{key} from {fetch_start} to {gap_end} -> Error: {e}')
+                continue
+            coverage = self.merge_intervals(coverage + [(fetch_start, gap_end)])
+        if fetched:
+            series = pd.concat([series] + fetched, ignore_index=True)
+            series = series.astype({'timestamp': 'int64'}).drop_duplicates('timestamp', keep='last').sort_values('timestamp', ignore_index=True)
+            self.save(key, series, coverage)
+        timestamps = series['timestamp'].to_numpy()
+        return series.iloc[np.searchsorted(timestamps, start, side='left'):np.searchsorted(timestamps, end, side='right')].reset_index(drop=True)
 
-    @streamlit.cache_data
-    def get_token_symbol(_self, address, network):
-        try:
-            url = f"https://{_self.network_map[network]}.g.alchemy.com/v2/{_self.api_key}"
-            payload = {
-                # "id": 1,
-                "jsonrpc": "2.0",
-                "method": "alchemy_getTokenMetadata",
-                "params": [address]
-            }
-            headers = {
-                "accept": "application/json",
-                "content-type": "application/json"
-            }
-            response = requests.post(url, json=payload, headers=headers)
-            data = response.json()
-            return data["result"]["symbol"].lower()
-        except Exception as e:
-            return address
 
 class myCoinGeckoAPI(pycoingecko.CoinGeckoAPI):
     defillama_mapping = ({'id': 'id',
@@ -143,19 +361,23 @@ class myCoinGeckoAPI(pycoingecko.CoinGeckoAPI):
         "arbitrum-nova": "nova",
     }
 
+    address_map_file = os.path.join(os.sep, os.getcwd(), 'config', 'coingecko_address_map.csv')
+    address_index_file = os.path.join(os.sep, os.getcwd(), 'config', 'coingecko_address_index.pickle')
+    series_cache_dir = os.path.join(os.sep, os.getcwd(), 'config', 'coingecko_series')
+
     @streamlit.cache_data
     def get_address_map(_self) -> pd.DataFrame:
-        filename = os.path.join(os.sep, os.getcwd(), 'config', 'coingecko_address_map.csv')
+        filename = _self.address_map_file
         if not os.path.isfile(filename):
             ids = _self.get_coins_list(include_platform='true')
-            address_map = pd.concat([pd.Series(x['platforms']
-                                               | {'id': x['id'],
-                                                  'symbol': x['symbol'],
-                                                  'name': x['name']})
-                                     for x in ids], axis=1).T
-            address_map.columns = address_map.columns
+            address_map = pd.DataFrame.from_records([x['platforms']
+                                                     | {'id': x['id'],
+                                                        'symbol': x['symbol'],
+                                                        'name': x['name']}
+                                                     for x in ids])
             result = address_map.fillna('').set_index('id')
             result.to_csv(filename)
+            _self.update_address_index(ids)
         else:
             result = pd.read_csv(filename, index_col='id')
 
@@ -169,63 +391,121 @@ class myCoinGeckoAPI(pycoingecko.CoinGeckoAPI):
         table.columns = [myCoinGeckoAPI.defillama_mapping[chain] for chain in table.columns]
         return table
 
-    @streamlit.cache_data
-    def address_to_id(_self, address: str, chain: str) -> str:
-        return _self.address_map[_self.address_map[chain] == address].index[0]
+    @cached_property
+    def address_index(self) -> AddressIndex:
+        return AddressIndex.load(self.address_index_file, source=self.address_map_file)
 
-    @streamlit.cache_data
-    def address_to_symbol(_self, address: str, chain: str) -> str:
-        temp = _self.address_map.loc[_self.address_map[chain] == address, 'symbol'].squeeze()
-        return temp if type(temp) == str else ''
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def platform(chain: str) -> str:
+        '''coingecko platform of a coingecko, defillama or debank chain name'''
+        aliases = ({defillama: platform for platform, defillama in myCoinGeckoAPI.defillama_mapping.items()}
+                   | {debank: platform for platform, debank in myCoinGeckoAPI.debank_mapping.items()})
+        return aliases.get(chain, chain)
 
-    @streamlit.cache_data
-    def fetch_range(_self, symbol: str, start: datetime, end: datetime) -> pd.DataFrame:
+    def update_address_index(self, coins: list[dict] = None) -> int:
         '''
-        :param symbol: coin name
-        :param start: start date
-        :param end: end date
-        :return: df with columns: timestamp, open, high, low, close, volume
+        indexes the coins added since the index was built, from coins if given, otherwise from a fresh
+        get_coins_list(include_platform='true'). returns how many.
         '''
-        df = pd.DataFrame(_self.get_coin_market_chart_range_by_id(id=symbol, vs_currency='usd',
-                                                                 from_timestamp=start.timestamp(),
-                                                                 to_timestamp=end.timestamp()),
-                          columns=['timestamp', 'open', 'high', 'low', 'close'])
-        df['timestamp'] = df['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000).replace(tzinfo=timezone.utc))
-        return df
+        coins = self.get_coins_list(include_platform='true') if coins is None else coins
+        return self.address_index.update(coins)
 
-    @streamlit.cache_data
-    def fetch_market_chart(_self, _id: str, days: int, vs_currency='usd') -> pd.DataFrame:
+    def addresses_to_ids(self, addresses: typing.Iterable[str], chains: typing.Iterable[str]) -> pd.DataFrame:
+        '''id and symbol of each (address, chain), None where unknown, in input order'''
+        return self.address_index.lookup(map(self.platform, chains), addresses)
+
+    def address_to_id(self, address: str, chain: str) -> typing.Optional[str]:
+        return self.address_index.index.get((self.platform(chain), address.lower()), (None, None))[0]
+
+    def address_to_symbol(self, address: str, chain: str) -> str:
+        return self.address_index.index.get((self.platform(chain), address.lower()), (None, ''))[1]
+
+    # spans (in days) up to which coingecko serves each granularity
+    market_chart_granularities = {'5m': 1, 'hourly': 90, 'daily': float('inf')}
+    # 2 days would be 30m too, but the ohlc endpoint only takes the spans of ohlc_days
+    ohlc_granularities = {'30m': 1, '4h': 30, '4d': float('inf')}
+    ohlc_days = [1, 7, 14, 30, 90, 180, 365]
+    granularity_steps = {'5m': 300000, 'hourly': 3600000, 'daily': 86400000,
+                         '30m': 1800000, '4h': 14400000, '4d': 345600000}
+
+    @cached_property
+    def series_cache(self) -> SeriesCache:
+        return SeriesCache(self.series_cache_dir)
+
+    @staticmethod
+    def granularity(granularities: dict[str, float], days: float) -> tuple[str, int]:
+        '''granularity coingecko serves a span of days at, and the smallest span (in ms) still served at it'''
+        previous = 0
+        for granularity, max_days in granularities.items():
+            if days <= max_days:
+                return granularity, int(previous * 86400000) + 1
+            previous = max_days
+
+    @staticmethod
+    def _to_frame(data: list[list[float]], columns: list[str]) -> pd.DataFrame:
+        '''[[ms, value, ...], ...] -> frame of timestamp (in ms) and columns'''
+        values = np.array(data, dtype=float).reshape(-1, len(columns) + 1)
+        return pd.DataFrame({'timestamp': values[:, 0].astype('int64')} | {column: values[:, i + 1] for i, column in enumerate(columns)})
+
+    @staticmethod
+    def _to_datetime(series: pd.DataFrame) -> pd.DataFrame:
+        return series.assign(timestamp=pd.to_datetime(series['timestamp'], unit='ms', utc=True))
+
+    def market_chart_range(self, id_: str, start: int, end: int, vs_currency: str = 'usd') -> pd.DataFrame:
+        '''timestamp (in ms), price, market_cap and total_volume of id_ within [start, end] (in ms), through series_cache'''
+        end = min(end, int(time.time() * 1000))
+        granularity, min_span = self.granularity(self.market_chart_granularities, (end - start) / 86400000)
+
+        def fetch(fetch_start: int, fetch_end: int) -> pd.DataFrame:
+            data = self.get_coin_market_chart_range_by_id(id=id_, vs_currency=vs_currency,
+                                                          from_timestamp=fetch_start // 1000, to_timestamp=fetch_end // 1000)
+            return (self._to_frame(data['prices'], ['price'])
+                    .merge(self._to_frame(data['market_caps'], ['market_cap']), on='timestamp', how='left')
+                    .merge(self._to_frame(data['total_volumes'], ['total_volume']), on='timestamp', how='left'))
+
+        return self.series_cache.get((id_, vs_currency, granularity), start, end, fetch,
+                                     min_gap=self.granularity_steps[granularity], min_span=min_span)
+
+    def fetch_range(self, symbol: str, start: datetime, end: datetime, vs_currency: str = 'usd') -> pd.DataFrame:
         '''
         :param symbol: coin name
         :param start: start date
         :param end: end date
-        :return: df with columns: timestamp, open, high, low, close, volume
+        :return: df with columns: timestamp, price, market_cap, total_volume
         '''
-        df = pd.DataFrame(_self.get_coin_market_chart_by_id(id=_id, days=days, vs_currency=vs_currency)['prices'],
-                          columns=['timestamp', 'price'])
-        df['timestamp'] = df['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000).replace(tzinfo=timezone.utc))
-        return df
+        return self._to_datetime(self.market_chart_range(symbol, int(start.timestamp() * 1000), int(end.timestamp() * 1000), vs_currency))
 
-    @streamlit.cache_data
-    def fetch_ohlc(_self, id_: str, days: int, vs_currency='usd') -> pd.DataFrame:
+    def fetch_market_chart(self, _id: str, days: int, vs_currency='usd') -> pd.DataFrame:
         '''
-        :param symbol: coin name
-        :param start: start date
-        :param end: end date
-        :return: df with columns: timestamp, open, high, low, close, volume
+        :param _id: coin name
+        :param days: number of days up to now
+        :return: df with columns: timestamp, price
         '''
-        if days <= 2:
-            freq = timedelta(minutes=30)
-        elif days <= 30:
-            freq = timedelta(hours=4)
-        else:
-            freq = timedelta(days=4)
+        end = int(time.time() * 1000)
+        series = self.market_chart_range(_id, end - days * 86400000, end, vs_currency)
+        return self._to_datetime(series[['timestamp', 'price']])
+
+    def fetch_ohlc(self, id_: str, days: int, vs_currency='usd') -> pd.DataFrame:
+        '''
+        :param id_: coin name
+        :param days: number of days up to now
+        :return: df with columns: timestamp, open, high, low, close
+        '''
+        end = int(time.time() * 1000)
+        granularity, min_span = self.granularity(self.ohlc_granularities, days)
+
+        def fetch(fetch_start: int, fetch_end: int) -> pd.DataFrame:
+            # the ohlc endpoint only serves the last days up to now, over the spans of ohlc_days, else all of them.
+            # rounding the span up keeps the granularity, the points before fetch_start are dropped as not in coverage
+            fetch_days = next((str(days) for days in self.ohlc_days if days * 86400000 >= end - fetch_start), 'max')
+            series = self._to_frame(self.get_coin_ohlc_by_id(id=id_, vs_currency=vs_currency, days=fetch_days),
+                                    ['open', 'high', 'low', 'close'])
+            return series[series['timestamp'].between(fetch_start, fetch_end)]
 
-        df = pd.DataFrame(_self.get_coin_ohlc_by_id(id=id_, vs_currency=vs_currency,
-                                                   days=str(days)),
-                          columns=['timestamp', 'open', 'high', 'low', 'close'])
-        df['timestamp'] = df['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000).replace(tzinfo=timezone.utc))
-        return df
+        series = self.series_cache.get((id_, vs_currency, f'ohlc_{granularity}'), end - days * 86400000, end, fetch,
+                                       min_gap=self.granularity_steps[granularity], min_span=min_span)
+        return self._to_datetime(series)
 
 if __name__ == '__main__':
     if sys.argv[1] =='ohlcv':
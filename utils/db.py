@@ -1,24 +1,96 @@
-import asyncio
+import bisect
+import collections
+import gzip
 import json
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 import typing
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 
-import boto3
 import yaml
-from botocore.exceptions import ClientError
+import numpy as np
 import pandas as pd
 import sqlite3
 
 from pandas import DataFrame
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from utils.sync import RemoteStore, SegmentSync, LocalDirStore, S3Store
 
 
 TableType = typing.NewType('TableType', typing.Literal["snapshots", "transactions"])
 
+# persisted columns of PnlExplainer.explain results, keyed by (addresses, start_ts, end_ts, categories_version)
+plex_results_columns: dict[str, str] = {
+    'chain': 'TEXT', 'protocol': 'TEXT', 'hold_mode': 'TEXT', 'type': 'TEXT', 'asset': 'TEXT', 'address': 'TEXT',
+    'underlying': 'TEXT', 'pnl_bucket': 'TEXT', 'pnl': 'REAL',
+    'price_start': 'REAL', 'amount_start': 'REAL', 'value_start': 'REAL',
+    'price_end': 'REAL', 'amount_end': 'REAL', 'value_end': 'REAL',
+    'P_underlying_start': 'REAL', 'P_underlying_end': 'REAL',
+}
+
+# running totals of the pnl ledger are kept per these keys
+pnl_ledger_keys: list[str] = ['address', 'underlying', 'asset', 'protocol', 'pnl_bucket']
+
+class CategoricalSchema:
+    '''
+    dtypes of the columns repeated on every row of snapshot and explain frames: categoricals whose categories only
+    grow and are shared by all the frames of the process, so that frames loaded at different times still concat and
+    merge as categoricals. categories are kept sorted, so sorting by codes sorts by value, as it did with strings.
+    amount, price and value stay float64.
+    '''
+    columns = ['chain', 'protocol', 'hold_mode', 'type', 'asset', 'address', 'underlying', 'pnl_bucket']
+
+    def __init__(self):
+        self.categories: dict[str, pd.Index] = {column: pd.Index([], dtype=object) for column in self.columns}
+        self.lock = threading.Lock()
+
+    def dtype(self, column: str) -> pd.CategoricalDtype:
+        return pd.CategoricalDtype(self.categories[column])
+
+    def encode(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''casts the categorical columns of df, in place, to their current dtype, adding the values not seen yet'''
+        for column in self.columns:
+            if column not in df.columns:
+                continue
+            values = df[column]
+            seen = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else pd.Index(values.dropna().unique())
+            with self.lock:
+                if len(new := seen.difference(self.categories[column], sort=False)):
+                    self.categories[column] = self.categories[column].append(new).sort_values(key=lambda index: index.astype(str))
+                dtype = pd.CategoricalDtype(self.categories[column])
+            if values.dtype != dtype:
+                df[column] = values.astype(dtype)
+        return df
+
+
+snapshot_schema = CategoricalSchema()
+
+# column layout of the single-table schema, address and timestamp being the indexed key
+table_schemas: dict[TableType, dict[str, str]] = {
+    'snapshots': {'chain': 'TEXT', 'protocol': 'TEXT', 'hold_mode': 'TEXT', 'type': 'TEXT', 'asset': 'TEXT',
+                  'amount': 'REAL', 'price': 'REAL', 'value': 'REAL',
+                  'timestamp': 'INTEGER', 'address': 'TEXT'},
+    'transactions': {'id': 'TEXT', 'timestamp': 'INTEGER', 'chain': 'TEXT', 'protocol': 'TEXT', 'gas': 'REAL',
+                     'type': 'TEXT', 'asset': 'TEXT', 'amount': 'REAL', 'price': 'REAL', 'pnl': 'REAL',
+                     'address': 'TEXT'},
+}
+
 class RawDataDB(ABC):
     '''
     Abstract class for RawDataDB, where we put raw data in cold storage.
@@ -39,82 +111,697 @@ class RawDataDB(ABC):
     def all_timestamps(self, address: str, table_name: TableType) -> list[int]:
         raise NotImplementedError
 
+    @abstractmethod
+    def query_table_bytes(self, address: str, timestamp: int, table_name: TableType) -> bytes:
+        '''the raw json payload, not parsed, e.g. to parse it in another process'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_table(self, address: str, timestamp: int, table_name: TableType) -> None:
+        raise NotImplementedError
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    if compression == 'gzip':
+        return gzip.compress(data)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().compress(data)
+    elif compression == 'none':
+        return data
+    else:
+        raise ValueError(f'unknown compression {compression}, must be none, gzip or zstd')
+
+
+def decompress(data: bytes) -> bytes:
+    '''detects the compression from the magic bytes, so plain json passes through'''
+    if data[:2] == b'\x1f\x8b':
+        return gzip.decompress(data)
+    elif data[:4] == b'\x28\xb5\x2f\xfd':
+        if zstandard is None:
+            raise ImportError('zstd compressed data needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def json_loads(data: typing.Union[bytes, str]) -> typing.Any:
+    '''orjson if installed, several times faster on large raw files, else json'''
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class ObjectStoreRawDataDB(RawDataDB):
+    '''
+    RawDataDB over a RemoteStore, laid out as
+        <data_dir>/<table_name>/<address>/<timestamp>.json[.gz|.zst]   (<start_timestamp>_<end_timestamp> for transactions)
+        <data_dir>/<table_name>/<address>/packs/<period_start>.pack
+        <data_dir>/<table_name>/<address>/manifest.json
+    the manifest holds {'loose': {timestamp: key}, 'packs': {key: {'timestamps', 'offsets', 'lengths'}}}, so
+    enumerating the files of an address is one GET. Transactions are indexed by end_timestamp.
+
+    Payloads are compressed with compression (none, gzip or zstd), each on its own so reads stay random access.
+    With pack_period (hourly or daily), the loose objects of a period are rolled into one pack object once the period
+    is over, and read back with range GETs at their offset.
+
+    A missing manifest is rebuilt by a paginated listing of the address prefix and of the legacy flat
+    <data_dir>/<table_name>_<address>_<timestamp>.json keys, which stay where they are until compact(include_legacy=True).
+    '''
+    pack_periods = {'hourly': 3600, 'daily': 86400}
+    extensions = {'none': '.json', 'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+    def __init__(self, store: RemoteStore, data_dir: str, compression: str = 'none', pack_period: str = None):
+        self.store = store
+        self.data_dir = data_dir
+        if compression not in self.extensions:
+            raise ValueError(f'unknown compression {compression}, must be one of {list(self.extensions)}')
+        self.compression = compression
+        if pack_period is not None and pack_period not in self.pack_periods:
+            raise ValueError(f'unknown pack_period {pack_period}, must be one of {list(self.pack_periods)}')
+        self.pack_period = pack_period
+        # manifests last read or written by this process, refreshed by all_timestamps and on insert
+        self._manifests: dict[tuple[str, TableType], dict] = {}
+        # (first timestamp, last timestamp, key) of the packs of each manifest, sorted
+        self._pack_bounds: dict[tuple[str, TableType], list[tuple[int, int, str]]] = {}
+
+    def _key(self, *parts: str) -> str:
+        return '/'.join(part for part in [self.data_dir, *parts] if part)
+
+    def _manifest_key(self, address: str, table_name: TableType) -> str:
+        return self._key(table_name, address, 'manifest.json')
+
+    def manifest(self, address: str, table_name: TableType, refresh: bool = True) -> dict:
+        if refresh or (address, table_name) not in self._manifests:
+            if (data := self.store.get(self._manifest_key(address, table_name))) is None:
+                return self.rebuild_manifest(address, table_name)
+            manifest = json.loads(decompress(data))
+            if 'loose' not in manifest:
+                # flat {timestamp: key} manifest, before packs
+                manifest = {'loose': manifest, 'packs': {}}
+            manifest['loose'] = {int(timestamp): key for timestamp, key in manifest['loose'].items()}
+            self._cache_manifest(address, table_name, manifest)
+        return self._manifests[(address, table_name)]
+
+    def _cache_manifest(self, address: str, table_name: TableType, manifest: dict) -> None:
+        for index in manifest['packs'].values():
+            # packs appended to out of order before they were kept sorted
+            if any(a > b for a, b in zip(index['timestamps'], index['timestamps'][1:])):
+                rows = sorted(zip(index['timestamps'], index['offsets'], index['lengths']))
+                index['timestamps'], index['offsets'], index['lengths'] = (list(field) for field in zip(*rows))
+        self._manifests[(address, table_name)] = manifest
+        self._pack_bounds[(address, table_name)] = sorted((index['timestamps'][0], index['timestamps'][-1], key)
+                                                          for key, index in manifest['packs'].items() if index['timestamps'])
+
+    def _save_manifest(self, address: str, table_name: TableType, manifest: dict) -> None:
+        self._cache_manifest(address, table_name, manifest)
+        data = json.dumps({'loose': {str(timestamp): key for timestamp, key in sorted(manifest['loose'].items())},
+                           'packs': manifest['packs']}).encode('utf-8')
+        self.store.put(self._manifest_key(address, table_name), compress(data, self.compression))
+
+    def rebuild_manifest(self, address: str, table_name: TableType) -> dict:
+        '''
+        lists loose objects of the address prefix and legacy flat keys. packs are listed but their index is lost,
+        so they need to be re-read with index_pack.
+        '''
+        manifest = {'loose': {}, 'packs': {}}
+        for prefix in [self._key(table_name, address) + '/', self._key(f'{table_name}_{address}_')]:
+            for key in self.store.list(prefix):
+                name = key[len(prefix):]
+                if name.startswith('manifest.json'):
+                    continue
+                elif name.startswith('packs/'):
+                    manifest['packs'][key] = self.index_pack(key)
+                elif '.json' in name:
+                    # <timestamp>.json or <start_timestamp>_<end_timestamp>.json, after the prefix
+                    manifest['loose'][int(name.split('.json')[0].split('_')[-1])] = key
+        self._save_manifest(address, table_name, manifest)
+        return manifest
+
+    def index_pack(self, key: str) -> dict:
+        return self._index_records(self.store.get(key))
+
+    @staticmethod
+    def _index_records(data: bytes) -> dict:
+        '''a pack is a sequence of [8 bytes timestamp][4 bytes length][payload] records'''
+        index, offset = {'timestamps': [], 'offsets': [], 'lengths': []}, 0
+        while offset < len(data):
+            length = int.from_bytes(data[offset + 8:offset + 12], 'big')
+            index['timestamps'].append(int.from_bytes(data[offset:offset + 8], 'big'))
+            index['offsets'].append(offset + 12)
+            index['lengths'].append(length)
+            offset += 12 + length
+        return index
 
-class LocalJsonRawDataDB(RawDataDB):
+    def _locate(self, address: str, table_name: TableType, timestamp: int) -> typing.Optional[tuple[str, typing.Optional[tuple[int, int]]]]:
+        '''key and (offset, length) within it if in a pack, None if timestamp is not in the cached manifest'''
+        manifest = self._manifests[(address, table_name)]
+        if timestamp in manifest['loose']:
+            return manifest['loose'][timestamp], None
+        bounds = self._pack_bounds[(address, table_name)]
+        # packs don't overlap, so only the last one starting before timestamp can hold it
+        i = bisect.bisect_right(bounds, (timestamp, float('inf'), '')) - 1
+        if i >= 0 and bounds[i][1] >= timestamp:
+            index = manifest['packs'][bounds[i][2]]
+            j = bisect.bisect_left(index['timestamps'], timestamp)
+            if j < len(index['timestamps']) and index['timestamps'][j] == timestamp:
+                return bounds[i][2], (index['offsets'][j], index['lengths'][j])
+        return None
 
-    def __init__(self, config: dict):
-        self.data_dir = config['data_dir']
+    def query_table_bytes(self, address: str, timestamp: int, table_name: TableType) -> bytes:
+        '''the raw json payload, decompressed but not parsed'''
+        timestamp = int(timestamp)
+        self.manifest(address, table_name, refresh=False)
+        if (location := self._locate(address, table_name, timestamp)) is None:
+            # may have been written by another process since we read the manifest
+            self.manifest(address, table_name)
+            if (location := self._locate(address, table_name, timestamp)) is None:
+                raise FileNotFoundError(f'{table_name} {address} {timestamp}')
+        key, byte_range = location
+        data = self.store.get(key) if byte_range is None else self.store.get_range(key, *byte_range)
+        if data is None:
+            raise FileNotFoundError(key)
+        return decompress(data)
 
     def query_table(self, address: str, timestamp: int, table_name: TableType) -> dict:
-        with open(os.path.join(self.data_dir, f'{table_name}_{address}_{timestamp}.json'), 'r') as f:
-            return json.load(f)
+        return json_loads(self.query_table_bytes(address, timestamp, table_name))
 
     def insert_table(self, dict_result: dict, address: str, table_name: TableType) -> None:
         if 'start_timestamp' in dict_result and 'end_timestamp' in dict_result:
-            with open(os.path.join(os.sep, self.data_dir, f"{table_name}_{address}_{dict_result['start_timestamp']}_{dict_result['end_timestamp']}.json"), 'w') as f:
-                json.dump(dict_result, f)
+            timestamp = int(dict_result['end_timestamp'])
+            name = f"{dict_result['start_timestamp']}_{dict_result['end_timestamp']}"
         else:
-            with open(os.path.join(os.sep, self.data_dir, f"{table_name}_{address}_{int(dict_result['timestamp'])}.json"), 'w') as f:
-                json.dump(dict_result, f)
+            timestamp = int(dict_result['timestamp'])
+            name = f"{timestamp}"
+        key = self._key(table_name, address, name + self.extensions[self.compression])
+        self.store.put(key, compress(json.dumps(dict_result).encode('utf-8'), self.compression))
+        # one manifest read and one write per insert, packing included
+        manifest = self.manifest(address, table_name)
+        manifest['loose'][timestamp] = key
+        packed = {}
+        if self.pack_period is not None:
+            period = self.pack_periods[self.pack_period]
+            packed = self._pack(manifest, address, table_name, before=timestamp - timestamp % period, include_legacy=False)
+        self._save_manifest(address, table_name, manifest)
+        for packed_key in packed.values():
+            self.store.delete(packed_key)
+
+    def compact(self, address: str, table_name: TableType, before: int = None, include_legacy: bool = False) -> int:
+        '''
+        rolls loose objects with timestamp < before (default: start of the current period) into one pack per
+        pack_period, then deletes them. legacy flat keys are only packed if include_legacy.
+        returns the number of objects packed.
+        '''
+        period = self.pack_periods[self.pack_period or 'daily']
+        if before is None:
+            now = int(datetime.now(tz=timezone.utc).timestamp())
+            before = now - now % period
+        manifest = self.manifest(address, table_name)
+        if packed := self._pack(manifest, address, table_name, before, include_legacy):
+            self._save_manifest(address, table_name, manifest)
+            for key in packed.values():
+                self.store.delete(key)
+        return len(packed)
+
+    def _pack(self, manifest: dict, address: str, table_name: TableType, before: int, include_legacy: bool) -> dict[int, str]:
+        '''
+        packs into manifest the loose objects with timestamp < before, and returns their {timestamp: key}, to be
+        deleted once the manifest is saved.
+        '''
+        period = self.pack_periods[self.pack_period or 'daily']
+        prefix = self._key(table_name, address) + '/'
+        loose = {timestamp: key for timestamp, key in manifest['loose'].items()
+                 if timestamp < before and (include_legacy or key.startswith(prefix))}
+        periods: dict[int, list[int]] = {}
+        for timestamp in sorted(loose):
+            periods.setdefault(timestamp - timestamp % period, []).append(timestamp)
+
+        for period_start, timestamps in periods.items():
+            pack_key = self._key(table_name, address, 'packs', f'{period_start}.pack')
+            # a period can be compacted twice if late data arrives: its records are merged into the existing pack,
+            # in timestamp order so that the index stays searchable. records deleted from the index are dropped
+            records = {}
+            if index := manifest['packs'].get(pack_key):
+                existing = self.store.get(pack_key) or b''
+                records = {timestamp: existing[offset - 12:offset + length]
+                           for timestamp, offset, length in zip(index['timestamps'], index['offsets'], index['lengths'])}
+            for timestamp in timestamps:
+                payload = compress(decompress(self.store.get(loose[timestamp])), self.compression)
+                records[timestamp] = timestamp.to_bytes(8, 'big') + len(payload).to_bytes(4, 'big') + payload
+            pack = b''.join(records[timestamp] for timestamp in sorted(records))
+            self.store.put(pack_key, pack)
+            manifest['packs'][pack_key] = self._index_records(pack)
+            for timestamp in timestamps:
+                del manifest['loose'][timestamp]
+        return loose
 
     def all_timestamps(self, address: str, table_name: TableType) -> list[int]:
-        return [int(file.split('_')[2].split('.')[0]) for file in os.listdir(self.data_dir)
-                if file.startswith(table_name) and file.endswith('.json') and address in file]
+        manifest = self.manifest(address, table_name)
+        return sorted(set(manifest['loose']).union(*(index['timestamps'] for index in manifest['packs'].values())))
+
+    def delete_table(self, address: str, timestamp: int, table_name: TableType) -> None:
+        '''deletes a loose object. a packed one is only dropped from the manifest, its bytes stay in the pack'''
+        manifest = self.manifest(address, table_name)
+        if (key := manifest['loose'].pop(int(timestamp), None)) is not None:
+            self.store.delete(key)
+        for index in manifest['packs'].values():
+            if int(timestamp) in index['timestamps']:
+                i = index['timestamps'].index(int(timestamp))
+                for field in ['timestamps', 'offsets', 'lengths']:
+                    del index[field][i]
+        self._save_manifest(address, table_name, manifest)
+
 
+class LocalJsonRawDataDB(ObjectStoreRawDataDB):
+    def __init__(self, config: dict, secrets: dict = None):
+        # data_dir is a path from home
+        super().__init__(LocalDirStore(os.path.join(os.sep, Path.home(), config['data_dir'])), data_dir='',
+                         compression=config.get('compression', 'none'), pack_period=config.get('pack_period'))
 
-class S3JsonRawDataDB(RawDataDB):
+
+class S3JsonRawDataDB(ObjectStoreRawDataDB):
     def __init__(self, config: dict, secrets: dict):
-        self.bucket_name = config['bucket_name']
-        self.data_dir = config['data_dir']
-        self.connection = boto3.client('s3',
-                                                         aws_access_key_id=secrets['AWS_ACCESS_KEY_ID'],
-                                                         aws_secret_access_key=secrets['AWS_SECRET_ACCESS_KEY'])
+        super().__init__(S3Store(config['bucket_name'], secrets), data_dir=config['data_dir'],
+                         compression=config.get('compression', 'none'), pack_period=config.get('pack_period'))
 
-    def query_table(self, address: str, timestamp: int, table_name: TableType) -> dict:
-        key = os.path.join(self.data_dir, f'{table_name}_{address}_{timestamp}.json')
-        response = self.connection.get_object(Bucket=self.bucket_name, Key=key)
-        return json.loads(response['Body'].read().decode('utf-8'))
 
-    def insert_table(self, dict_result: dict, address: str, table_name: TableType) -> None:
-        if 'start_timestamp' in dict_result and 'end_timestamp' in dict_result:
-            key = os.path.join(self.data_dir, f"{table_name}_{address}_{dict_result['start_timestamp']}_{dict_result['end_timestamp']}.json")
+class TimestampCatalog:
+    '''
+    sorted in-memory copy of the timestamp_catalog table of one TableType.
+    answers latest / nearest / common timestamps across addresses with bisect instead of table scans.
+    size is its number of (address, timestamp), to tell whether the table moved on since.
+    '''
+    def __init__(self, rows: typing.Iterable[tuple[str, int]] = ()):
+        self.timestamps: dict[str, list[int]] = {}
+        for address, timestamp in rows:
+            self.timestamps.setdefault(address, []).append(int(timestamp))
+        for timestamps in self.timestamps.values():
+            timestamps.sort()
+        self.size = sum(len(timestamps) for timestamps in self.timestamps.values())
+        self._common: dict[tuple[str, ...], list[int]] = {}
+
+    def add(self, address: str, timestamp: int) -> None:
+        timestamps = self.timestamps.setdefault(address, [])
+        timestamp = int(timestamp)
+        # snapshots mostly arrive in order, so this is usually an append
+        if not timestamps or timestamps[-1] < timestamp:
+            timestamps.append(timestamp)
         else:
-            key = os.path.join(self.data_dir, f"{table_name}_{address}_{int(dict_result['timestamp'])}.json")
-        json_data = json.dumps(dict_result)
-        self.connection.put_object(Bucket=self.bucket_name, Key=key, Body=json_data)
+            i = bisect.bisect_left(timestamps, timestamp)
+            if i < len(timestamps) and timestamps[i] == timestamp:
+                return
+            timestamps.insert(i, timestamp)
+        self.size += 1
+        self._common.clear()
 
-    def all_timestamps(self, address: str, table_name: TableType) -> list[int]:
-        '''in fact returns filenames'''
-        response = self.connection.list_objects_v2(Bucket=self.bucket_name, Prefix=self.data_dir)
-        return [obj['Key'] for obj in response.get('Contents', [])
-                 if table_name in obj['Key'] and obj['Key'].endswith('.json') and address in obj['Key']]
+    def all_timestamps(self, address: str) -> list[int]:
+        return list(self.timestamps.get(address, []))
+
+    def between(self, address: str, start_timestamp: float, end_timestamp: float) -> list[int]:
+        timestamps = self.timestamps.get(address, [])
+        return timestamps[bisect.bisect_left(timestamps, start_timestamp):bisect.bisect_right(timestamps, end_timestamp)]
+
+    def latest(self, address: str) -> typing.Optional[int]:
+        timestamps = self.timestamps.get(address)
+        return timestamps[-1] if timestamps else None
+
+    @property
+    def max_timestamp(self) -> int:
+        '''latest timestamp across addresses, 0 if empty'''
+        return max((timestamps[-1] for timestamps in self.timestamps.values() if timestamps), default=0)
+
+    def common_timestamps(self, addresses: list[str]) -> list[int]:
+        '''sorted timestamps present for all addresses, cached until the next insert'''
+        key = tuple(sorted(set(addresses)))
+        if key not in self._common:
+            lists = sorted((self.timestamps.get(address, []) for address in key), key=len)
+            if not lists:
+                common = []
+            else:
+                others = [set(lst) for lst in lists[1:]]
+                common = [ts for ts in lists[0] if all(ts in other for other in others)]
+            self._common[key] = common
+        return self._common[key]
+
+    def at_or_before(self, addresses: list[str], timestamp: float) -> typing.Optional[int]:
+        common = self.common_timestamps(addresses)
+        i = bisect.bisect_right(common, timestamp)
+        return common[i - 1] if i > 0 else None
+
+    def at_or_after(self, addresses: list[str], timestamp: float) -> typing.Optional[int]:
+        common = self.common_timestamps(addresses)
+        i = bisect.bisect_left(common, timestamp)
+        return common[i] if i < len(common) else None
+
+
+class ConnectionManager:
+    '''
+    sqlite connections shared by streamlit script threads and safe_gather coroutines:
+    - a pool of read-only connections for queries. pool_size of them are kept open, up to max_overflow more are
+    opened under load and closed after use, and pooled connections older than pool_recycle seconds are reopened.
+    - one writer thread owning the only read-write connection, fed through a queue. writes are serialized and
+    each runs in its own transaction.
+    '''
+    def __init__(self, local_file: str, pool_size: int = 5, max_overflow: int = 10, pool_recycle: int = 3600):
+        self.local_file = local_file
+        self.pool_size = pool_size
+        self.pool_recycle = pool_recycle
+        self.pool: queue.LifoQueue = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size + max_overflow)
+
+        # opened here so the file exists when __init__ returns, but only ever used by the writer thread
+        self.writer_connection = sqlite3.connect(self.local_file, check_same_thread=False)
+        self.write_queue: queue.Queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name='sqlite_writer', daemon=True)
+        self.writer.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            fn, future = self.write_queue.get()
+            if fn is None:
+                self.writer_connection.close()
+                future.set_result(None)
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.writer_connection:
+                    result = fn(self.writer_connection)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+
+    def write(self, fn: typing.Callable[[sqlite3.Connection], typing.Any]) -> typing.Any:
+        '''runs fn(connection) in a transaction on the writer thread, and returns its result'''
+        if threading.current_thread() is self.writer:
+            return fn(self.writer_connection)
+        future = Future()
+        self.write_queue.put((fn, future))
+        return future.result()
+
+    def _connect_reader(self) -> tuple[sqlite3.Connection, float]:
+        connection = sqlite3.connect(f'file:{self.local_file}?mode=ro', uri=True, check_same_thread=False)
+        return connection, time.monotonic()
+
+    @contextmanager
+    def reader(self) -> typing.Iterator[sqlite3.Connection]:
+        '''borrows a read-only connection from the pool, blocking if pool_size + max_overflow are in use'''
+        self.slots.acquire()
+        try:
+            try:
+                connection, created_at = self.pool.get_nowait()
+                if time.monotonic() - created_at > self.pool_recycle:
+                    connection.close()
+                    connection, created_at = self._connect_reader()
+            except queue.Empty:
+                connection, created_at = self._connect_reader()
+            try:
+                yield connection
+            finally:
+                if self.pool.qsize() < self.pool_size:
+                    self.pool.put((connection, created_at))
+                else:
+                    connection.close()
+        finally:
+            self.slots.release()
+
+    def close(self) -> None:
+        future = Future()
+        self.write_queue.put((None, future))
+        future.result()
+        while not self.pool.empty():
+            self.pool.get_nowait()[0].close()
+
+
+class DeltaSnapshots:
+    '''
+    Delta-encoded storage of snapshots (snapshot_storage: delta of plex_db):
+    - every keyframe_interval-th snapshot of an address is a keyframe, stored in full in the snapshots table,
+    - the others are stored in snapshot_deltas as the positions added, removed, or whose amount, price or value changed
+    since the previous snapshot of the address. positions are interned in snapshot_positions, keyed by
+    (address, chain, protocol, hold_mode, type, asset, occurrence), occurrence numbering repeated keys within a snapshot.
+    - snapshot_frames records the base_timestamp each delta applies to, NULL for keyframes.
+    snapshots missing from snapshot_frames, eg inserted before delta storage was enabled, are keyframes.
+    a snapshot older than the latest one of its address is stored as a keyframe, so that deltas always apply forward.
+    one written again replaces the stored one, the snapshot whose deltas applied to it becoming a keyframe.
+    value is only stored when it isn't amount * price.
+    '''
+    key_columns = ['chain', 'protocol', 'hold_mode', 'type', 'asset']
+    # bits of snapshot_deltas.changed
+    AMOUNT, PRICE, VALUE, REMOVED = 1, 2, 4, 8
+
+    def __init__(self, keyframe_interval: int = 60):
+        self.keyframe_interval = keyframe_interval
+        # address -> (timestamp, depth, state) of the latest snapshot written, to diff the next one against
+        self._latest: dict[str, tuple[int, int, dict]] = {}
+        # address -> {key: position_id}
+        self._position_ids: dict[str, dict[tuple, int]] = {}
+
+    def reset(self) -> None:
+        self._latest.clear()
+        self._position_ids.clear()
+
+    @staticmethod
+    def create_tables(conn: sqlite3.Connection) -> None:
+        conn.execute('CREATE TABLE IF NOT EXISTS snapshot_positions '
+                     '(position_id INTEGER PRIMARY KEY, address TEXT, chain TEXT, protocol TEXT, hold_mode TEXT, '
+                     'type TEXT, asset TEXT, occurrence INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_snapshot_positions_address ON snapshot_positions (address)')
+        conn.execute('CREATE TABLE IF NOT EXISTS snapshot_frames '
+                     '(frame_id INTEGER PRIMARY KEY, address TEXT, timestamp INTEGER, base_timestamp INTEGER, '
+                     'depth INTEGER, UNIQUE (address, timestamp))')
+        conn.execute('CREATE TABLE IF NOT EXISTS snapshot_deltas '
+                     '(frame_id INTEGER, position_id INTEGER, changed INTEGER, amount REAL, price REAL, value REAL, '
+                     'PRIMARY KEY (frame_id, position_id)) WITHOUT ROWID')
+
+    @staticmethod
+    def _same(a: typing.Any, b: typing.Any) -> bool:
+        return a == b or (a != a and b != b)
+
+    @classmethod
+    def _state(cls, df: pd.DataFrame) -> dict[tuple, tuple]:
+        '''{(chain, protocol, hold_mode, type, asset, occurrence): (amount, price, value)} of a full snapshot'''
+        occurrence = df.groupby(cls.key_columns, dropna=False, sort=False, observed=True).cumcount()
+        return dict(zip(zip(*(df[column].tolist() for column in cls.key_columns), occurrence.tolist()),
+                        zip(df['amount'].tolist(), df['price'].tolist(), df['value'].tolist())))
+
+    @staticmethod
+    def _positions(conn: sqlite3.Connection, address: str) -> dict[int, tuple]:
+        return {row[0]: tuple(row[1:]) for row in conn.execute(
+            'SELECT position_id, chain, protocol, hold_mode, type, asset, occurrence '
+            'FROM snapshot_positions WHERE address = ?', (address,))}
+
+    def _apply(self, state: dict[tuple, tuple], deltas: list[tuple], positions: dict[int, tuple]) -> dict[tuple, tuple]:
+        '''new state from state and (position_id, changed, amount, price, value) rows'''
+        state = dict(state)
+        for position_id, changed, amount, price, value in deltas:
+            # NaNs are stored as NULL
+            amount, price, value = (np.nan if x is None else x for x in (amount, price, value))
+            key = positions[position_id]
+            if changed & self.REMOVED:
+                del state[key]
+                continue
+            old_amount, old_price, old_value = state.get(key, (None, None, None))
+            amount = amount if changed & self.AMOUNT else old_amount
+            price = price if changed & self.PRICE else old_price
+            if not changed & self.VALUE:
+                value = amount * price if changed & (self.AMOUNT | self.PRICE) else old_value
+            state[key] = (amount, price, value)
+        return state
+
+    def _keyframe_state(self, conn: sqlite3.Connection, address: str, timestamp: int) -> dict[tuple, tuple]:
+        return self._state(self._numeric(pd.read_sql_query('SELECT * FROM snapshots WHERE address = ? AND timestamp = ?',
+                                                           conn, params=(address, int(timestamp)))))
+
+    @staticmethod
+    def _numeric(keyframes: pd.DataFrame) -> pd.DataFrame:
+        '''a REAL column that is all NULL reads back as None objects'''
+        return keyframes.astype({'amount': 'float64', 'price': 'float64', 'value': 'float64'})
+
+    def _state_at(self, conn: sqlite3.Connection, address: str, timestamp: int,
+                  positions: dict[int, tuple] = None) -> tuple[int, dict[tuple, tuple]]:
+        '''(depth, state) of the snapshot of address at timestamp, walking its deltas back to their keyframe'''
+        chain = []
+        while (frame := conn.execute('SELECT frame_id, base_timestamp, depth FROM snapshot_frames '
+                                     'WHERE address = ? AND timestamp = ?', (address, int(timestamp))).fetchone()) \
+                and frame[1] is not None:
+            chain.append(frame)
+            timestamp = frame[1]
+        state = self._keyframe_state(conn, address, timestamp)
+        if chain:
+            positions = positions if positions is not None else self._positions(conn, address)
+            for frame_id, _, _ in reversed(chain):
+                state = self._apply(state, conn.execute('SELECT position_id, changed, amount, price, value '
+                                                        'FROM snapshot_deltas WHERE frame_id = ?', (frame_id,)).fetchall(),
+                                    positions)
+        return (chain[0][2] if chain else 0), state
+
+    def _latest_state(self, conn: sqlite3.Connection, address: str) -> typing.Optional[tuple[int, int, dict]]:
+        latest = max((row[0] for row in [
+            conn.execute('SELECT MAX(timestamp) FROM snapshots WHERE address = ?', (address,)).fetchone(),
+            conn.execute('SELECT MAX(timestamp) FROM snapshot_frames WHERE address = ?', (address,)).fetchone()]
+                      if row[0] is not None), default=None)
+        if latest is None:
+            return None
+        if address not in self._latest or self._latest[address][0] != latest:
+            self._latest[address] = (latest, *self._state_at(conn, address, latest))
+        return self._latest[address]
+
+    def _position_id(self, conn: sqlite3.Connection, address: str, key: tuple) -> int:
+        if address not in self._position_ids:
+            self._position_ids[address] = {key: position_id for position_id, key in self._positions(conn, address).items()}
+        position_ids = self._position_ids[address]
+        if key not in position_ids:
+            position_ids[key] = conn.execute('INSERT INTO snapshot_positions '
+                                             '(address, chain, protocol, hold_mode, type, asset, occurrence) '
+                                             'VALUES (?, ?, ?, ?, ?, ?, ?)', (address, *key)).lastrowid
+        return position_ids[key]
+
+    def encode(self, conn: sqlite3.Connection, data: pd.DataFrame) -> pd.DataFrame:
+        '''
+        writes the deltas of the snapshots in data, within the caller's transaction.
+        returns the rows of the keyframes, to be inserted in the snapshots table by the caller.
+        '''
+        keyframes: dict[tuple[str, int], pd.DataFrame] = {}
+        for (address, timestamp), df in data.groupby(['address', 'timestamp'], sort=True, observed=True):
+            timestamp = int(timestamp)
+            state = self._state(df)
+            latest = self._latest_state(conn, address)
+            if latest is None or timestamp <= latest[0] or latest[1] + 1 >= self.keyframe_interval:
+                if latest is not None and timestamp <= latest[0]:
+                    keyframes |= self._drop(conn, address, timestamp)
+                keyframes[(address, timestamp)] = df
+                conn.execute('INSERT OR REPLACE INTO snapshot_frames (address, timestamp, base_timestamp, depth) '
+                             'VALUES (?, ?, NULL, 0)', (address, timestamp))
+                if latest is None or timestamp >= latest[0]:
+                    self._latest[address] = (timestamp, 0, state)
+                continue
+
+            base_timestamp, depth, base = latest
+            deltas = []
+            for key, (amount, price, value) in state.items():
+                old_amount, old_price, old_value = base.get(key, (None, None, None))
+                new = key not in base
+                changed = (self.AMOUNT if new or not self._same(amount, old_amount) else 0) \
+                    | (self.PRICE if new or not self._same(price, old_price) else 0)
+                expected = amount * price if changed else old_value
+                if not self._same(value, expected):
+                    changed |= self.VALUE
+                if changed:
+                    deltas.append((self._position_id(conn, address, key), changed,
+                                   amount if changed & self.AMOUNT else None,
+                                   price if changed & self.PRICE else None,
+                                   value if changed & self.VALUE else None))
+            deltas += [(self._position_id(conn, address, key), self.REMOVED, None, None, None)
+                       for key in base if key not in state]
+            frame_id = conn.execute('INSERT OR REPLACE INTO snapshot_frames (address, timestamp, base_timestamp, depth) '
+                                    'VALUES (?, ?, ?, ?)', (address, timestamp, base_timestamp, depth + 1)).lastrowid
+            conn.executemany('INSERT INTO snapshot_deltas VALUES (?, ?, ?, ?, ?, ?)',
+                             [(frame_id, *delta) for delta in deltas])
+            self._latest[address] = (timestamp, depth + 1, state)
+        return pd.concat(keyframes.values(), ignore_index=True) if keyframes else data.iloc[:0]
+
+    def _drop(self, conn: sqlite3.Connection, address: str, timestamp: int) -> dict[tuple[str, int], pd.DataFrame]:
+        '''
+        drops the stored snapshot of address at timestamp, about to be overwritten.
+        the snapshots whose deltas applied to it become keyframes, returned to be inserted in the snapshots table.
+        '''
+        keyframes = {}
+        for (dependent,) in conn.execute('SELECT timestamp FROM snapshot_frames WHERE address = ? AND base_timestamp = ?',
+                                         (address, timestamp)).fetchall():
+            state = self._state_at(conn, address, dependent)[1]
+            keyframes[(address, dependent)] = pd.DataFrame([(*key[:-1], *values, dependent, address)
+                                                            for key, values in state.items()],
+                                                           columns=list(table_schemas['snapshots']))
+            conn.execute('UPDATE snapshot_frames SET base_timestamp = NULL, depth = 0 WHERE address = ? AND timestamp = ?',
+                         (address, dependent))
+            self._delete_deltas(conn, address, dependent)
+        self._delete_deltas(conn, address, timestamp)
+        conn.execute('DELETE FROM snapshots WHERE address = ? AND timestamp = ?', (address, timestamp))
+        return keyframes
+
+    @staticmethod
+    def _delete_deltas(conn: sqlite3.Connection, address: str, timestamp: int) -> None:
+        conn.execute('DELETE FROM snapshot_deltas WHERE frame_id IN '
+                     '(SELECT frame_id FROM snapshot_frames WHERE address = ? AND timestamp = ?)', (address, timestamp))
+
+    def read(self, conn: sqlite3.Connection, address: str, timestamps: list[int]) -> pd.DataFrame:
+        '''the snapshots of address at timestamps, in the snapshots table layout'''
+        if not timestamps:
+            return pd.DataFrame(columns=list(table_schemas['snapshots']))
+        start, end = int(min(timestamps)), int(max(timestamps))
+        keyframes = self._numeric(pd.read_sql_query('SELECT * FROM snapshots WHERE address = ? AND timestamp BETWEEN ? AND ?',
+                                                    conn, params=(address, start, end)))
+        frames = {timestamp: (frame_id, base_timestamp) for frame_id, timestamp, base_timestamp in conn.execute(
+            'SELECT frame_id, timestamp, base_timestamp FROM snapshot_frames '
+            'WHERE address = ? AND timestamp BETWEEN ? AND ? AND base_timestamp IS NOT NULL', (address, start, end))}
+        if not frames:
+            return keyframes[keyframes['timestamp'].isin(timestamps)]
+        deltas = collections.defaultdict(list)
+        for frame_id, *delta in conn.execute(
+                'SELECT d.frame_id, d.position_id, d.changed, d.amount, d.price, d.value FROM snapshot_deltas d '
+                'JOIN snapshot_frames f ON d.frame_id = f.frame_id '
+                'WHERE f.address = ? AND f.timestamp BETWEEN ? AND ?', (address, start, end)):
+            deltas[frame_id].append(tuple(delta))
+        positions = self._positions(conn, address)
+        keyframes_by_timestamp = dict(tuple(keyframes.groupby('timestamp')))
+
+        # replay in timestamp order, keeping the previous state around as it is usually the next one's base
+        result = []
+        rows = []
+        previous_timestamp, previous_state = None, None
+        for timestamp in sorted(set(timestamps)):
+            if timestamp in frames:
+                frame_id, base_timestamp = frames[timestamp]
+                base = previous_state if base_timestamp == previous_timestamp \
+                    else self._state_at(conn, address, base_timestamp, positions)[1]
+                state = self._apply(base, deltas[frame_id], positions)
+                rows += [(*key[:-1], *values, timestamp, address) for key, values in state.items()]
+            elif timestamp in keyframes_by_timestamp:
+                result.append(keyframes_by_timestamp[timestamp])
+                state = self._state(keyframes_by_timestamp[timestamp])
+            else:
+                continue
+            previous_timestamp, previous_state = timestamp, state
+        result = [df for df in result + [pd.DataFrame(rows, columns=list(table_schemas['snapshots']))] if not df.empty]
+        if not result:
+            return keyframes.iloc[:0]
+        return pd.concat(result, ignore_index=True).sort_values('timestamp', kind='stable', ignore_index=True)
 
 
 class SQLiteDB:
-    def __init__(self, config: dict, secrets: dict):
-        if 'bucket_name' in config and 'remote_file' in config:
-            # if bucket_name is in config, we are using s3 and download the file to ~
-            self.data_location = {'bucket_name': config['bucket_name'],
+    '''
+    schema 'single' (default) keeps one snapshots and one transactions table indexed on (address, timestamp).
+    schema 'per_address' is the legacy layout with one table per address, e.g. snapshots_0x123...
+    queries go through a pool of read-only connections, writes through a single writer thread
+    (see ConnectionManager, sized by pool_size / max_overflow / pool_recycle of run_parameters.async).
+    snapshot_storage 'delta' stores most snapshots as deltas to the previous one (see DeltaSnapshots), 'full' (default)
+    stores them all in full. query_table_at / query_table_between return full snapshots either way.
+    '''
+    def __init__(self, config: dict, secrets: dict, pool_config: dict = None):
+        self.schema = config.get('schema', 'single')
+        if self.schema not in ['single', 'per_address']:
+            raise ValueError(f'unknown schema {self.schema}, must be single or per_address')
+        self.snapshot_storage = config.get('snapshot_storage', 'full')
+        if self.snapshot_storage not in ['full', 'delta']:
+            raise ValueError(f'unknown snapshot_storage {self.snapshot_storage}, must be full or delta')
+        if self.snapshot_storage == 'delta' and self.schema != 'single':
+            raise ValueError('delta snapshot_storage needs the single schema')
+        if ('bucket_name' in config or 'remote_dir' in config) and 'remote_file' in config:
+            # if bucket_name is in config, we are using s3 (or a local directory standing in for it) and sync the file to ~
+            self.data_location = {'bucket_name': config.get('bucket_name'),
                                   'remote_file': config['remote_file'],
                                   'local_file': os.path.join(os.sep, os.getcwd(), 'plex.db')}
             self.secrets = secrets
-
-            s3 = boto3.client('s3',
-                              aws_access_key_id=secrets['AWS_ACCESS_KEY_ID'],
-                              aws_secret_access_key=secrets['AWS_SECRET_ACCESS_KEY'])
-            # check if the file exists in s3
-            try:
-                s3.download_file(self.data_location['bucket_name'],
-                                 self.data_location['remote_file'],
-                                 self.data_location['local_file'])
-            except ClientError as e:
-                if e.response['Error']['Code'] == '404':
-                    logging.warning(f'Creating new {self.data_location["local_file"]}')
-                    # create a new file, or overwrite existing one
-                    with open(self.data_location['local_file'], 'w') as f:
-                        f.write('')
-                else:
-                    raise e
+            self.sync = SegmentSync(RemoteStore.build_RemoteStore(config, secrets),
+                                    remote_file=self.data_location['remote_file'],
+                                    local_file=self.data_location['local_file'],
+                                    segment_size=config.get('segment_size', 1 << 20),
+                                    gc_delay=config.get('gc_delay', 2))
+            # only downloads what changed since the last sync, if anything
+            if self.sync.pull():
+                # a write-ahead log left by a previous session doesn't belong to the new file
+                for suffix in ['-wal', '-shm']:
+                    if os.path.isfile(self.data_location['local_file'] + suffix):
+                        os.remove(self.data_location['local_file'] + suffix)
             local_file = self.data_location['local_file']
         elif 'data_dir' in config:
             # if not, we are using local and the file is already in the data_dir
@@ -124,57 +811,441 @@ class SQLiteDB:
                 os.chmod(data_dir, 0o777)
             local_file = os.path.join(data_dir, 'plex.db')
         else:
-            raise ValueError('config must contain either bucket_name and filename, or data_dir')
+            raise ValueError('config must contain either bucket_name (or remote_dir) and remote_file, or data_dir')
         # self.engine = st.experimental_connection(config['data_dir'], type=config['type'], autocommit=True)
-        self.conn = sqlite3.connect(local_file, check_same_thread=False)
+        pool_config = pool_config or {}
+        self.connections = ConnectionManager(local_file,
+                                             pool_size=pool_config.get('pool_size', 5),
+                                             max_overflow=pool_config.get('max_overflow', 10),
+                                             pool_recycle=pool_config.get('pool_recycle', 3600))
         os.chmod(local_file, 0o777)
-        self.cursor = self.conn.cursor()
+        self.connections.write(lambda conn: self.set_pragmas(conn, config))
+        if self.schema == 'single':
+            self.connections.write(self.create_tables)
+            self.connections.write(self.migrate_per_address_tables)
+        self.catalogs: dict[TableType, TimestampCatalog] = {}
+        self.catalog_lock = threading.Lock()
+        self.connections.write(self.create_catalog)
+        self.connections.write(self.create_results_tables)
+        self.connections.write(self.create_rebuild_checkpoints)
+        self.connections.write(self.create_token_metadata)
+        self.connections.write(self.create_pnl_ledger)
+        self.deltas: typing.Optional[DeltaSnapshots] = None
+        if self.snapshot_storage == 'delta':
+            self.deltas = DeltaSnapshots(config.get('keyframe_interval', 60))
+            self.connections.write(self.deltas.create_tables)
+
+    @staticmethod
+    def set_pragmas(conn: sqlite3.Connection, config: dict) -> None:
+        '''
+        page_size only applies to a new db file (it is set before the journal mode, which fixes it in WAL).
+        WAL with synchronous=NORMAL lets readers run during writes and only syncs at checkpoints.
+        '''
+        conn.execute(f"PRAGMA page_size = {int(config.get('page_size', 4096))}")
+        conn.execute(f"PRAGMA journal_mode = {config.get('journal_mode', 'WAL')}")
+        conn.execute(f"PRAGMA synchronous = {config.get('synchronous', 'NORMAL')}")
+
+    @staticmethod
+    def create_tables(conn: sqlite3.Connection) -> None:
+        for table_name, columns in table_schemas.items():
+            columns_sql = ', '.join(f'{column} {sql_type}' for column, sql_type in columns.items())
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {table_name} ({columns_sql})')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_address_timestamp '
+                         f'ON {table_name} (address, timestamp)')
+
+    @staticmethod
+    def migrate_per_address_tables(conn: sqlite3.Connection) -> None:
+        '''
+        moves legacy snapshots_<address> / transactions_<address> tables into the single indexed tables.
+        runs in one transaction, so a failed migration leaves the legacy tables untouched.
+        '''
+        legacy_tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND (name LIKE 'snapshots\\_0x%' ESCAPE '\\' OR name LIKE 'transactions\\_0x%' ESCAPE '\\')").fetchall()]
+        for legacy_table in legacy_tables:
+            table_name, address = legacy_table.split('_', 1)
+            legacy_columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{legacy_table}")').fetchall()]
+            columns = [column for column in table_schemas[table_name] if column in legacy_columns and column != 'address']
+            conn.execute(f'INSERT INTO {table_name} ({", ".join(columns)}, address) '
+                         f'SELECT {", ".join(columns)}, ? FROM "{legacy_table}"', (address,))
+            conn.execute(f'DROP TABLE "{legacy_table}"')
+            logging.info(f'migrated {legacy_table} into {table_name}')
+
+    def create_catalog(self, conn: sqlite3.Connection) -> None:
+        '''
+        timestamp_catalog holds the distinct (address, timestamp) of each table and is maintained on insert.
+        it is backfilled from the data tables the first time a db is opened with it.
+        plex_metadata's catalog_size_<table_name> counts its rows, so that a process can cheaply tell that another one
+        (eg the cron cli on the same data_dir) inserted since it loaded its catalog.
+        '''
+        conn.execute('CREATE TABLE IF NOT EXISTS timestamp_catalog '
+                     '(table_name TEXT, address TEXT, timestamp INTEGER, '
+                     'PRIMARY KEY (table_name, address, timestamp)) WITHOUT ROWID')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_timestamp_catalog_timestamp ON timestamp_catalog (table_name, timestamp)')
+        conn.execute('CREATE TABLE IF NOT EXISTS plex_metadata (key TEXT PRIMARY KEY, value)')
+        for table_name in table_schemas:
+            if conn.execute('SELECT 1 FROM timestamp_catalog WHERE table_name = ? LIMIT 1', (table_name,)).fetchone():
+                continue
+            if self.schema == 'per_address':
+                tables = [row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ? ESCAPE '\\'",
+                    (f'{table_name}\\_0x%',)).fetchall()]
+                rows = [(address, timestamp)
+                        for table in tables
+                        for address in [table.split('_', 1)[1]]
+                        for (timestamp,) in conn.execute(f'SELECT DISTINCT timestamp FROM "{table}"').fetchall()]
+            else:
+                rows = conn.execute(f'SELECT DISTINCT address, timestamp FROM {table_name}').fetchall()
+            conn.executemany('INSERT OR IGNORE INTO timestamp_catalog VALUES (?, ?, ?)',
+                             [(table_name, address, int(timestamp)) for address, timestamp in rows])
+        for table_name in table_schemas:
+            conn.execute('INSERT OR REPLACE INTO plex_metadata VALUES (?, '
+                         '(SELECT COUNT(*) FROM timestamp_catalog WHERE table_name = ?))', (f'catalog_size_{table_name}', table_name))
+
+    @staticmethod
+    def create_results_tables(conn: sqlite3.Connection) -> None:
+        '''
+        plex_results_pairs records which (addresses, start_ts, end_ts) have been explained, and with which
+        categories_version, plex_results holds their rows. plex_metadata holds the categories_version, and categories
+        the underlying of each asset.
+        '''
+        conn.execute('CREATE TABLE IF NOT EXISTS plex_metadata (key TEXT PRIMARY KEY, value)')
+        conn.execute("INSERT OR IGNORE INTO plex_metadata VALUES ('categories_version', 0)")
+        conn.execute('CREATE TABLE IF NOT EXISTS plex_results_pairs '
+                     '(addresses TEXT, start_ts INTEGER, end_ts INTEGER, categories_version INTEGER, '
+                     'PRIMARY KEY (addresses, start_ts, end_ts)) WITHOUT ROWID')
+        columns_sql = ', '.join(f'{column} {sql_type}' for column, sql_type in plex_results_columns.items())
+        conn.execute(f'CREATE TABLE IF NOT EXISTS plex_results '
+                     f'(addresses TEXT, start_ts INTEGER, end_ts INTEGER, categories_version INTEGER, {columns_sql})')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_plex_results_pair ON plex_results (addresses, start_ts, end_ts)')
+        conn.execute('CREATE TABLE IF NOT EXISTS categories (asset TEXT, underlying TEXT)')
+
+    @staticmethod
+    def create_token_metadata(conn: sqlite3.Connection) -> None:
+        '''token symbol of each (chain, lowercase contract address), NULL when the contract has none'''
+        conn.execute('CREATE TABLE IF NOT EXISTS token_metadata '
+                     '(chain TEXT, address TEXT, symbol TEXT, PRIMARY KEY (chain, address)) WITHOUT ROWID')
+
+    def query_token_symbols(self, tokens: typing.Iterable[tuple[str, str]]) -> dict[tuple[str, str], typing.Optional[str]]:
+        '''symbols of the (chain, lowercase address) already resolved, missing ones are not in the result'''
+        by_chain = collections.defaultdict(list)
+        for chain, address in set(tokens):
+            by_chain[chain].append(address)
+        result = {}
+        with self.connections.reader() as conn:
+            for chain, addresses in by_chain.items():
+                # stay well within sqlite's bound parameter limit
+                for i in range(0, len(addresses), 500):
+                    chunk = addresses[i:i + 500]
+                    result |= {(chain, address): symbol for address, symbol in conn.execute(
+                        f'SELECT address, symbol FROM token_metadata WHERE chain = ? AND address IN ({", ".join("?" for _ in chunk)})',
+                        (chain, *chunk)).fetchall()}
+        return result
+
+    def insert_token_symbols(self, symbols: dict[tuple[str, str], typing.Optional[str]]) -> None:
+        self.connections.write(lambda conn: conn.executemany('INSERT OR REPLACE INTO token_metadata VALUES (?, ?, ?)',
+                                                             [(chain, address, symbol) for (chain, address), symbol in symbols.items()]))
+
+    @staticmethod
+    def create_pnl_ledger(conn: sqlite3.Connection) -> None:
+        '''
+        pnl_ledger holds the pnl of each snapshot window and its running total per pnl_ledger_keys, with a row only
+        when the total moves. pnl_ledger_heads holds the snapshot timestamp each address' ledger is up to date with.
+        '''
+        keys_sql = ', '.join(f'{key} TEXT' for key in pnl_ledger_keys)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS pnl_ledger ({keys_sql}, timestamp INTEGER, pnl REAL, cum_pnl REAL, '
+                     f'PRIMARY KEY ({", ".join(pnl_ledger_keys)}, timestamp)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS pnl_ledger_heads (address TEXT PRIMARY KEY, timestamp INTEGER)')
+
+    @staticmethod
+    def _pnl_ledger_at(conn: sqlite3.Connection, addresses: list[str], timestamp: int) -> pd.DataFrame:
+        # sqlite takes the bare cum_pnl from the row of MAX(timestamp)
+        return pd.read_sql_query(f'SELECT {", ".join(pnl_ledger_keys)}, MAX(timestamp) AS timestamp, cum_pnl FROM pnl_ledger '
+                                 f'WHERE address IN ({", ".join("?" for _ in addresses)}) AND timestamp <= ? '
+                                 f'GROUP BY {", ".join(pnl_ledger_keys)}', conn, params=(*addresses, int(timestamp)))
+
+    def pnl_ledger_at(self, addresses: list[str], timestamp: int) -> pd.DataFrame:
+        '''running total of each ledger key as of timestamp'''
+        with self.connections.reader() as conn:
+            return self._pnl_ledger_at(conn, addresses, timestamp).drop(columns='timestamp')
+
+    def cumulative_pnl(self, addresses: list[str], start_timestamp: int, end_timestamp: int) -> pd.DataFrame:
+        '''pnl between two timestamps per ledger key: two ledger lookups and a subtraction'''
+        start = self.pnl_ledger_at(addresses, start_timestamp).set_index(pnl_ledger_keys)['cum_pnl']
+        end = self.pnl_ledger_at(addresses, end_timestamp).set_index(pnl_ledger_keys)['cum_pnl']
+        return end.sub(start, fill_value=0).rename('pnl').reset_index()
+
+    def pnl_ledger_head(self, address: str) -> typing.Optional[int]:
+        with self.connections.reader() as conn:
+            row = conn.execute('SELECT timestamp FROM pnl_ledger_heads WHERE address = ?', (address,)).fetchone()
+        return row[0] if row is not None else None
+
+    def append_pnl_ledger(self, address: str, head: int, entries: pd.DataFrame) -> None:
+        '''
+        appends the pnl of address' windows up to head, one row per ledger key and window end timestamp, and moves its
+        head to head. running totals carry on from the ledger, in the same transaction.
+        '''
+        def append(conn: sqlite3.Connection) -> None:
+            if not entries.empty:
+                previous = self._pnl_ledger_at(conn, [address], entries['timestamp'].min()).set_index(pnl_ledger_keys)['cum_pnl']
+                data = entries.sort_values('timestamp', kind='stable')
+                data['cum_pnl'] = data.groupby(pnl_ledger_keys, observed=True)['pnl'].cumsum() \
+                                  + np.nan_to_num(previous.reindex(pd.MultiIndex.from_frame(data[pnl_ledger_keys])).to_numpy(dtype=float))
+                columns = pnl_ledger_keys + ['timestamp', 'pnl', 'cum_pnl']
+                conn.executemany(f'INSERT OR REPLACE INTO pnl_ledger ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+                                 zip(*(data[column].tolist() for column in columns)))
+            conn.execute('INSERT OR REPLACE INTO pnl_ledger_heads VALUES (?, ?)', (address, int(head)))
+        self.connections.write(append)
+
+    @staticmethod
+    def create_rebuild_checkpoints(conn: sqlite3.Connection) -> None:
+        '''last raw file timestamp inserted by a rebuild, per address and table'''
+        conn.execute('CREATE TABLE IF NOT EXISTS rebuild_checkpoints '
+                     '(address TEXT, table_name TEXT, timestamp INTEGER, PRIMARY KEY (address, table_name)) WITHOUT ROWID')
+
+    def rebuild_checkpoint(self, address: str, table_name: TableType) -> int:
+        with self.connections.reader() as conn:
+            row = conn.execute('SELECT timestamp FROM rebuild_checkpoints WHERE address = ? AND table_name = ?',
+                               (address, table_name)).fetchone()
+        return row[0] if row else 0
+
+    def catalog(self, table_name: TableType) -> TimestampCatalog:
+        '''
+        in-memory catalog of table_name, first checked against the row count in plex_metadata: rows inserted by another
+        process since are read back, by the timestamp index when they are newer than the catalog, else in full.
+        '''
+        with self.catalog_lock, self.connections.reader() as conn:
+            # one read transaction, so that the count and the rows agree
+            conn.execute('BEGIN')
+            try:
+                size = conn.execute('SELECT value FROM plex_metadata WHERE key = ?', (f'catalog_size_{table_name}',)).fetchone()[0]
+                catalog = self.catalogs.get(table_name)
+                if catalog is not None and catalog.size != size:
+                    for address, timestamp in conn.execute('SELECT address, timestamp FROM timestamp_catalog '
+                                                           'WHERE table_name = ? AND timestamp >= ?',
+                                                           (table_name, catalog.max_timestamp)).fetchall():
+                        catalog.add(address, timestamp)
+                if catalog is None or catalog.size != size:
+                    catalog = self.catalogs[table_name] = TimestampCatalog(conn.execute(
+                        'SELECT address, timestamp FROM timestamp_catalog WHERE table_name = ?', (table_name,)).fetchall())
+            finally:
+                conn.execute('ROLLBACK')
+            return catalog
+
+    @staticmethod
+    def _update_catalog(conn: sqlite3.Connection, df: pd.DataFrame, table_name: TableType) -> list[tuple[str, int]]:
+        '''writes the new (address, timestamp) of df to timestamp_catalog and its size, within the caller's transaction'''
+        keys = df[['address', 'timestamp']].drop_duplicates()
+        rows = [(address, int(timestamp)) for address, timestamp in keys.itertuples(index=False)]
+        added = conn.executemany('INSERT OR IGNORE INTO timestamp_catalog VALUES (?, ?, ?)',
+                                 [(table_name, address, timestamp) for address, timestamp in rows]).rowcount
+        conn.execute('UPDATE plex_metadata SET value = value + ? WHERE key = ?', (max(added, 0), f'catalog_size_{table_name}'))
+        return rows
 
     def last_updated(self, address: str, table_name: TableType) -> datetime:
-        if all_timestamps := self.all_timestamps(address, table_name):
-            timestamp = max(all_timestamps)
+        if (timestamp := self.catalog(table_name).latest(address)) is not None:
             return datetime.fromtimestamp(timestamp, tz=timezone.utc)
         else:
             return datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-    def upload_to_s3(self):
-        s3 = boto3.client('s3',
-                          aws_access_key_id=self.secrets['AWS_ACCESS_KEY_ID'],
-                          aws_secret_access_key=self.secrets['AWS_SECRET_ACCESS_KEY'])
-        s3.upload_file(self.data_location['local_file'], self.data_location['bucket_name'],
-                       self.data_location['remote_file'])
+    def upload_to_s3(self, checkpoint_retries: int = 5):
+        '''pushes the segments of plex.db that changed since the last sync'''
+        def checkpoint_and_push(conn: sqlite3.Connection) -> None:
+            # fold the write-ahead log into the db file before mirroring it, holding off other writes meanwhile.
+            # a reader still on an older snapshot keeps it busy, and the file would then miss commits
+            for attempt in range(checkpoint_retries):
+                busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+                if not busy:
+                    break
+                time.sleep(0.1 * 2 ** attempt)
+            else:
+                raise RuntimeError(f'{self.data_location["local_file"]} write-ahead log still busy after '
+                                   f'{checkpoint_retries} checkpoints, not pushed')
+            self.sync.push()
+        self.connections.write(checkpoint_and_push)
 
     def insert_table(self, df: pd.DataFrame, table_name: TableType) -> None:
-        for address, data in df.groupby('address'):
-            table = f"{table_name}_{address}"
-            data.drop(columns='address').to_sql(table, self.conn, if_exists='append', index=False)
+        self.bulk_insert([df], table_name)
+
+    def bulk_insert(self, frames: typing.Iterable[pd.DataFrame], table_name: TableType,
+                    checkpoint: typing.Optional[tuple[str, int]] = None) -> int:
+        '''
+        inserts many frames in one transaction, through a single prepared INSERT run with executemany.
+        checkpoint (address, timestamp) is recorded in rebuild_checkpoints in the same transaction.
+        returns the number of rows inserted.
+        '''
+        frames = [df for df in frames if not df.empty]
+        if not frames and checkpoint is None:
+            return 0
+        # one concat then column-wise tolist is much cheaper than walking many small frames
+        data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['address', 'timestamp'])
+
+        def insert(conn: sqlite3.Connection) -> list[tuple[str, int]]:
+            if checkpoint is not None:
+                conn.execute('INSERT OR REPLACE INTO rebuild_checkpoints VALUES (?, ?, ?)',
+                             (checkpoint[0], table_name, int(checkpoint[1])))
+            if data.empty:
+                return []
+            if self.schema == 'per_address':
+                for address, address_data in data.groupby('address', observed=True):
+                    table = f"{table_name}_{address}"
+                    address_data.drop(columns='address').to_sql(table, conn, if_exists='append', index=False)
+            else:
+                # in delta storage, only keyframes go to the snapshots table
+                rows = self.deltas.encode(conn, data) if self.deltas is not None and table_name == 'snapshots' else data
+                columns = [column for column in table_schemas[table_name] if column in rows.columns]
+                conn.executemany(f'INSERT INTO {table_name} ({", ".join(columns)}) '
+                                 f'VALUES ({", ".join("?" for _ in columns)})',
+                                 zip(*(rows[column].tolist() for column in columns)))
+            return self._update_catalog(conn, data, table_name)
+        try:
+            new_timestamps = self.connections.write(insert)
+        except Exception:
+            if self.deltas is not None:
+                # the cached states and positions may include rolled back ones
+                self.deltas.reset()
+            raise
+
+        with self.catalog_lock:
+            # not through catalog(), which would read back the rows just written
+            if (catalog := self.catalogs.get(table_name)) is not None:
+                for address, timestamp in new_timestamps:
+                    catalog.add(address, timestamp)
+        return len(data)
 
     def query_table_at(self, addresses: list[str], timestamp: int, table_name: TableType) -> pd.DataFrame:
-        return pd.concat([pd.read_sql_query(f'SELECT * FROM {table_name}_{address} WHERE timestamp = {timestamp}', self.conn)
-                            for address in addresses], ignore_index=True, axis=0)
+        '''snapshots come with the categoricals of snapshot_schema'''
+        if self.deltas is not None and table_name == 'snapshots':
+            return snapshot_schema.encode(self._query_deltas(addresses, timestamp, timestamp))
+        return self._typed(self._query_addresses(addresses, table_name, 'timestamp = ?', (int(timestamp),)), table_name)
 
     def query_table_between(self, addresses: list[str], start_timestamp: int, end_timestamp: int, table_name: TableType) -> pd.DataFrame:
-        return pd.concat([pd.read_sql_query(f'SELECT * FROM {table_name}_{address} WHERE timestamp BETWEEN {start_timestamp} AND {end_timestamp}',self.conn)
-                          for address in addresses], ignore_index=True, axis=0)
-    
+        '''snapshots come with the categoricals of snapshot_schema'''
+        if self.deltas is not None and table_name == 'snapshots':
+            return snapshot_schema.encode(self._query_deltas(addresses, start_timestamp, end_timestamp))
+        return self._typed(self._query_addresses(addresses, table_name, 'timestamp BETWEEN ? AND ?',
+                                                 (int(start_timestamp), int(end_timestamp))), table_name)
+
+    @staticmethod
+    def _typed(df: pd.DataFrame, table_name: TableType) -> pd.DataFrame:
+        return snapshot_schema.encode(df) if table_name == 'snapshots' else df
+
+    def _query_deltas(self, addresses: list[str], start_timestamp: int, end_timestamp: int) -> pd.DataFrame:
+        '''snapshots reconstructed from keyframes and deltas, at the catalog timestamps within the range'''
+        catalog = self.catalog('snapshots')
+        with self.connections.reader() as conn:
+            frames = [self.deltas.read(conn, address, catalog.between(address, start_timestamp, end_timestamp))
+                      for address in addresses]
+        non_empty = [df for df in frames if not df.empty]
+        if not non_empty:
+            return frames[0] if frames else pd.DataFrame(columns=list(table_schemas['snapshots']))
+        return pd.concat(non_empty, ignore_index=True)
+
+    def _query_addresses(self, addresses: list[str], table_name: TableType, condition: str, params: tuple) -> pd.DataFrame:
+        '''one bound-parameter statement over all addresses, or one per address table in the legacy schema'''
+        with self.connections.reader() as conn:
+            if self.schema == 'per_address':
+                return pd.concat([pd.read_sql_query(f'SELECT * FROM "{table_name}_{address}" WHERE {condition}',
+                                                    conn, params=params).assign(address=address)
+                                  for address in addresses], ignore_index=True, axis=0)
+            placeholders = ', '.join('?' for _ in addresses)
+            return pd.read_sql_query(f'SELECT * FROM {table_name} WHERE address IN ({placeholders}) AND {condition}',
+                                     conn, params=tuple(addresses) + params)
+
     def all_timestamps(self, address: str, table_name: TableType) -> list[int]:
-        self.cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}_{address}';")
-        if not self.cursor.fetchall():
-            return []
-        self.cursor.execute(f'SELECT DISTINCT timestamp FROM {table_name}_{address}')
-        rows = self.cursor.fetchall()
-        return [row[0] for row in rows]
-    
+        return self.catalog(table_name).all_timestamps(address)
+
+    def common_timestamps(self, addresses: list[str], table_name: TableType = "snapshots") -> list[int]:
+        return self.catalog(table_name).common_timestamps(addresses)
+
+    def timestamp_at_or_before(self, addresses: list[str], timestamp: float, table_name: TableType = "snapshots") -> typing.Optional[int]:
+        '''latest timestamp <= timestamp that all addresses have, None if there is none'''
+        return self.catalog(table_name).at_or_before(addresses, timestamp)
+
+    def timestamp_at_or_after(self, addresses: list[str], timestamp: float, table_name: TableType = "snapshots") -> typing.Optional[int]:
+        '''earliest timestamp >= timestamp that all addresses have, None if there is none'''
+        return self.catalog(table_name).at_or_after(addresses, timestamp)
+
     def query_categories(self) -> dict:
-        tables = pd.read_sql_query("SELECT name FROM sqlite_master WHERE type='table'", self.conn)
-        if 'categories' not in tables.values:
-            pd.DataFrame(columns=['asset', 'underlying']).to_sql('categories', self.conn, index=False)
-            return {}
-        return pd.read_sql_query('SELECT * FROM categories', self.conn).set_index('asset')['underlying'].to_dict()
+        with self.connections.reader() as conn:
+            return pd.read_sql_query('SELECT * FROM categories', conn).set_index('asset')['underlying'].to_dict()
 
     def overwrite_categories(self, categories: dict) -> None:
+        '''
+        replaces categories, bumps categories_version and invalidates the cached explains holding a re-categorized
+        asset. the other cached explains are carried over to the new version.
+        '''
         # if True:
         #     with open(os.path.join(os.getcwd(), 'config', 'categories_SAVED.yaml'), 'r') as file:
         #         categories = yaml.safe_load(file)
-        pd.DataFrame({'asset':categories.keys(), 'underlying': categories.values()}).to_sql('categories', self.conn, index=False, if_exists='replace')
-        self.conn.commit()
\ No newline at end of file
+        old_categories = self.query_categories()
+
+        def overwrite(conn: sqlite3.Connection) -> None:
+            pd.DataFrame({'asset': categories.keys(), 'underlying': categories.values()}).to_sql('categories', conn, index=False, if_exists='replace')
+            changed = {asset.lower() for asset in set(old_categories) | set(categories)
+                       if old_categories.get(asset) != categories.get(asset)}
+            if changed:
+                stale_pairs = (f'SELECT DISTINCT addresses, start_ts, end_ts FROM plex_results '
+                               f'WHERE lower(asset) IN ({", ".join("?" for _ in changed)})')
+                # pairs first, as the stale pairs are found from plex_results
+                for table in ['plex_results_pairs', 'plex_results']:
+                    conn.execute(f'DELETE FROM {table} WHERE (addresses, start_ts, end_ts) IN ({stale_pairs})', tuple(changed))
+                # the ledger is keyed by asset too, so re-labelling its underlying doesn't merge any running totals
+                lower_categories = {asset.lower(): underlying for asset, underlying in categories.items()}
+                conn.executemany('UPDATE pnl_ledger SET underlying = COALESCE(?, asset) WHERE lower(asset) = ?',
+                                 [(lower_categories.get(asset), asset) for asset in changed])
+            conn.execute("UPDATE plex_metadata SET value = value + 1 WHERE key = 'categories_version'")
+            for table in ['plex_results', 'plex_results_pairs']:
+                conn.execute(f"UPDATE {table} SET categories_version = "
+                             f"(SELECT value FROM plex_metadata WHERE key = 'categories_version')")
+        self.connections.write(overwrite)
+
+    def categories_version(self) -> int:
+        with self.connections.reader() as conn:
+            return conn.execute("SELECT value FROM plex_metadata WHERE key = 'categories_version'").fetchone()[0]
+
+    @staticmethod
+    def _addresses_key(addresses: list[str]) -> str:
+        return ','.join(sorted(set(addresses)))
+
+    def plex_results_pairs(self, addresses: list[str]) -> set[tuple[int, int]]:
+        '''(start_ts, end_ts) already explained for these addresses under the current categories'''
+        with self.connections.reader() as conn:
+            return set(conn.execute('SELECT start_ts, end_ts FROM plex_results_pairs WHERE addresses = ? AND categories_version = '
+                                    "(SELECT value FROM plex_metadata WHERE key = 'categories_version')",
+                                    (self._addresses_key(addresses),)).fetchall())
+
+    def insert_plex_results(self, addresses: list[str], results: list[tuple[int, int, pd.DataFrame]], categories_version: int) -> None:
+        '''persists the explains of (start_ts, end_ts, explain) computed with categories_version'''
+        key = self._addresses_key(addresses)
+        frames = [explain.reindex(columns=list(plex_results_columns)).assign(addresses=key, start_ts=int(start), end_ts=int(end),
+                                                                            categories_version=categories_version)
+                  for start, end, explain in results if not explain.empty]
+        columns = ['addresses', 'start_ts', 'end_ts', 'categories_version'] + list(plex_results_columns)
+
+        def insert(conn: sqlite3.Connection) -> None:
+            # categories changed while we were explaining: don't persist stale results
+            if conn.execute("SELECT value FROM plex_metadata WHERE key = 'categories_version'").fetchone()[0] != categories_version:
+                return
+            conn.executemany('INSERT OR REPLACE INTO plex_results_pairs VALUES (?, ?, ?, ?)',
+                             [(key, int(start), int(end), categories_version) for start, end, _ in results])
+            if frames:
+                data = pd.concat(frames, ignore_index=True)
+                conn.executemany(f'INSERT INTO plex_results ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+                                 zip(*(data[column].tolist() for column in columns)))
+        self.connections.write(insert)
+
+    def query_plex_results(self, addresses: list[str], pairs: list[tuple[int, int]]) -> pd.DataFrame:
+        '''cached explains of these (start_ts, end_ts) pairs, in the format and dtypes of PnlExplainer.explain'''
+        if not pairs:
+            return pd.DataFrame(columns=list(plex_results_columns) + ['timestamp_start', 'timestamp_end'])
+        with self.connections.reader() as conn:
+            result = pd.read_sql_query('SELECT * FROM plex_results WHERE addresses = ? AND start_ts >= ? AND end_ts <= ?', conn,
+                                       params=(self._addresses_key(addresses),
+                                               int(min(start for start, _ in pairs)), int(max(end for _, end in pairs))))
+        wanted = pd.DataFrame(pairs, columns=['start_ts', 'end_ts']).astype('int64')
+        result = result.merge(wanted, on=['start_ts', 'end_ts'], how='inner')
+        # same dtypes as a fresh explain: snapshot_schema's categoricals and second timestamps in microseconds
+        result['timestamp_start'] = pd.to_datetime(result['start_ts'], unit='s', utc=True).astype('datetime64[us, UTC]')
+        result['timestamp_end'] = pd.to_datetime(result['end_ts'], unit='s', utc=True).astype('datetime64[us, UTC]')
+        return snapshot_schema.encode(result.drop(columns=['addresses', 'start_ts', 'end_ts', 'categories_version']))
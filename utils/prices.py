@@ -0,0 +1,127 @@
+import logging
+import sqlite3
+import time
+import typing
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+from utils.coingecko import SeriesCache, myCoinGeckoAPI
+from utils.db import SQLiteDB
+
+
+class PriceBackend(ABC):
+    '''where PriceStore fetches the prices it doesn't have yet'''
+    @abstractmethod
+    def fetch(self, coin_id: str, start: int, end: int) -> pd.DataFrame:
+        '''prices of coin_id between start and end (in s): columns timestamp (in s) and price'''
+        raise NotImplementedError
+
+
+class CoinGeckoPriceBackend(PriceBackend):
+    def __init__(self, api: myCoinGeckoAPI = None, vs_currency: str = 'usd'):
+        self.api = api or myCoinGeckoAPI()
+        self.vs_currency = vs_currency
+
+    def fetch(self, coin_id: str, start: int, end: int) -> pd.DataFrame:
+        prices = self.api.get_coin_market_chart_range_by_id(id=coin_id, vs_currency=self.vs_currency,
+                                                             from_timestamp=start, to_timestamp=end)['prices']
+        # [[ms, price], ...]
+        data = np.array(prices, dtype=float).reshape(-1, 2)
+        return pd.DataFrame({'timestamp': (data[:, 0] // 1000).astype('int64'), 'price': data[:, 1]})
+
+
+class FixturePriceBackend(PriceBackend):
+    '''
+    prices from a frame, or csv file, of coin_id, timestamp (in s) and price, for tests and benchmarks.
+    fetched records the (coin_id, start, end) of each fetch.
+    '''
+    def __init__(self, prices: typing.Union[pd.DataFrame, str]):
+        self.prices = pd.read_csv(prices) if isinstance(prices, str) else prices
+        self.fetched: list[tuple[str, int, int]] = []
+
+    def fetch(self, coin_id: str, start: int, end: int) -> pd.DataFrame:
+        self.fetched.append((coin_id, start, end))
+        rows = (self.prices['coin_id'] == coin_id) & self.prices['timestamp'].between(start, end)
+        return self.prices.loc[rows, ['timestamp', 'price']]
+
+
+class PriceStore:
+    '''
+    append-only local price history, in plex_db's prices table keyed by (coin_id, timestamp).
+    price_coverage records the ranges already fetched from backend, so that only missing ranges are ever fetched,
+    gaps shorter than min_gap being left for later.
+    prices_at prices many (coin_id, timestamp) at once, as of the last price at or before each timestamp,
+    no older than tolerance (in s). coin_id 'usd' is priced 1.
+    '''
+    def __init__(self, plex_db: SQLiteDB, backend: PriceBackend, tolerance: int = 86400, min_gap: int = 3600):
+        self.plex_db = plex_db
+        self.backend = backend
+        self.tolerance = tolerance
+        self.min_gap = min_gap
+        self.plex_db.connections.write(self.create_tables)
+
+    @staticmethod
+    def create_tables(conn: sqlite3.Connection) -> None:
+        conn.execute('CREATE TABLE IF NOT EXISTS prices '
+                     '(coin_id TEXT, timestamp INTEGER, price REAL, PRIMARY KEY (coin_id, timestamp)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS price_coverage (coin_id TEXT, start INTEGER, end INTEGER)')
+
+    def coverage(self, coin_id: str) -> list[tuple[int, int]]:
+        '''fetched ranges of coin_id, sorted and disjoint'''
+        with self.plex_db.connections.reader() as conn:
+            return conn.execute('SELECT start, end FROM price_coverage WHERE coin_id = ? ORDER BY start', (coin_id,)).fetchall()
+
+    def ensure(self, coin_id: str, start: int, end: int) -> int:
+        '''fetches the missing ranges of coin_id within [start, end], returns the number of fetches'''
+        end = min(end, int(time.time()))
+        gaps = [(gap_start, gap_end) for gap_start, gap_end in SeriesCache.gaps(self.coverage(coin_id), start, end)
+                if gap_end - gap_start >= self.min_gap]
+        for gap_start, gap_end in gaps:
+            try:
+                prices = self.backend.fetch(coin_id, gap_start, gap_end)
+            except Exception as e:
+                logging.warning(f'prices of {coin_id} from {gap_start} to {gap_end} -> Error: {e}')
+                continue
+
+            def insert(conn: sqlite3.Connection) -> None:
+                conn.executemany('INSERT OR IGNORE INTO prices VALUES (?, ?, ?)',
+                                 zip([coin_id] * len(prices), prices['timestamp'].astype('int64').tolist(), prices['price'].tolist()))
+                intervals = conn.execute('SELECT start, end FROM price_coverage WHERE coin_id = ?', (coin_id,)).fetchall()
+                conn.execute('DELETE FROM price_coverage WHERE coin_id = ?', (coin_id,))
+                conn.executemany('INSERT INTO price_coverage VALUES (?, ?, ?)',
+                                 [(coin_id, *interval) for interval in SeriesCache.merge_intervals(intervals + [(gap_start, gap_end)])])
+            self.plex_db.connections.write(insert)
+        return len(gaps)
+
+    def history(self, coin_id: str, start: int, end: int) -> pd.DataFrame:
+        '''stored prices of coin_id within [start, end], by timestamp. doesn't fetch'''
+        with self.plex_db.connections.reader() as conn:
+            return pd.read_sql_query('SELECT timestamp, price FROM prices WHERE coin_id = ? AND timestamp BETWEEN ? AND ? '
+                                     'ORDER BY timestamp', conn, params=(coin_id, int(start), int(end)))
+
+    def prices_at(self, coin_ids: typing.Sequence[str], timestamps: typing.Sequence[int]) -> np.ndarray:
+        '''
+        price of each (coin_id, timestamp), NaN where there is none within tolerance. each coin's missing range is
+        fetched once, then all pairs are priced with one as-of merge.
+        '''
+        query = pd.DataFrame({'coin_id': np.asarray(coin_ids, dtype=object),
+                              'timestamp': np.asarray(timestamps, dtype='int64'),
+                              'row': np.arange(len(coin_ids))})
+        result = np.full(len(query), np.nan)
+        result[(query['coin_id'] == 'usd').to_numpy()] = 1.0
+        query = query[query['coin_id'].notna() & (query['coin_id'] != 'usd')]
+        if query.empty:
+            return result
+
+        histories = []
+        for coin_id, (start, end) in query.groupby('coin_id')['timestamp'].agg(['min', 'max']).iterrows():
+            self.ensure(coin_id, start - self.tolerance, end)
+            histories.append(self.history(coin_id, start - self.tolerance, end).assign(coin_id=coin_id))
+        history = pd.concat(histories, ignore_index=True).astype({'timestamp': 'int64', 'price': 'float64'})
+
+        priced = pd.merge_asof(query.sort_values('timestamp'), history.sort_values('timestamp'), on='timestamp', by='coin_id',
+                               direction='backward', tolerance=self.tolerance)
+        result[priced['row'].to_numpy()] = priced['price'].to_numpy()
+        return result
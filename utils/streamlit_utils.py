@@ -58,12 +58,13 @@ def prompt_snapshot_timestamp(plex_db: SQLiteDB, addresses: list[str]) -> int:
         date = st.date_input("date", value=now_datetime)
     result = datetime.combine(date, time)
 
-    # intersection of timestamps lists for all addresses
-    list_timestamps = [plex_db.all_timestamps(address, "snapshots") for address in addresses]
-    timestamps = [x for x in set(list_timestamps[0]) if all(x in lst for lst in list_timestamps)]
-
-    timestamp = next((ts for ts in sorted(timestamps, reverse=False)
-                          if ts >= result.timestamp()), max(timestamps))
+    # first snapshot common to all addresses after the prompted date, else the latest one
+    if not (timestamps := plex_db.common_timestamps(addresses, "snapshots")):
+        st.error("No snapshot common to all addresses, please fetch one from debank")
+        st.stop()
+    timestamp = plex_db.timestamp_at_or_after(addresses, result.timestamp(), "snapshots")
+    if timestamp is None:
+        timestamp = timestamps[-1]
 
     st.write(f"Actual date of snapshot: {datetime.fromtimestamp(timestamp)}")
 
@@ -85,14 +86,16 @@ def prompt_plex_interval(plex_db: SQLiteDB, addresses: list[str], nonce: str='',
         st.error("start time must be before end time")
         st.stop()
 
-    # intersection of timestamps lists for all addresses
-    list_timestamps = [plex_db.all_timestamps(address, "snapshots") for address in addresses]
-    timestamps = [x for x in set(list_timestamps[0]) if all(x in lst for lst in list_timestamps)]
-
-    start_timestamp = next((ts for ts in sorted(timestamps, reverse=True)
-                            if ts <= start_datetime.timestamp()), min(timestamps))
-    end_timestamp = next((ts for ts in sorted(timestamps, reverse=False)
-                          if ts >= end_datetime.timestamp()), max(timestamps))
+    # snapshots common to all addresses bracketing the prompted interval, else the first/latest ones
+    if not (timestamps := plex_db.common_timestamps(addresses, "snapshots")):
+        st.error("No snapshot common to all addresses, please fetch one from debank")
+        st.stop()
+    start_timestamp = plex_db.timestamp_at_or_before(addresses, start_datetime.timestamp(), "snapshots")
+    if start_timestamp is None:
+        start_timestamp = timestamps[0]
+    end_timestamp = plex_db.timestamp_at_or_after(addresses, end_datetime.timestamp(), "snapshots")
+    if end_timestamp is None:
+        end_timestamp = timestamps[-1]
 
     st.write(f"Actual dates of snapshots: {datetime.fromtimestamp(start_timestamp)}, {datetime.fromtimestamp(end_timestamp)}")
 
@@ -176,12 +179,13 @@ def display_multi_stacked_bars(df: pd.DataFrame,
     '''
 
     def display_stacked_bars():
-        cur_df = row_df[row_df.apply(lambda x: all(x[col] in selection
-                                       for col, selection in filtering.items()
-                                       if selection != ['all']),
-                         axis=1)]
+        selected = np.ones(len(row_df), dtype=bool)
+        for col, selection in filtering.items():
+            if selection != ['all']:
+                selected &= row_df[col].isin(selection).to_numpy()
+        cur_df = row_df[selected]
         # pivot and display
-        totals = pd.pivot_table(cur_df, values=values, columns=[stacking_field], index=rows, aggfunc='sum')
+        totals = pd.pivot_table(cur_df, values=values, columns=[stacking_field], index=rows, aggfunc='sum', observed=True)
         if cum_sum:
             totals = totals.cumsum()
         totals = totals.stack().reset_index()
@@ -210,7 +214,7 @@ def display_multi_stacked_bars(df: pd.DataFrame,
                                         options=list(df[filter_col].unique()) + ['all']):
                 filtering[filter_col] = prompt
     if row_field != 'all':
-        for row, row_df in df.groupby(row_field):
+        for row, row_df in df.groupby(row_field, observed=True):
             display_stacked_bars()
     else:
         row = 'all'
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import os
+import typing
+from abc import ABC, abstractmethod
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+class RemoteStore(ABC):
+    '''
+    Minimal object store interface used to mirror plex.db: S3, or a local directory standing in for it.
+    '''
+    @staticmethod
+    def build_RemoteStore(config: dict, secrets: dict):
+        if 'bucket_name' in config:
+            return S3Store(config['bucket_name'], secrets)
+        elif 'remote_dir' in config:
+            return LocalDirStore(config['remote_dir'])
+        else:
+            raise ValueError('config must contain either bucket_name or remote_dir')
+
+    @abstractmethod
+    def get(self, key: str) -> typing.Optional[bytes]:
+        '''returns None if key does not exist'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_range(self, key: str, offset: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, key: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def etag(self, key: str) -> typing.Optional[str]:
+        '''cheap version tag of an object, None if key does not exist'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def list(self, prefix: str) -> typing.Iterator[str]:
+        '''all keys starting with prefix'''
+        raise NotImplementedError
+
+
+class S3Store(RemoteStore):
+    def __init__(self, bucket_name: str, secrets: dict):
+        self.bucket_name = bucket_name
+        self.connection = boto3.client('s3',
+                                       aws_access_key_id=secrets['AWS_ACCESS_KEY_ID'],
+                                       aws_secret_access_key=secrets['AWS_SECRET_ACCESS_KEY'])
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        try:
+            return self.connection.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return None
+            raise e
+
+    def get_range(self, key: str, offset: int, length: int) -> bytes:
+        return self.connection.get_object(Bucket=self.bucket_name, Key=key,
+                                          Range=f'bytes={offset}-{offset + length - 1}')['Body'].read()
+
+    def put(self, key: str, data: bytes) -> None:
+        self.connection.put_object(Bucket=self.bucket_name, Key=key, Body=data)
+
+    def delete(self, key: str) -> None:
+        self.connection.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def etag(self, key: str) -> typing.Optional[str]:
+        try:
+            return self.connection.head_object(Bucket=self.bucket_name, Key=key)['ETag'].strip('"')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return None
+            raise e
+
+    def list(self, prefix: str) -> typing.Iterator[str]:
+        # list_objects_v2 returns at most 1000 keys per call
+        for page in self.connection.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+
+class LocalDirStore(RemoteStore):
+    def __init__(self, remote_dir: str):
+        self.remote_dir = remote_dir
+        os.makedirs(self.remote_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.remote_dir, *key.split('/'))
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        if not os.path.isfile(self._path(key)):
+            return None
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def get_range(self, key: str, offset: int, length: int) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so readers never see a partial object
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+
+    def delete(self, key: str) -> None:
+        if os.path.isfile(self._path(key)):
+            os.remove(self._path(key))
+
+    def etag(self, key: str) -> typing.Optional[str]:
+        if not os.path.isfile(self._path(key)):
+            return None
+        with open(self._path(key), 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def list(self, prefix: str) -> typing.Iterator[str]:
+        directory = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        for root, _, files in os.walk(self._path(directory)):
+            for file in files:
+                key = os.path.relpath(os.path.join(root, file), self.remote_dir).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.tmp'):
+                    yield key
+
+
+class SegmentSync:
+    '''
+    Mirrors a local file to a RemoteStore as immutable content-addressed segments plus a manifest:
+        <remote_file>.manifest.json     {'version', 'size', 'segment_size', 'segments': [sha256, ...]}
+        <remote_file>.segments/<sha256>
+    pull() skips the download when the remote manifest matches the one last synced, and otherwise only fetches
+    segments the local file doesn't already have. push() only uploads segments the remote doesn't have.
+    A remote holding only the legacy whole <remote_file> is downloaded once (skipped if its ETag is unchanged)
+    and converted to segments on the next push.
+    segment_size should be a multiple of the sqlite page size, so that a write only dirties the segments of its pages.
+    segments a push no longer references are listed in the manifest's retired, and only deleted gc_delay pushes later,
+    so that a pull that read the previous manifest can still fetch them.
+    '''
+    def __init__(self, store: RemoteStore, remote_file: str, local_file: str, segment_size: int = 1 << 20, gc_delay: int = 2):
+        self.store = store
+        self.remote_file = remote_file
+        self.local_file = local_file
+        self.segment_size = segment_size
+        self.gc_delay = gc_delay
+        self.manifest_key = f'{remote_file}.manifest.json'
+        self.state_file = f'{local_file}.sync.json'
+
+    def segment_key(self, digest: str) -> str:
+        return f'{self.remote_file}.segments/{digest}'
+
+    def _load_state(self) -> dict:
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file, 'r') as f:
+            return json.load(f)
+
+    def _save_state(self, state: dict) -> None:
+        with open(self.state_file, 'w') as f:
+            json.dump(state, f)
+
+    def _remote_manifest(self) -> typing.Optional[dict]:
+        if (data := self.store.get(self.manifest_key)) is None:
+            return None
+        return json.loads(data)
+
+    def _local_segments(self, segment_size: int) -> typing.Iterator[tuple[str, bytes]]:
+        '''(sha256, bytes) of each segment of the local file, in file order'''
+        if not os.path.isfile(self.local_file):
+            return
+        with open(self.local_file, 'rb') as f:
+            while chunk := f.read(segment_size):
+                yield hashlib.sha256(chunk).hexdigest(), chunk
+
+    def pull(self) -> bool:
+        '''
+        brings local_file in line with the remote. returns True if anything was downloaded.
+        '''
+        try:
+            return self._pull()
+        except FileNotFoundError as e:
+            # segments of the manifest we read were collected meanwhile, the current manifest doesn't need them
+            logging.warning(f'{e}, retrying with the current manifest')
+            return self._pull()
+
+    def _pull(self) -> bool:
+        state = self._load_state()
+        manifest = self._remote_manifest()
+
+        if manifest is None:
+            # legacy whole-file remote, or nothing at all
+            etag = self.store.etag(self.remote_file)
+            if etag is None:
+                if not os.path.isfile(self.local_file):
+                    logging.warning(f'Creating new {self.local_file}')
+                    with open(self.local_file, 'w') as f:
+                        f.write('')
+                return False
+            if etag == state.get('legacy_etag') and os.path.isfile(self.local_file):
+                return False
+            with open(self.local_file, 'wb') as f:
+                f.write(self.store.get(self.remote_file))
+            self._save_state({'legacy_etag': etag})
+            return True
+
+        if (state.get('manifest') == manifest and os.path.isfile(self.local_file)
+                and os.path.getsize(self.local_file) == manifest['size']):
+            return False
+
+        # offsets of the segments we already have locally
+        segment_size = manifest['segment_size']
+        local_offsets = {digest: i * segment_size for i, (digest, _) in enumerate(self._local_segments(segment_size))}
+        downloaded = 0
+        with open(f'{self.local_file}.tmp', 'wb') as f:
+            for digest in manifest['segments']:
+                if digest in local_offsets:
+                    with open(self.local_file, 'rb') as local:
+                        local.seek(local_offsets[digest])
+                        data = local.read(segment_size)
+                else:
+                    if (data := self.store.get(self.segment_key(digest))) is None:
+                        raise FileNotFoundError(f'segment {digest} of {self.manifest_key} is missing, retry the pull')
+                    downloaded += 1
+                f.write(data)
+        os.replace(f'{self.local_file}.tmp', self.local_file)
+        self._save_state({'manifest': manifest})
+        logging.info(f'pulled {downloaded}/{len(manifest["segments"])} segments of {self.remote_file}')
+        return True
+
+    def push(self) -> int:
+        '''
+        uploads the segments of local_file the remote doesn't have, then the manifest, then deletes the segments
+        retired gc_delay pushes ago. returns the number of segments uploaded.
+        '''
+        previous = self._remote_manifest() or {'version': 0, 'segments': []}
+        retired: dict[str, int] = previous.get('retired', {})
+        remote_digests = set(previous['segments']) if previous.get('segment_size') == self.segment_size else set()
+        remote_digests |= set(retired)
+
+        digests = []
+        uploaded = 0
+        for digest, chunk in self._local_segments(self.segment_size):
+            if digest not in remote_digests:
+                self.store.put(self.segment_key(digest), chunk)
+                remote_digests.add(digest)
+                uploaded += 1
+            digests.append(digest)
+
+        version = previous['version'] + 1
+        referenced = set(digests)
+        retired = {digest: retired_at for digest, retired_at in retired.items() if digest not in referenced} \
+                  | {digest: version for digest in set(previous['segments']) - referenced - set(retired)}
+        expired = [digest for digest, retired_at in retired.items() if version - retired_at >= self.gc_delay]
+        manifest = {'version': version,
+                    'size': os.path.getsize(self.local_file),
+                    'segment_size': self.segment_size,
+                    'segments': digests,
+                    'retired': {digest: retired_at for digest, retired_at in retired.items() if digest not in expired}}
+        self.store.put(self.manifest_key, json.dumps(manifest).encode('utf-8'))
+        self._save_state({'manifest': manifest})
+
+        for digest in expired:
+            self.store.delete(self.segment_key(digest))
+        logging.info(f'pushed {uploaded}/{len(digests)} segments of {self.remote_file}')
+        return uploaded